@@ -0,0 +1,113 @@
+"""
+Answer matching for Math Jeopardy
+Each stored answer is compiled once into a set of canonical keys: when it
+reads as a number, its exact rational value, so that 1/2, 0.5, 0,5 and
+٠٫٥ are the same answer; otherwise its normalized text (see normalize.py)
+with runs of spaces collapsed. Spaces are kept because they can matter
+("1 2" is not 12), and numbers are never compared as text ("11/2" is not
+"1 1/2"). A comma before exactly three digits groups thousands (1,000);
+any other comma between digits is a decimal comma. Checking a submission
+builds its keys and intersects the two sets, so the cost depends only on
+the submission's length, and submissions over MAX_ANSWER_LENGTH never
+match. Common submissions ("4", "1/2") are served from a small LRU cache.
+"""
+
+import re
+from fractions import Fraction
+from functools import lru_cache
+
+from normalize import normalize_text
+
+# Separators between alternative spellings stored in one answer field
+_ALTERNATIVES = re.compile(r'\s*[|؛;]\s*')
+
+# "x = 4", "س = 4": the variable name is not part of the answer
+_ASSIGNMENT = re.compile(r'^[a-zء-ي]\s*=\s*')
+
+# Thousands grouped by commas: 1,000 and 12,345,678 (but 0,125 is a decimal)
+_THOUSANDS = re.compile(r'(?<![\d.,])[1-9]\d{0,2}(?:,\d{3})+(?![\d,])')
+
+# French decimal comma between digits
+_DECIMAL_COMMA = re.compile(r'(?<=\d),(?=\d)')
+
+_SPACES = re.compile(r'\s+')
+
+_NUMBER = re.compile(r'''
+    ^(?P<sign>[-+−]?)
+    (?:
+        (?P<whole>\d+)\s+(?P<mnum>\d+)\s*/\s*(?P<mden>\d+)   # mixed number: 1 1/2
+      | (?P<num>\d+(?:\.\d*)?|\.\d+)\s*/\s*(?P<den>\d+(?:\.\d*)?)   # fraction: 3/4
+      | (?P<dec>\d+(?:\.\d*)?|\.\d+)\s*(?P<pct>%)?            # decimal or percent
+    )$
+''', re.VERBOSE)
+
+# Longest submission considered; anything longer is wrong whatever it starts with
+MAX_ANSWER_LENGTH = 200
+
+
+def _number(text):
+    """Exact value of text as a Fraction, or None if it isn't a number"""
+    match = _NUMBER.match(text)
+    if not match:
+        return None
+    try:
+        if match['whole'] is not None:
+            denominator = int(match['mden'])
+            if not denominator:
+                return None
+            value = int(match['whole']) + Fraction(int(match['mnum']), denominator)
+        elif match['num'] is not None:
+            denominator = Fraction(match['den'])
+            if not denominator:
+                return None
+            value = Fraction(match['num']) / denominator
+        else:
+            value = Fraction(match['dec'])
+            if match['pct']:
+                value /= 100
+    except (ValueError, ZeroDivisionError):
+        return None
+    return -value if match['sign'] in ('-', '−') else value
+
+
+@lru_cache(maxsize=4096)
+def _keys(text):
+    """Canonical keys of one spelling of an answer"""
+    if text.isascii():
+        # Nothing to fold; same result as normalize_text, several times faster
+        text = ' '.join(text.split()).lower()
+    else:
+        text = normalize_text(text)
+    text = _THOUSANDS.sub(lambda match: match[0].replace(',', ''), text)
+    text = _ASSIGNMENT.sub('', _DECIMAL_COMMA.sub('.', text)).strip()
+    if not text:
+        return frozenset()
+
+    value = _number(text)
+    if value is None:
+        return frozenset(('t:' + _SPACES.sub(' ', text),))
+    return frozenset((f'n:{value}',))
+
+
+def compile_answers(*answers):
+    """Frozen set of keys accepted for a question, from its stored answers"""
+    keys = set()
+    for answer in answers:
+        if not answer:
+            continue
+        for alternative in _ALTERNATIVES.split(answer):
+            keys |= _keys(alternative)
+    return frozenset(keys)
+
+
+def submission_keys(submission):
+    if not isinstance(submission, str):
+        submission = '' if submission is None else str(submission)
+    if len(submission) > MAX_ANSWER_LENGTH:
+        return frozenset()
+    return _keys(submission)
+
+
+def is_correct(compiled, submission):
+    """Whether submission matches one of the compiled answers; blank never does"""
+    return not compiled.isdisjoint(submission_keys(submission))
@@ -1,133 +1,99 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
-import sqlite3
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
+import base64
+import json
 import os
 import re
+import sys
 from datetime import datetime, timedelta
 import secrets
 import requests
 from functools import wraps
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import db
+import leaderboard
+import message_log
+import metrics
+import ratelimit
+import reference_data
+import migrations
+import search
+import stats
+from events import hub
+from games import GameError, player_history, store as game_store
+from hashing import HashUnavailable, service as hasher
+from jeopardy import bank as question_bank
+from presence import tracker as presence
+from reference_data import USER_CATEGORIES, WILAYAS_MOUGHATAAS
+from response_cache import responses
+from db import get_db_connection, write_transaction
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 
-def get_db_connection():
-    conn = sqlite3.connect('tedris.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Reverse proxies in front of the app whose X-Forwarded-For/-Proto to trust;
+# without this, client IPs (rate limits) are the proxy's
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+db.init_app(app)
+metrics.init_app(app)
+
+# Any chat event for a user may change their conversation list; this is
+# how writes made in other workers reach this one's cache
+hub.listen(lambda user_id, event_type, data: responses.bump(('conversations', user_id)))
 
 def init_db():
+    """Prepare the database; safe to run from several processes at once"""
+    with db.init_lock():
+        conn = get_db_connection()
+        
+        # Storage configuration (WAL journal, see db.py for the tuning knobs)
+        db.configure_storage(conn)
+        
+        # Create or upgrade the schema (see migrations.py); a no-op once up to date
+        if migrations.pending(conn):
+            migrations.migrate(conn)
+        
+        conn.close()
+        
+        # Apply messages accepted but not stored before the last shutdown
+        if message_log.MESSAGE_WRITE_BEHIND:
+            replayed = message_log.log.replay()
+            if replayed:
+                app.logger.info('Replayed %d messages from the message log', replayed)
+
+def warm_caches():
+    """Load the per-process caches so the first requests don't pay for it
+
+    Run before forking (gunicorn preload_app), the workers start with them
+    loaded and share the pages until they change.
+    """
     conn = get_db_connection()
-    
-    # Create users table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            full_name TEXT NOT NULL,
-            nni TEXT UNIQUE NOT NULL,
-            phone TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            user_category TEXT NOT NULL,
-            wilaya TEXT NOT NULL,
-            moughataa TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_login TIMESTAMP,
-            is_online BOOLEAN DEFAULT FALSE,
-            last_seen TIMESTAMP
-        )
-    ''')
-    
-    # Create conversations table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user1_id INTEGER NOT NULL,
-            user2_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user1_id) REFERENCES users (id),
-            FOREIGN KEY (user2_id) REFERENCES users (id),
-            UNIQUE(user1_id, user2_id)
-        )
-    ''')
-    
-    # Create messages table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id INTEGER NOT NULL,
-            sender_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_read BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
-            FOREIGN KEY (sender_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create game_questions table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS game_questions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            category TEXT NOT NULL,
-            question_ar TEXT NOT NULL,
-            question_fr TEXT NOT NULL,
-            answer_ar TEXT NOT NULL,
-            answer_fr TEXT NOT NULL,
-            explanation_ar TEXT,
-            explanation_fr TEXT,
-            difficulty INTEGER DEFAULT 1,
-            points INTEGER DEFAULT 100,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create game_sessions table
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS game_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            game_type TEXT NOT NULL,
-            language_mode TEXT NOT NULL,
-            score INTEGER DEFAULT 0,
-            questions_answered INTEGER DEFAULT 0,
-            correct_answers INTEGER DEFAULT 0,
-            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_at TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
+    reference_data.bundle.get(conn)
+    question_bank.refresh(conn)
+    leaderboard.boards.board(conn, leaderboard.board_key('global'))
+    stats.dashboard(conn)
     conn.close()
+    # Workers open their own connections; don't carry the master's across fork
+    db.pool.close_all()
+
 
-# Mauritanian Wilayas and Moughataas
-WILAYAS_MOUGHATAAS = {
-    'نواكشوط الشمالية': ['تفرغ زينة', 'دار النعيم', 'توجونين'],
-    'نواكشوط الغربية': ['كرفور', 'تيارت', 'الميناء'],
-    'نواكشوط الجنوبية': ['الرياض', 'عرفات', 'الخير'],
-    'الحوض الشرقي': ['النعمة', 'الباسكنو', 'فصاله', 'أمجريه الجديدة'],
-    'الحوض الغربي': ['العيون', 'تمبدغه', 'كوبني', 'بوتلميت'],
-    'العصابة': ['كيفه', 'العصابة', 'بركيول', 'قورو'],
-    'كوركول': ['سيلبابي', 'مبوت', 'يارل', 'فولو فولبه'],
-    'البراكنة': ['ألاك', 'بوكي', 'مال', 'مقطع لحجار', 'أفديرك'],
-    'الترارزة': ['روصو', 'المذرذرة', 'بوتيليميت', 'كور ماصين'],
-    'آدرار': ['أطار', 'شنقيط', 'وادان', 'أوجفت'],
-    'داخلت نواديبو': ['نواديبو'],
-    'تكانت': ['تيجكجه', 'تامشكط', 'بومديد', 'كنكوصه'],
-    'كيدي ماغا': ['كيدي ماغا', 'جعوار', 'كوبني', 'نيملان'],
-    'إنشيري': ['أكجوجت', 'بنشاب', 'زويرات'],
-    'تيرس زمور': ['بير أم كرين', 'الكليبه', 'زويرات']
-}
-
-USER_CATEGORIES = [
-    'طالب',
-    'معلم',
-    'أستاذ',
-    'مدير مدرسة',
-    'مفتش تربوي',
-    'إداري',
-    'ولي أمر'
-]
+# Columns /api/admin/users may return (never password_hash)
+ADMIN_USER_FIELDS = (
+    'id', 'full_name', 'nni', 'phone', 'user_category', 'wilaya', 'moughataa',
+    'school', 'created_at', 'last_login', 'last_seen', 'is_online', 'is_verified'
+)
+ADMIN_USER_DEFAULT_FIELDS = (
+    'id', 'full_name', 'phone', 'user_category', 'wilaya', 'moughataa', 'created_at'
+)
+ADMIN_USERS_PAGE_SIZE = 50
+ADMIN_USERS_MAX_PAGE_SIZE = 500
+
+# Chat history page sizes for /api/conversations/<id>/messages
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
 
 def validate_phone(phone):
     """Validate Mauritanian phone number (20000000-49999999)"""
@@ -145,15 +111,37 @@ def validate_nni(nni):
     """Validate NNI (numeric only)"""
     return nni and re.match(r'^\d+$', nni)
 
-def update_user_online_status(user_id, is_online=True):
-    """Update user's online status"""
+def is_admin(user_id):
+    """Whether the user is an administrator; read each time so revoking takes effect at once"""
     conn = get_db_connection()
-    conn.execute(
-        'UPDATE users SET is_online = ?, last_seen = CURRENT_TIMESTAMP WHERE id = ?',
-        (is_online, user_id)
-    )
-    conn.commit()
-    conn.close()
+    user = conn.execute('SELECT is_admin FROM users WHERE id = ?', (user_id,)).fetchone()
+    return bool(user and user['is_admin'])
+
+def update_user_online_status(user_id, is_online=True):
+    """Update user's online status (kept in memory, flushed in batches by presence.py)"""
+    if is_online:
+        presence.touch(user_id)
+    else:
+        presence.mark_offline(user_id)
+
+def too_many_attempts(template, retry_after):
+    """Re-render a form after a rate limiter refused the request"""
+    minutes = max(1, int(retry_after // 60) + 1)
+    flash(f'محاولات كثيرة جداً، يرجى المحاولة بعد {minutes} دقيقة', 'error')
+    return render_template(template), 429
+
+def server_busy(template):
+    """Re-render a form when password hashing is saturated"""
+    flash('الخادم مشغول حالياً، يرجى المحاولة مرة أخرى بعد قليل', 'error')
+    return render_template(template), 503
+
+@app.context_processor
+def reference_data_context():
+    # Versioned URL of the reference bundle, so browsers can cache it for good
+    def reference_data_url():
+        payload = reference_data.bundle.get(get_db_connection())
+        return url_for('get_reference_data', v=payload.etag)
+    return {'reference_data_url': reference_data_url}
 
 @app.route('/')
 def index():
@@ -205,6 +193,10 @@ def register():
             flash('المقاطعة غير صحيحة', 'error')
             return render_template('register.html')
         
+        retry_after = ratelimit.register_by_ip.hit(request.remote_addr)
+        if retry_after:
+            return too_many_attempts('register.html', retry_after)
+        
         # Check if user already exists
         conn = get_db_connection()
         existing_user = conn.execute(
@@ -214,18 +206,22 @@ def register():
         
         if existing_user:
             flash('المستخدم موجود بالفعل (رقم البطاقة أو الهاتف مستخدم)', 'error')
-            conn.close()
             return render_template('register.html')
         
         # Create user directly without verification
-        password_hash = generate_password_hash(password)
-        conn.execute('''
-            INSERT INTO users (full_name, nni, phone, password_hash, user_category, wilaya, moughataa)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (full_name, nni, phone, password_hash, user_category, wilaya, moughataa))
-        
-        conn.commit()
-        conn.close()
+        try:
+            password_hash = hasher.hash(password)
+        except HashUnavailable:
+            return server_busy('register.html')
+        with write_transaction(conn):
+            cursor = conn.execute('''
+                INSERT INTO users (full_name, nni, phone, password_hash, user_category, wilaya, moughataa)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (full_name, nni, phone, password_hash, user_category, wilaya, moughataa))
+            search.index_user(conn, cursor.lastrowid, full_name, phone)
+            stats.record_registration(conn, user_category, wilaya, moughataa)
+        stats.cache.invalidate()
+        responses.bump('users')
         
         flash('تم إنشاء الحساب بنجاح! يمكنك الآن تسجيل الدخول', 'success')
         return redirect(url_for('login'))
@@ -251,20 +247,26 @@ def forgot_password():
             flash('كلمات المرور غير متطابقة', 'error')
             return render_template('forgot_password.html')
         
+        retry_after = (ratelimit.password_reset_by_ip.hit(request.remote_addr)
+                       or ratelimit.password_reset_by_phone.hit(phone))
+        if retry_after:
+            return too_many_attempts('forgot_password.html', retry_after)
+        
         # Check if user exists
         conn = get_db_connection()
         user = conn.execute('SELECT id FROM users WHERE phone = ?', (phone,)).fetchone()
         
         if not user:
             flash('لا يوجد حساب مرتبط بهذا الرقم', 'error')
-            conn.close()
             return render_template('forgot_password.html')
         
         # Update password directly
-        password_hash = generate_password_hash(new_password)
-        conn.execute('UPDATE users SET password_hash = ? WHERE phone = ?', (password_hash, phone))
-        conn.commit()
-        conn.close()
+        try:
+            password_hash = hasher.hash(new_password)
+        except HashUnavailable:
+            return server_busy('forgot_password.html')
+        with write_transaction(conn):
+            conn.execute('UPDATE users SET password_hash = ? WHERE phone = ?', (password_hash, phone))
         
         flash('تم تغيير كلمة المرور بنجاح!', 'success')
         return redirect(url_for('login'))
@@ -292,17 +294,36 @@ def login():
             flash('كلمة المرور مطلوبة', 'error')
             return render_template('login.html')
         
+        # Refuse bursts before they reach the (expensive) password check
+        retry_after = (ratelimit.login_failures_by_ip.check(request.remote_addr)
+                       or ratelimit.login_by_phone.hit(phone))
+        if retry_after:
+            return too_many_attempts('login.html', retry_after)
+        
         conn = get_db_connection()
         user = conn.execute(
             'SELECT * FROM users WHERE phone = ?',
             (phone,)
         ).fetchone()
-        conn.close()
         
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            valid = user is not None and hasher.verify(user['password_hash'], password)
+            # Hash parameters changed since this one was made: upgrade it now
+            new_hash = hasher.hash(password) if valid and hasher.needs_rehash(user['password_hash']) else None
+        except HashUnavailable:
+            return server_busy('login.html')
+        
+        if valid:
+            ratelimit.login_by_phone.reset(phone)
+            if new_hash:
+                with write_transaction(conn):
+                    conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (new_hash, user['id']))
+            
             session['user_id'] = user['id']
             session['user_name'] = user['full_name']
             session['user_category'] = user['user_category']
+            # Only shows or hides the admin link; the admin routes check the database
+            session['is_admin'] = bool(user['is_admin'])
             
             # Update online status
             update_user_online_status(user['id'], True)
@@ -310,6 +331,7 @@ def login():
             flash(f'مرحباً {user["full_name"]}', 'success')
             return redirect(url_for('dashboard'))
         else:
+            ratelimit.login_failures_by_ip.record(request.remote_addr)
             flash('رقم الهاتف أو كلمة المرور غير صحيحة', 'error')
     
     return render_template('login.html')
@@ -339,40 +361,104 @@ def admin():
         flash('يجب تسجيل الدخول أولاً', 'error')
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    
-    # Get statistics
-    total_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    if not is_admin(session['user_id']):
+        flash('هذه الصفحة مخصصة للمشرفين', 'error')
+        return redirect(url_for('dashboard'))
     
-    # Users by category
-    categories = conn.execute('''
-        SELECT user_category, COUNT(*) as count 
-        FROM users 
-        GROUP BY user_category
-    ''').fetchall()
+    conn = get_db_connection()
     
-    # Recent registrations (last 7 days)
-    recent_count = conn.execute('''
-        SELECT COUNT(*) FROM users 
-        WHERE created_at >= datetime('now', '-7 days')
-    ''').fetchone()[0]
+    # Get statistics (rolled-up counters, cached; see stats.py)
+    dashboard_stats = stats.dashboard(conn)
     
-    # All users
+    # Latest users (first page of /api/admin/users)
     users = conn.execute('''
-        SELECT * FROM users 
-        ORDER BY created_at DESC 
+        SELECT id, full_name, phone, user_category, wilaya, created_at 
+        FROM users 
+        ORDER BY created_at DESC, id DESC 
         LIMIT 50
     ''').fetchall()
     
-    conn.close()
+    return render_template('admin.html', stats=dashboard_stats, users=users)
+
+@app.route('/api/admin/users')
+def admin_users():
+    """Paginated, filterable user listing for administrators"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not is_admin(session['user_id']):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    # Column projection; password_hash is never selectable
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else list(ADMIN_USER_DEFAULT_FIELDS)
+    unknown = [field for field in fields if field not in ADMIN_USER_FIELDS]
+    if unknown:
+        return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+    # The cursor needs these two whatever the client asked for
+    columns = list(dict.fromkeys(['id', 'created_at'] + fields))
+    
+    limit = request.args.get('limit', ADMIN_USERS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, ADMIN_USERS_MAX_PAGE_SIZE))
+    
+    conditions = []
+    params = []
+    for arg, column in (('category', 'user_category'), ('wilaya', 'wilaya'), ('moughataa', 'moughataa')):
+        value = request.args.get(arg, '').strip()
+        if value:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    online = request.args.get('online')
+    if online is not None:
+        conditions.append('is_online = ?')
+        params.append(online.lower() in ('1', 'true', 'yes'))
+    
+    # Keyset pagination on (created_at, id), newest first
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            created_at, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        # Only a (timestamp, id) pair as issued below can be bound
+        if (not isinstance(created_at, str) or not isinstance(last_id, int)
+                or isinstance(last_id, bool) or not -2 ** 63 <= last_id < 2 ** 63):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        conditions.append('(created_at, id) < (?, ?)')
+        params.extend([created_at, last_id])
+    
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    conn = get_db_connection()
+    rows = conn.execute(f'''
+        SELECT {", ".join(columns)}
+        FROM users 
+        {where}
+        ORDER BY created_at DESC, id DESC 
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = base64.urlsafe_b64encode(
+            json.dumps([last['created_at'], last['id']]).encode()
+        ).decode()
     
-    stats = {
-        'total_users': total_users,
-        'recent_registrations': recent_count,
-        'categories': {cat['user_category']: cat['count'] for cat in categories}
-    }
+    return jsonify({
+        'users': [{field: row[field] for field in fields} for row in rows],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/admin/stats')
+def admin_stats():
+    """Admin dashboard statistics as JSON"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not is_admin(session['user_id']):
+        return jsonify({'error': 'Forbidden'}), 403
     
-    return render_template('admin.html', stats=stats, users=users)
+    conn = get_db_connection()
+    return jsonify(stats.dashboard(conn))
 
 @app.route('/logout')
 def logout():
@@ -411,20 +497,17 @@ def search_users():
     query = request.args.get('q', '').strip()
     current_user_id = session['user_id']
     
+    key = ('users/search', current_user_id, query)
+    version = responses.version('users')
+    payload = responses.get(key, version)
+    if payload is not None:
+        return private_payload_response(payload)
+    
     conn = get_db_connection()
     
     if query:
-        users = conn.execute('''
-            SELECT id, full_name, user_category, school, is_online, last_seen
-            FROM users 
-            WHERE id != ? AND is_verified = TRUE AND (
-                full_name LIKE ? OR 
-                phone LIKE ? OR 
-                school LIKE ?
-            )
-            ORDER BY is_online DESC, full_name ASC
-            LIMIT 20
-        ''', (current_user_id, f'%{query}%', f'%{query}%', f'%{query}%')).fetchall()
+        # Ranked prefix search over the full-text index (see search.py)
+        users = search.search_users(conn, query, current_user_id)
     else:
         users = conn.execute('''
             SELECT id, full_name, user_category, school, is_online, last_seen
@@ -434,16 +517,19 @@ def search_users():
             LIMIT 20
         ''', (current_user_id,)).fetchall()
     
-    conn.close()
-    
-    return jsonify([{
-        'id': user['id'],
-        'name': user['full_name'],
-        'category': user['user_category'],
-        'school': user['school'],
-        'is_online': bool(user['is_online']),
-        'last_seen': user['last_seen']
-    } for user in users])
+    results = []
+    for user in users:
+        is_online, last_seen = presence.status(user['id'], user['last_seen'], user['is_online'])
+        results.append({
+            'id': user['id'],
+            'name': user['full_name'],
+            'category': user['user_category'],
+            'school': user['school'],
+            'is_online': is_online,
+            'last_seen': last_seen
+        })
+    
+    return private_payload_response(responses.put(key, version, results))
 
 @app.route('/api/conversations')
 def get_conversations():
@@ -452,6 +538,16 @@ def get_conversations():
         return jsonify({'error': 'Unauthorized'}), 401
     
     user_id = session['user_id']
+    
+    # Served from the cache until a message to or from the user bumps it;
+    # starting the event hub keeps this worker hearing about other workers' writes
+    hub.start()
+    resource = ('conversations', user_id)
+    version = responses.version(resource)
+    payload = responses.get(resource, version)
+    if payload is not None:
+        return private_payload_response(payload)
+    
     conn = get_db_connection()
     
     conversations = conn.execute('''
@@ -462,16 +558,19 @@ def get_conversations():
             u.full_name as other_user_name,
             u.user_category as other_user_category,
             u.is_online as other_user_online,
+            u.last_seen as other_user_last_seen,
             m.content as last_message,
             m.sender_id as last_sender_id,
             m.created_at as last_message_time,
-            (SELECT COUNT(*) FROM messages 
-             WHERE conversation_id = c.id AND sender_id != ? AND is_read = FALSE) as unread_count
+            CASE 
+                WHEN c.participant1_id = ? THEN c.participant1_unread
+                ELSE c.participant2_unread
+            END as unread_count
         FROM conversations c
-        JOIN users u ON (
+        JOIN users u ON u.id = (
             CASE 
-                WHEN c.participant1_id = ? THEN u.id = c.participant2_id
-                ELSE u.id = c.participant1_id
+                WHEN c.participant1_id = ? THEN c.participant2_id
+                ELSE c.participant1_id
             END
         )
         LEFT JOIN messages m ON m.id = c.last_message_id
@@ -479,15 +578,15 @@ def get_conversations():
         ORDER BY c.updated_at DESC
     ''', (user_id, user_id, user_id, user_id)).fetchall()
     
-    conn.close()
-    
-    return jsonify([{
+    payload = responses.put(resource, version, [{
         'id': conv['id'],
         'other_user': {
             'id': conv['other_user_id'],
             'name': conv['other_user_name'],
             'category': conv['other_user_category'],
-            'is_online': bool(conv['other_user_online'])
+            'is_online': presence.is_online(
+                conv['other_user_id'], conv['other_user_last_seen'], conv['other_user_online']
+            )
         },
         'last_message': {
             'content': conv['last_message'] or '',
@@ -497,6 +596,7 @@ def get_conversations():
         'unread_count': conv['unread_count'],
         'updated_at': conv['updated_at']
     } for conv in conversations])
+    return private_payload_response(payload)
 
 @app.route('/api/conversations/<int:conversation_id>/messages')
 def get_messages(conversation_id):
@@ -514,43 +614,95 @@ def get_messages(conversation_id):
     ''', (conversation_id, user_id, user_id)).fetchone()
     
     if not conversation:
-        conn.close()
         return jsonify({'error': 'Conversation not found'}), 404
     
-    # Get messages
-    messages = conn.execute('''
-        SELECT 
-            m.id,
-            m.content,
-            m.sender_id,
-            m.is_read,
-            m.created_at,
-            u.full_name as sender_name
-        FROM messages m
-        JOIN users u ON u.id = m.sender_id
-        WHERE m.conversation_id = ?
-        ORDER BY m.created_at ASC
-    ''', (conversation_id,)).fetchall()
-    
-    # Mark messages as read
-    conn.execute('''
-        UPDATE messages 
-        SET is_read = TRUE 
-        WHERE conversation_id = ? AND sender_id != ? AND is_read = FALSE
-    ''', (conversation_id, user_id))
-    
-    conn.commit()
-    conn.close()
+    # Page through history by message id (keyset pagination):
+    #   ?before_id=N  older messages, for scrolling back
+    #   ?after_id=N   only messages newer than N, for polling
+    #   neither       the most recent page
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', MESSAGES_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MESSAGES_MAX_PAGE_SIZE))
+    
+    if before_id is not None and after_id is not None:
+        return jsonify({'error': 'Use either before_id or after_id, not both'}), 400
+    
+    if after_id is not None:
+        messages = conn.execute('''
+            SELECT 
+                m.id,
+                m.content,
+                m.sender_id,
+                m.is_read,
+                m.created_at,
+                u.full_name as sender_name
+            FROM messages m
+            JOIN users u ON u.id = m.sender_id
+            WHERE m.conversation_id = ? AND m.id > ?
+            ORDER BY m.id ASC
+            LIMIT ?
+        ''', (conversation_id, after_id, limit + 1)).fetchall()
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        messages = conn.execute('''
+            SELECT 
+                m.id,
+                m.content,
+                m.sender_id,
+                m.is_read,
+                m.created_at,
+                u.full_name as sender_name
+            FROM messages m
+            JOIN users u ON u.id = m.sender_id
+            WHERE m.conversation_id = ? AND m.id < ?
+            ORDER BY m.id DESC
+            LIMIT ?
+        ''', (conversation_id, before_id if before_id is not None else sys.maxsize, limit + 1)).fetchall()
+        has_more = len(messages) > limit
+        messages = list(reversed(messages[:limit]))
+    
+    # Mark messages as read, taking the write lock only when the counter says
+    # there is something to mark
+    if conversation['participant1_id'] == user_id:
+        unread_column, other_user_id = 'participant1_unread', conversation['participant2_id']
+    else:
+        unread_column, other_user_id = 'participant2_unread', conversation['participant1_id']
+    
+    if conversation[unread_column]:
+        with write_transaction(conn):
+            conn.execute('''
+                UPDATE messages 
+                SET is_read = TRUE 
+                WHERE conversation_id = ? AND sender_id != ? AND is_read = FALSE
+            ''', (conversation_id, user_id))
+            conn.execute(f'UPDATE conversations SET {unread_column} = 0 WHERE id = ?',
+                         (conversation_id,))
+        responses.bump(('conversations', user_id))
+        
+        # Read receipt for the sender, and a cleared badge for the reader's other tabs
+        hub.publish([other_user_id], 'read', {
+            'conversation_id': conversation_id,
+            'reader_id': user_id
+        })
+        hub.publish([user_id], 'unread', {
+            'conversation_id': conversation_id,
+            'unread_count': 0
+        })
     
-    return jsonify([{
-        'id': msg['id'],
-        'content': msg['content'],
-        'sender_id': msg['sender_id'],
-        'sender_name': msg['sender_name'],
-        'is_read': bool(msg['is_read']),
-        'created_at': msg['created_at'],
-        'is_mine': msg['sender_id'] == user_id
-    } for msg in messages])
+    return jsonify({
+        'messages': [{
+            'id': msg['id'],
+            'content': msg['content'],
+            'sender_id': msg['sender_id'],
+            'sender_name': msg['sender_name'],
+            'is_read': bool(msg['is_read']),
+            'created_at': msg['created_at'],
+            'is_mine': msg['sender_id'] == user_id
+        } for msg in messages],
+        'has_more': has_more
+    })
 
 @app.route('/api/send-message', methods=['POST'])
 def send_message():
@@ -559,87 +711,167 @@ def send_message():
         return jsonify({'error': 'Unauthorized'}), 401
     
     data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Invalid request'}), 400
     user_id = session['user_id']
     recipient_id = data.get('recipient_id')
-    content = data.get('content', '').strip()
+    content = data.get('content')
+    
+    # Only text is a message (a number or null has no strip())
+    if content is not None and not isinstance(content, str):
+        return jsonify({'error': 'Invalid content'}), 400
+    content = (content or '').strip()
     
     if not recipient_id or not content:
         return jsonify({'error': 'Missing required fields'}), 400
     
+    # A user id SQLite can hold (bool is an int too), of someone else who exists
+    if (not isinstance(recipient_id, int) or isinstance(recipient_id, bool)
+            or not 0 < recipient_id < 2 ** 63 or recipient_id == user_id):
+        return jsonify({'error': 'Invalid recipient'}), 400
     conn = get_db_connection()
+    if not conn.execute('SELECT 1 FROM users WHERE id = ?', (recipient_id,)).fetchone():
+        return jsonify({'error': 'Recipient not found'}), 404
     
-    # Find or create conversation
+    if message_log.MESSAGE_WRITE_BEHIND:
+        return send_message_write_behind(user_id, recipient_id, content)
+    
+    # Timestamp set here so the message can be pushed without a read-back
+    created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    with write_transaction(conn):
+        conversation_id, message_id, unread_count = message_log.store_message(
+            conn, user_id, recipient_id, content, created_at)
+    
+    message_log.publish_message(conversation_id, message_id, unread_count, user_id, recipient_id,
+                                session.get('user_name'), content, created_at)
+    
+    return jsonify({
+        'success': True,
+        'message_id': message_id,
+        'conversation_id': conversation_id
+    })
+
+def send_message_write_behind(user_id, recipient_id, content):
+    """Accept a message into the write-behind log (MESSAGE_WRITE_BEHIND=1)
+
+    Answers 202 with the client id the message's 'message' event will
+    carry once it is stored; its message id comes with that event.
+    """
+    try:
+        accepted = message_log.log.append(user_id, recipient_id, content, session.get('user_name'))
+    except OSError:
+        app.logger.exception('Could not append to the message log')
+        # No synchronous fallback: it would overtake messages still in the log
+        return jsonify({'error': 'Messages are unavailable, try again'}), 503
+    
+    conn = get_db_connection()
     conversation = conn.execute('''
         SELECT id FROM conversations 
         WHERE (participant1_id = ? AND participant2_id = ?) 
            OR (participant1_id = ? AND participant2_id = ?)
     ''', (user_id, recipient_id, recipient_id, user_id)).fetchone()
     
-    if not conversation:
-        # Create new conversation
-        cursor = conn.execute('''
-            INSERT INTO conversations (participant1_id, participant2_id)
-            VALUES (?, ?)
-        ''', (min(user_id, recipient_id), max(user_id, recipient_id)))
-        conversation_id = cursor.lastrowid
-    else:
-        conversation_id = conversation['id']
-    
-    # Insert message
-    cursor = conn.execute('''
-        INSERT INTO messages (conversation_id, sender_id, content)
-        VALUES (?, ?, ?)
-    ''', (conversation_id, user_id, content))
-    message_id = cursor.lastrowid
-    
-    # Update conversation's last message
-    conn.execute('''
-        UPDATE conversations 
-        SET last_message_id = ?, updated_at = CURRENT_TIMESTAMP
-        WHERE id = ?
-    ''', (message_id, conversation_id))
-    
-    conn.commit()
-    conn.close()
-    
     return jsonify({
         'success': True,
-        'message_id': message_id,
-        'conversation_id': conversation_id
-    })
+        'pending': True,
+        'client_id': accepted.client_id,
+        'message_id': None,
+        'conversation_id': conversation['id'] if conversation else None,
+        'created_at': accepted.created_at
+    }), 202
+
+@app.route('/api/presence/heartbeat', methods=['POST'])
+def presence_heartbeat():
+    """Keep the logged-in user marked online"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    presence.touch(session['user_id'])
+    return '', 204
+
+@app.route('/api/events')
+def event_stream():
+    """Server-Sent Events stream of chat events for the logged-in user"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    # The stream outlives the request context, so nothing in it may use g or session
+    subscription = hub.subscribe(session['user_id'])
+    return Response(
+        hub.stream(subscription),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def cache_headers(response, etag, max_age, immutable=False):
+    """Set a strong ETag and public caching on a response"""
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = immutable
+    return response
+
+def payload_response(payload, max_age, immutable=False):
+    """JSON response for a precomputed payload, answering 304 when the ETag matches"""
+    response = Response(payload.body, mimetype='application/json')
+    return cache_headers(response, payload.etag, max_age, immutable).make_conditional(request)
+
+def private_payload_response(payload):
+    """JSON response for a per-user payload; clients revalidate it with its ETag every time"""
+    response = Response(payload.body, mimetype='application/json')
+    response.set_etag(payload.etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/api/moughataas/<wilaya>')
 def get_moughataas(wilaya):
-    """API endpoint to get moughataas for a wilaya"""
-    moughataas_data = {
-        'nouakchott_north': [
-            {'value': 'dar_naim', 'label_ar': 'دار النعيم', 'label_fr': 'Dar Naim'},
-            {'value': 'toujounine', 'label_ar': 'توجونين', 'label_fr': 'Toujounine'}
-        ],
-        'nouakchott_south': [
-            {'value': 'arafat', 'label_ar': 'عرفات', 'label_fr': 'Arafat'},
-            {'value': 'sebkha', 'label_ar': 'السبخة', 'label_fr': 'Sebkha'}
-        ],
-        'trarza': [
-            {'value': 'rosso', 'label_ar': 'روصو', 'label_fr': 'Rosso'},
-            {'value': 'mederdra', 'label_ar': 'مدردرة', 'label_fr': 'Mederdra'}
-        ],
-        'adrar': [
-            {'value': 'atar', 'label_ar': 'أطار', 'label_fr': 'Atar'},
-            {'value': 'chinguetti', 'label_ar': 'شنقيط', 'label_fr': 'Chinguetti'}
-        ]
-    }
-    
-    return jsonify(moughataas_data.get(wilaya, []))
+    """API endpoint to get moughataas for a wilaya (Arabic name, French name or code)"""
+    return payload_response(reference_data.moughataas(wilaya), reference_data.REFERENCE_MAX_AGE)
+
+@app.route('/api/reference-data')
+def get_reference_data():
+    """Wilayas with their moughataas, user categories and schools in one payload"""
+    payload = reference_data.bundle.get(get_db_connection())
+    # The register page links to ?v=<etag>; that URL's content never changes
+    if request.args.get('v') == payload.etag:
+        return payload_response(payload, reference_data.REFERENCE_IMMUTABLE_MAX_AGE, immutable=True)
+    return payload_response(payload, reference_data.REFERENCE_MAX_AGE)
 
 @app.route('/api/schools')
 def get_schools():
-    """API endpoint to get schools"""
-    conn = get_db_connection()
-    schools = conn.execute('SELECT name FROM schools WHERE is_active = 1 ORDER BY name').fetchall()
-    conn.close()
+    """Active schools, filtered by wilaya/moughataa and name prefix (q), paginated"""
+    query = request.args.get('q', '').strip()
+    wilaya = request.args.get('wilaya', '').strip()
+    moughataa = request.args.get('moughataa', '').strip()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', reference_data.SCHOOLS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, reference_data.SCHOOLS_MAX_PAGE_SIZE))
     
-    return jsonify([{'value': school['name'], 'label': school['name']} for school in schools])
+    conn = get_db_connection()
+    catalog = reference_data.catalog
+    catalog.refresh(conn)
+    
+    # The page is fully determined by the catalog version and the arguments,
+    # so a matching ETag is answered before searching
+    etag = reference_data.Payload([catalog.version, query, wilaya, moughataa, offset, limit]).etag
+    if request.if_none_match.contains(etag):
+        return cache_headers(Response(status=304), etag, reference_data.SCHOOLS_MAX_AGE)
+    
+    schools, total = catalog.search(conn, query, wilaya, moughataa, offset, limit)
+    payload = reference_data.Payload({
+        'schools': [{'value': school['name'], 'label': school['name'], 'id': school['id'],
+                     'wilaya': school['wilaya'], 'moughataa': school['moughataa']}
+                    for school in schools],
+        'total': total,
+        'offset': offset,
+        'has_more': offset + len(schools) < total
+    })
+    payload.etag = etag
+    return payload_response(payload, reference_data.SCHOOLS_MAX_AGE)
 
 @app.route('/api/games/math-jeopardy/start', methods=['POST'])
 def start_math_jeopardy():
@@ -653,41 +885,14 @@ def start_math_jeopardy():
     user_id = session['user_id']
     conn = get_db_connection()
     
-    # Create new game session
-    cursor = conn.execute('''
-        INSERT INTO game_sessions (user_id, game_type, language_mode)
-        VALUES (?, ?, ?)
-    ''', (user_id, 'math_jeopardy', language_mode))
-    
-    session_id = cursor.lastrowid
+    # Board sampled from the question bank to suit this player's recent accuracy
+    accuracy, recently_asked = player_history(conn, user_id)
+    board, question_ids = question_bank.sample_board(conn, language_mode, accuracy, recently_asked)
+    if not question_ids:
+        return jsonify({'error': 'No questions available'}), 503
     
-    # Get questions organized by category and points
-    questions = conn.execute('''
-        SELECT id, category, points, question_ar, question_fr, difficulty_level
-        FROM math_jeopardy_questions
-        ORDER BY category, points
-    ''').fetchall()
-    
-    conn.close()
-    
-    # Organize questions into board format
-    board = {}
-    for question in questions:
-        category = question['category']
-        if category not in board:
-            board[category] = {}
-        
-        # Choose question text based on language mode
-        if language_mode == 'french':
-            question_text = question['question_fr']
-        else:
-            question_text = question['question_ar']
-        
-        board[category][question['points']] = {
-            'id': question['id'],
-            'question': question_text,
-            'answered': False
-        }
+    # Create new game session; this worker holds it while it is played
+    session_id = game_store.start(conn, user_id, 'math_jeopardy', language_mode, question_ids)
     
     return jsonify({
         'session_id': session_id,
@@ -702,22 +907,28 @@ def get_jeopardy_question(question_id):
         return jsonify({'error': 'Unauthorized'}), 401
     
     conn = get_db_connection()
-    question = conn.execute('''
-        SELECT * FROM math_jeopardy_questions WHERE id = ?
-    ''', (question_id,)).fetchone()
-    conn.close()
+    question_bank.refresh(conn)
+    
+    # The same for every player, so cached once per question and bank version
+    key = ('question', question_id)
+    version = question_bank.version
+    payload = responses.get(key, version)
+    if payload is not None:
+        return private_payload_response(payload)
+    
+    question = question_bank.get(conn, question_id)
     
     if not question:
         return jsonify({'error': 'Question not found'}), 404
     
-    return jsonify({
+    return private_payload_response(responses.put(key, version, {
         'id': question['id'],
         'category': question['category'],
         'points': question['points'],
         'question_ar': question['question_ar'],
         'question_fr': question['question_fr'],
         'difficulty_level': question['difficulty_level']
-    })
+    }))
 
 @app.route('/api/games/math-jeopardy/answer', methods=['POST'])
 def submit_jeopardy_answer():
@@ -725,58 +936,32 @@ def submit_jeopardy_answer():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    data = request.get_json()
+    data = request.get_json() or {}
     question_id = data.get('question_id')
-    user_answer = data.get('answer', '').strip()
+    user_answer = data.get('answer') or ''
     session_id = data.get('session_id')
-    language_mode = data.get('language_mode', 'arabic')
     
     conn = get_db_connection()
     
     # Get question details
-    question = conn.execute('''
-        SELECT * FROM math_jeopardy_questions WHERE id = ?
-    ''', (question_id,)).fetchone()
+    question = question_bank.get(conn, question_id)
     
     if not question:
-        conn.close()
         return jsonify({'error': 'Question not found'}), 404
     
-    # Check answer (case-insensitive, flexible matching)
-    correct_answer_ar = question['answer_ar'].lower().strip()
-    correct_answer_fr = question['answer_fr'].lower().strip()
-    user_answer_lower = user_answer.lower().strip()
-    
-    is_correct = (user_answer_lower == correct_answer_ar or 
-                  user_answer_lower == correct_answer_fr or
-                  user_answer_lower in correct_answer_ar or
-                  user_answer_lower in correct_answer_fr)
-    
-    # Update game session
-    if is_correct:
-        conn.execute('''
-            UPDATE game_sessions 
-            SET score = score + ?, questions_answered = questions_answered + 1, 
-                correct_answers = correct_answers + 1
-            WHERE id = ?
-        ''', (question['points'], session_id))
-    else:
-        conn.execute('''
-            UPDATE game_sessions 
-            SET questions_answered = questions_answered + 1
-            WHERE id = ?
-        ''', (session_id,))
-    
-    conn.commit()
+    # Compare against the answers precompiled by the question bank
+    is_correct = question_bank.check_answer(conn, question['id'], user_answer)
     
-    # Get updated session info
-    session_info = conn.execute('''
-        SELECT score, questions_answered, correct_answers FROM game_sessions WHERE id = ?
-    ''', (session_id,)).fetchone()
-    
-    conn.close()
+    try:
+        # Scored in memory by the worker holding the session; written on completion or at the next checkpoint
+        language_mode, progress = game_store.answer(
+            conn, session_id, session['user_id'], question['id'], question['points'], is_correct,
+            len(question_bank.questions)
+        )
+    except GameError as e:
+        return jsonify({'error': e.message}), e.status
     
-    # Choose explanation based on language mode
+    # Choose explanation based on the language the game was started in
     if language_mode == 'french':
         explanation = question['explanation_fr']
         correct_answer = question['answer_fr']
@@ -789,11 +974,37 @@ def submit_jeopardy_answer():
         'correct_answer': correct_answer,
         'explanation': explanation,
         'points_earned': question['points'] if is_correct else 0,
-        'total_score': session_info['score'],
-        'questions_answered': session_info['questions_answered'],
-        'correct_answers': session_info['correct_answers']
+        **progress
     })
 
+@app.route('/api/games/leaderboard')
+def game_leaderboard():
+    """Ranked players for one board, with the caller's own rank"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    scope = request.args.get('scope', 'global')
+    if scope not in leaderboard.SCOPES:
+        return jsonify({'error': f'Unknown scope: {scope}'}), 400
+    
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', leaderboard.LEADERBOARD_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, leaderboard.LEADERBOARD_MAX_PAGE_SIZE))
+    
+    conn = get_db_connection()
+    value = request.args.get('value', '').strip()
+    if scope == 'week':
+        value = value or leaderboard.current_week()
+    elif scope in ('wilaya', 'category') and not value:
+        # Default to the caller's own wilaya / category
+        user = conn.execute(
+            'SELECT wilaya, user_category FROM users WHERE id = ?', (session['user_id'],)
+        ).fetchone()
+        value = user['wilaya'] if scope == 'wilaya' else user['user_category']
+    
+    board = leaderboard.board_key(scope, value)
+    return jsonify(leaderboard.leaderboard(conn, board, session['user_id'], offset, limit))
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Math Jeopardy answer matching benchmark
+Times answers.py against the old lowercase/substring comparison on a
+sample of stored answers and submissions. Whether it judges them right is
+tested in tests/test_answers.py.
+
+    python benchmarks/answer_matching.py --repeat 200000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import answers  # noqa: E402
+
+# (answer_ar, answer_fr, submission): a mix of numeric and text answers,
+# right and wrong; which ones should match is checked by tests/test_answers.py
+SAMPLES = [
+    ('4', '4', '4'),
+    ('4', '4', '٤'),
+    ('4', '4', '44'),
+    ('4', '4', ''),
+    ('0.5', '0,5', '1/2'),
+    ('0.5', '0,5', '٠٫٥'),
+    ('0.5', '0,5', '50%'),
+    ('1 1/2', '1 1/2', '3/2'),
+    ('-3', '-3', '−3'),
+    ('س = 5', 'x = 5', 'x=5'),
+    ('مثلث', 'triangle', 'Triangle'),
+    ('مثلث', 'triangle', 'tri'),
+    ('زاوية قائمة', 'angle droit', 'زاوِيَة قائِمَة'),
+    ('أربعة', 'quatre', 'اربعه'),
+    ('متساوي الأضلاع', 'équilatéral', 'Équilatéral'),
+    ('3.14', '3,14', '3,14'),
+    ('12 | اثنا عشر', '12 | douze', 'douze'),
+    ('25%', '25 %', '1/4'),
+    ('1000', '1000', '1,000'),
+    ('12345678', '12345678', '12,345,678'),
+]
+
+
+def legacy_is_correct(answer_ar, answer_fr, user_answer):
+    """The comparison submit_jeopardy_answer() used before answers.py"""
+    correct_answer_ar = answer_ar.lower().strip()
+    correct_answer_fr = answer_fr.lower().strip()
+    user_answer_lower = user_answer.lower().strip()
+    return (user_answer_lower == correct_answer_ar or
+            user_answer_lower == correct_answer_fr or
+            user_answer_lower in correct_answer_ar or
+            user_answer_lower in correct_answer_fr)
+
+
+def measure(func, cases, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat // len(cases) + 1):
+        for case in cases:
+            func(*case)
+    return (time.perf_counter() - started) * 1e6 / ((repeat // len(cases) + 1) * len(cases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=100_000)
+    args = parser.parse_args()
+
+    compiled = {(ar, fr): answers.compile_answers(ar, fr) for ar, fr, _ in SAMPLES}
+    precompiled = [(compiled[ar, fr], sub) for ar, fr, sub in SAMPLES]
+
+    started = time.perf_counter()
+    for ar, fr, _ in SAMPLES:
+        answers.compile_answers(ar, fr)
+    compile_us = (time.perf_counter() - started) * 1e6 / len(SAMPLES)
+
+    legacy_us = measure(legacy_is_correct, SAMPLES, args.repeat)
+
+    def cold_is_correct(compiled, submission):
+        answers._keys.cache_clear()
+        return answers.is_correct(compiled, submission)
+
+    matcher_us = measure(answers.is_correct, precompiled, args.repeat)
+    cold_us = measure(cold_is_correct, precompiled, args.repeat)
+    print(f'compile (once per question at load): {compile_us:8.2f} us')
+    print(f'legacy check per submission:         {legacy_us:8.2f} us')
+    print(f'compiled check, uncached submission: {cold_us:8.2f} us')
+    print(f'compiled check, cached submission:   {matcher_us:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+Tedris application load benchmark
+Replays a weighted mix of the real routes (conversations, message history,
+sending, user search, schools, leaderboards, Math Jeopardy rounds, admin
+listing) as a fixed set of logged-in users of a synthetic database (see
+dataset.py), and reports p50/p95/p99 latency and throughput per endpoint.
+
+Two modes:
+
+- client: in-process through the Flask test client, one request at a time.
+  No network or server in the way, so it isolates the cost of the route.
+- http: several load processes against gunicorn, started here with
+  gunicorn.conf.py and --workers/--threads unless --url points at a
+  running server. The server
+  must use the same SECRET_KEY as this script, since users are logged in
+  by signing their session cookies rather than by POST /login (which would
+  only measure password hashing, and is rate limited).
+
+Sending messages and playing games write to the database, so runs use a
+scratch copy of it unless --in-place is given; every run then starts from
+the same data. The same --seed replays the same users and request
+sequence. --write-behind sends messages through the write-behind log
+(MESSAGE_WRITE_BEHIND, see message_log.py). --save NAME
+stores the results under benchmarks/baselines/, --baseline NAME compares
+against a saved run.
+
+    python benchmarks/dataset.py /tmp/tedris-bench.db --users 20000 --messages 2000000
+    python benchmarks/app_load.py /tmp/tedris-bench.db --mode client --requests 20000 --save before
+    python benchmarks/app_load.py /tmp/tedris-bench.db --mode http --concurrency 8 --duration 30 --baseline before
+"""
+
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import secrets
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+
+# Requests per scenario, relative; a jeopardy round is several requests
+WEIGHTS = {
+    'conversations': 20,
+    'messages': 20,
+    'send_message': 10,
+    'user_search': 10,
+    'user_list': 3,
+    'schools': 5,
+    'reference_data': 2,
+    'leaderboard': 8,
+    'jeopardy_round': 8,
+    'admin_users': 2,
+}
+# Questions answered per jeopardy round
+JEOPARDY_ANSWERS = 3
+PERCENTILES = (50, 95, 99)
+
+
+class Workload:
+    """Users, their conversations and the question answers, read once from the database"""
+
+    def __init__(self, path, sessions, seed):
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        rng = random.Random(seed)
+        user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+        if not user_ids:
+            raise SystemExit(f'{path} has no users; generate it with benchmarks/dataset.py')
+        self.users = {}
+        for user_id in sorted(rng.sample(user_ids, min(sessions, len(user_ids)))):
+            name, category, wilaya = conn.execute(
+                'SELECT full_name, user_category, wilaya FROM users WHERE id = ?', (user_id,)
+            ).fetchone()
+            conversations = conn.execute('''
+                SELECT id, CASE WHEN participant1_id = ? THEN participant2_id ELSE participant1_id END
+                FROM conversations WHERE participant1_id = ? OR participant2_id = ?
+            ''', (user_id, user_id, user_id)).fetchall()
+            self.users[user_id] = {
+                'name': name, 'category': category, 'wilaya': wilaya,
+                'conversations': conversations,
+                'cookie': None
+            }
+        self.user_ids = list(self.users)
+        self.answers = dict(conn.execute('SELECT id, answer_ar FROM math_jeopardy_questions'))
+        self.regions = conn.execute('SELECT DISTINCT wilaya, moughataa FROM schools').fetchall()
+        self.name_prefixes = sorted({name.split()[0][:3] for name in
+                                     (user['name'] for user in self.users.values())})
+        self.counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                       for table in ('users', 'conversations', 'messages', 'game_sessions',
+                                     'math_jeopardy_questions')}
+        conn.close()
+
+    def sign_sessions(self, app):
+        """Session cookies for every user, signed like Flask signs them"""
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie_name = app.config['SESSION_COOKIE_NAME']
+        for user_id, user in self.users.items():
+            value = serializer.dumps({'user_id': user_id, 'user_name': user['name'],
+                                      'user_category': user['category']})
+            user['cookie'] = f'{cookie_name}={value}'
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, cookie, body=None):
+        response = self.client.open(path, method=method, headers={'Cookie': cookie}, json=body)
+        return response.status_code, response.get_data()
+
+
+class HttpTransport:
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def request(self, method, path, cookie, body=None):
+        headers = {'Cookie': cookie}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, body=data, headers=headers)
+            response = self.conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            # Dropped connection: count the error, reconnect on the next request
+            self.conn.close()
+            return 0, b''
+
+
+class Recorder:
+    """Latency samples and error counts per endpoint label"""
+
+    def __init__(self, transport, record=True):
+        self.transport = transport
+        self.record = record
+        self.samples = {}
+        self.errors = {}
+
+    def call(self, label, method, path, cookie, body=None):
+        started = time.perf_counter()
+        status, data = self.transport.request(method, path, cookie, body)
+        elapsed = time.perf_counter() - started
+        if self.record:
+            self.samples.setdefault(label, []).append(elapsed)
+            if not 200 <= status < 400:
+                self.errors[label] = self.errors.get(label, 0) + 1
+        if status == 200 and data[:1] in (b'{', b'['):
+            return json.loads(data)
+        return None
+
+
+def run_scenario(name, workload, rng, recorder):
+    user_id = rng.choice(workload.user_ids)
+    user = workload.users[user_id]
+    cookie = user['cookie']
+    call = recorder.call
+
+    if name == 'conversations':
+        call('GET /api/conversations', 'GET', '/api/conversations', cookie)
+    elif name == 'messages' and user['conversations']:
+        conversation_id, _ = rng.choice(user['conversations'])
+        call('GET /api/conversations/<id>/messages', 'GET',
+             f'/api/conversations/{conversation_id}/messages', cookie)
+    elif name == 'send_message' and user['conversations']:
+        _, recipient_id = rng.choice(user['conversations'])
+        call('POST /api/send-message', 'POST', '/api/send-message', cookie,
+             {'recipient_id': recipient_id, 'content': f'benchmark message {rng.random():.6f}'})
+    elif name == 'user_search':
+        query = urllib.parse.quote(rng.choice(workload.name_prefixes))
+        call('GET /api/users/search?q', 'GET', f'/api/users/search?q={query}', cookie)
+    elif name == 'user_list':
+        call('GET /api/users/search', 'GET', '/api/users/search', cookie)
+    elif name == 'schools' and workload.regions:
+        wilaya, moughataa = rng.choice(workload.regions)
+        query = urllib.parse.urlencode({'wilaya': wilaya, 'moughataa': moughataa})
+        call('GET /api/schools', 'GET', f'/api/schools?{query}', cookie)
+    elif name == 'reference_data':
+        call('GET /api/reference-data', 'GET', '/api/reference-data', cookie)
+    elif name == 'leaderboard':
+        scope = rng.choice(['global', 'wilaya', 'category', 'week'])
+        call('GET /api/games/leaderboard', 'GET', f'/api/games/leaderboard?scope={scope}', cookie)
+    elif name == 'jeopardy_round':
+        started = call('POST /api/games/math-jeopardy/start', 'POST', '/api/games/math-jeopardy/start',
+                       cookie, {'language_mode': rng.choice(['arabic', 'french', 'mixed'])})
+        if not started:
+            return
+        question_ids = [cell['id'] for cells in started['board'].values() for cell in cells.values()]
+        for question_id in rng.sample(question_ids, min(JEOPARDY_ANSWERS, len(question_ids))):
+            call('GET /api/games/math-jeopardy/question/<id>', 'GET',
+                 f'/api/games/math-jeopardy/question/{question_id}', cookie)
+            answer = workload.answers[question_id] if rng.random() < 0.6 else '0'
+            call('POST /api/games/math-jeopardy/answer', 'POST', '/api/games/math-jeopardy/answer',
+                 cookie, {'session_id': started['session_id'], 'question_id': question_id,
+                          'answer': answer})
+    elif name == 'admin_users':
+        call('GET /api/admin/users', 'GET', f'/api/admin/users?wilaya={urllib.parse.quote(user["wilaya"])}',
+             cookie)
+
+
+def _scenario_picker(rng):
+    names = list(WEIGHTS)
+    weights = list(WEIGHTS.values())
+    return lambda: rng.choices(names, weights=weights)[0]
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(samples, errors, elapsed):
+    results = {}
+    everything = []
+    for label, values in sorted(samples.items()):
+        everything.extend(values)
+        results[label] = _summary(values, errors.get(label, 0), elapsed)
+    if everything:
+        results['ALL'] = _summary(everything, sum(errors.values()), elapsed)
+    return results
+
+
+def _summary(values, errors, elapsed):
+    ordered = sorted(values)
+    summary = {'count': len(ordered), 'errors': errors,
+               'mean_ms': sum(ordered) / len(ordered) * 1000,
+               'rps': len(ordered) / elapsed if elapsed else 0.0}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = percentile(ordered, p) * 1000
+    return summary
+
+
+def run_client(args, workload):
+    import app as tedris
+
+    # Brings an older dataset's schema up to date, as the server does on start
+    tedris.init_db()
+    workload.sign_sessions(tedris.app)
+    rng = random.Random(args.seed)
+    pick = _scenario_picker(rng)
+    transport = TestClientTransport(tedris.app)
+
+    warmup = Recorder(transport, record=False)
+    for _ in range(args.warmup_requests):
+        run_scenario(pick(), workload, rng, warmup)
+
+    recorder = Recorder(transport)
+    started = time.perf_counter()
+    while sum(len(values) for values in recorder.samples.values()) < args.requests:
+        run_scenario(pick(), workload, rng, recorder)
+    elapsed = time.perf_counter() - started
+    return summarize(recorder.samples, recorder.errors, elapsed), elapsed
+
+
+def _load_process(url, workload, seed, warmup_until, stop_at, results):
+    rng = random.Random(seed)
+    pick = _scenario_picker(rng)
+    transport = HttpTransport(url)
+    recorder = Recorder(transport, record=False)
+    while time.time() < warmup_until:
+        run_scenario(pick(), workload, rng, recorder)
+    recorder.record = True
+    while time.time() < stop_at:
+        run_scenario(pick(), workload, rng, recorder)
+    results.put((recorder.samples, recorder.errors))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(url, timeout=60):
+    parsed = urllib.parse.urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=2)
+            conn.request('GET', '/login')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'server at {url} did not come up in {timeout}s')
+
+
+def start_gunicorn(args):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_PATH=os.path.abspath(args.database))
+    # The production configuration, with the bind and pool sizes overridden
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(args.workers), '--threads', str(args.threads),
+               '--log-level', 'warning']
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        _wait_until_up(url)
+    except SystemExit:
+        server.terminate()
+        raise
+    return server, url
+
+
+def run_http(args, workload):
+    import app as tedris
+
+    workload.sign_sessions(tedris.app)
+    server = None
+    url = args.url
+    if not url:
+        server, url = start_gunicorn(args)
+    try:
+        results = multiprocessing.Queue()
+        warmup_until = time.time() + args.warmup
+        stop_at = warmup_until + args.duration
+        processes = [multiprocessing.Process(
+            target=_load_process,
+            args=(url, workload, args.seed + index, warmup_until, stop_at, results)
+        ) for index in range(args.concurrency)]
+        for process in processes:
+            process.start()
+        samples = {}
+        errors = {}
+        for _ in processes:
+            process_samples, process_errors = results.get()
+            for label, values in process_samples.items():
+                samples.setdefault(label, []).extend(values)
+            for label, count in process_errors.items():
+                errors[label] = errors.get(label, 0) + count
+        for process in processes:
+            process.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    return summarize(samples, errors, args.duration), args.duration
+
+
+def scratch_copy(path):
+    """Copy of the database in a temporary directory, via SQLite's backup API"""
+    copy = os.path.join(tempfile.mkdtemp(prefix='tedris-load-'), os.path.basename(path))
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    target = sqlite3.connect(copy)
+    source.backup(target)
+    target.close()
+    source.close()
+    return copy
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    header = f'{"endpoint":42s} {"count":>7s} {"err":>5s} {"req/s":>9s}'
+    header += ''.join(f' {f"p{p} ms":>9s}' for p in PERCENTILES)
+    print(header)
+    for label, summary in results.items():
+        line = f'{label:42s} {summary["count"]:7d} {summary["errors"]:5d} {summary["rps"]:9.1f}'
+        line += ''.join(f' {summary[f"p{p}_ms"]:9.2f}' for p in PERCENTILES)
+        print(line)
+        before = (baseline or {}).get(label)
+        if before:
+            # Negative is faster for latency, positive is better for throughput
+            deltas = [_delta(summary['rps'], before['rps'])] + [
+                _delta(summary[f'p{p}_ms'], before[f'p{p}_ms']) for p in PERCENTILES]
+            print(f'{"  vs baseline":42s} {"":7s} {"":5s} ' + ' '.join(f'{d:>9s}' for d in deltas))
+
+
+def _delta(now, before):
+    return f'{(now - before) / before * 100:+.1f}%' if before else 'n/a'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('database', help='database made by benchmarks/dataset.py')
+    parser.add_argument('--mode', choices=('client', 'http'), default='client')
+    parser.add_argument('--sessions', type=int, default=1000, help='distinct logged-in users')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=10000, help='client mode: requests measured')
+    parser.add_argument('--warmup-requests', type=int, default=500)
+    parser.add_argument('--url', help='http mode: benchmark a running server instead of starting gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='http mode: gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='http mode: threads per worker')
+    parser.add_argument('--concurrency', type=int, default=8, help='http mode: load processes')
+    parser.add_argument('--duration', type=float, default=20, help='http mode: seconds measured')
+    parser.add_argument('--warmup', type=float, default=3, help='http mode: seconds before measuring')
+    parser.add_argument('--write-behind', action='store_true', help='accept messages into the write-behind log')
+    parser.add_argument('--in-place', action='store_true', help='write to the database itself')
+    parser.add_argument('--save', metavar='NAME', help='save results as a baseline')
+    parser.add_argument('--baseline', metavar='NAME', help='compare with a saved baseline')
+    args = parser.parse_args()
+
+    if not args.in_place:
+        args.database = scratch_copy(args.database)
+    # Both set before app is imported: it reads them at import time
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.database)
+    os.environ.setdefault('SECRET_KEY', secrets.token_hex(16))
+    if args.write_behind:
+        os.environ['MESSAGE_WRITE_BEHIND'] = '1'
+    sys.path.insert(0, ROOT)
+
+    workload = Workload(args.database, args.sessions, args.seed)
+    print(f'dataset: {", ".join(f"{count} {table}" for table, count in workload.counts.items())}')
+    print(f'mode: {args.mode}, {len(workload.users)} sessions, seed {args.seed}\n')
+
+    if args.mode == 'client':
+        results, elapsed = run_client(args, workload)
+    else:
+        results, elapsed = run_http(args, workload)
+
+    baseline = None
+    if args.baseline:
+        with open(os.path.join(BASELINES, f'{args.baseline}.json'), encoding='utf-8') as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        print(f'baseline {args.baseline}: {saved["meta"]["mode"]} mode at {saved["meta"]["revision"]}, '
+              f'{saved["meta"]["date"]}\n')
+    print_results(results, baseline)
+    print(f'\n{elapsed:.1f}s measured')
+
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        meta = {
+            'mode': args.mode, 'revision': _git_revision(), 'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'cpus': os.cpu_count(), 'dataset': workload.counts,
+            'args': {key: value for key, value in vars(args).items()
+                     if key not in ('database', 'save', 'baseline')}
+        }
+        path = os.path.join(BASELINES, f'{args.save}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, ensure_ascii=False)
+        print(f'saved {path}')
+
+
+if __name__ == '__main__':
+    main()
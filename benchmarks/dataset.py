@@ -0,0 +1,286 @@
+"""
+Synthetic Tedris dataset for the load benchmarks
+Builds a migrated database with users spread over every wilaya and
+moughataa in WILAYAS_MOUGHATAAS and every user category, schools,
+conversations between them, message history, a question bank and
+completed game sessions. The same seed gives the same database, so runs on
+different commits measure the same data.
+
+Rows are bulk inserted and the derived tables (search index, admin
+counters, unread counters, leaderboards) rebuilt once at the end, the way
+manage.py rebuilds them.
+
+    python benchmarks/dataset.py /tmp/tedris-bench.db --users 20000 --messages 2000000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import games  # noqa: E402
+import leaderboard  # noqa: E402
+import migrations  # noqa: E402
+import search  # noqa: E402
+import stats  # noqa: E402
+from hashing import hash_password  # noqa: E402
+from question_io import content_hash  # noqa: E402
+from reference_data import USER_CATEGORIES, WILAYAS_MOUGHATAAS  # noqa: E402
+
+# Every synthetic user logs in with this password
+PASSWORD = 'bench-password'
+
+FIRST_NAMES = ['محمد', 'أحمد', 'فاطمة', 'عائشة', 'إبراهيم', 'مريم', 'سيدي', 'خديجة',
+               'عبد الله', 'الشيخ', 'زينب', 'يحيى', 'آمنة', 'المختار', 'مامه', 'الحسن']
+LAST_NAMES = ['ولد أحمد', 'بنت محمد', 'ولد سيدي', 'ولد الشيخ', 'بنت عبد الله', 'ولد المختار',
+              'ولد إبراهيم', 'بنت الحسن', 'ولد محمد الأمين', 'ولد بابا', 'بنت يحيى', 'ولد اعل']
+WORDS = ['مرحبا', 'كيف', 'حالك', 'الدرس', 'غدا', 'الواجب', 'شكرا', 'الامتحان', 'Bonjour',
+         'merci', 'demain', 'cours', 'exercice', 'la', 'classe', 'الرياضيات', 'القسم']
+CATEGORIES = [('الجمع', 'addition', '+'), ('الطرح', 'soustraction', '-'),
+              ('الضرب', 'multiplication', '×'), ('القسمة', 'division', '÷'),
+              ('الكسور', 'fractions', '/'), ('الهندسة', 'géométrie', 'p')]
+POINTS = (100, 200, 300, 400, 500)
+
+BATCH_SIZE = 10000
+# Base of the synthetic phone numbers (valid Mauritanian mobile range)
+PHONE_BASE = 20000000
+START = datetime(2024, 9, 1)
+
+
+def user_phone(index):
+    return str(PHONE_BASE + index)
+
+
+def _batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(conn, sql, rows):
+    count = 0
+    for batch in _batches(rows):
+        with db.write_transaction(conn):
+            conn.executemany(sql, batch)
+        count += len(batch)
+    return count
+
+
+def _regions():
+    return [(wilaya, moughataa) for wilaya, moughataas in WILAYAS_MOUGHATAAS.items()
+            for moughataa in moughataas]
+
+
+def populate_schools(conn, rng, per_moughataa):
+    rows = []
+    for wilaya, moughataa in _regions():
+        for number in range(1, per_moughataa + 1):
+            kind = rng.choice(['مدرسة', 'إعدادية', 'ثانوية'])
+            rows.append((f'{kind} {moughataa} {number}', wilaya, moughataa))
+    return _insert(conn, 'INSERT INTO schools (name, wilaya, moughataa) VALUES (?, ?, ?)', rows)
+
+
+def populate_users(conn, rng, count):
+    password_hash = hash_password(PASSWORD)
+    regions = _regions()
+    schools = {}
+    for row in conn.execute('SELECT name, wilaya, moughataa FROM schools'):
+        schools.setdefault((row['wilaya'], row['moughataa']), []).append(row['name'])
+
+    def rows():
+        for index in range(count):
+            # Round-robin so every region and category has users at any size
+            wilaya, moughataa = regions[index % len(regions)]
+            category = USER_CATEGORIES[index % len(USER_CATEGORIES)]
+            name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {index}'
+            created = START + timedelta(minutes=index * 7)
+            school = rng.choice(schools.get((wilaya, moughataa)) or [None])
+            yield (name, f'{1000000000 + index}', user_phone(index), password_hash, category,
+                   wilaya, moughataa, school, created.strftime('%Y-%m-%d %H:%M:%S'))
+
+    return _insert(conn, '''
+        INSERT INTO users (full_name, nni, phone, password_hash, user_category, wilaya, moughataa,
+                           school, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows())
+
+
+def populate_conversations(conn, rng, per_user):
+    """Each user gets about per_user partners, mostly from their own wilaya"""
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    pairs = set()
+    for index, user_id in enumerate(user_ids):
+        for _ in range(max(1, per_user // 2)):
+            # Neighbouring ids share a region thanks to the round-robin above
+            other = user_ids[(index + rng.choice([1, -1]) * rng.randint(1, 50) * len(_regions()))
+                             % len(user_ids)]
+            if other != user_id:
+                pairs.add((min(user_id, other), max(user_id, other)))
+    return _insert(conn, '''
+        INSERT INTO conversations (participant1_id, participant2_id) VALUES (?, ?)
+    ''', sorted(pairs))
+
+
+def populate_messages(conn, rng, count):
+    conversations = conn.execute(
+        'SELECT id, participant1_id, participant2_id FROM conversations ORDER BY id'
+    ).fetchall()
+    if not conversations:
+        return 0
+    # Skewed like real chat: a few conversations carry most of the history
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(len(conversations))]
+    rng.shuffle(weights)
+    step = timedelta(days=365) / count
+
+    def rows():
+        picks = rng.choices(conversations, weights=weights, k=count)
+        for index, conversation in enumerate(picks):
+            sender = conversation[rng.randint(1, 2)]
+            content = ' '.join(rng.choices(WORDS, k=rng.randint(1, 12)))
+            created = START + step * index
+            # The latest messages are the unread ones
+            is_read = index < count * 0.98
+            yield (conversation[0], sender, content, created.strftime('%Y-%m-%d %H:%M:%S'), is_read)
+
+    inserted = _insert(conn, '''
+        INSERT INTO messages (conversation_id, sender_id, content, created_at, is_read)
+        VALUES (?, ?, ?, ?, ?)
+    ''', rows())
+    with db.write_transaction(conn):
+        conn.execute('''
+            UPDATE conversations SET
+                last_message_id = (SELECT MAX(id) FROM messages WHERE conversation_id = conversations.id)
+        ''')
+        conn.execute('''
+            UPDATE conversations SET
+                updated_at = COALESCE((SELECT created_at FROM messages WHERE id = last_message_id), created_at)
+        ''')
+        migrations.backfill_unread_counters(conn)
+    return inserted
+
+
+def populate_questions(conn, rng, per_cell):
+    def rows():
+        for category_ar, category_fr, operator in CATEGORIES:
+            for points in POINTS:
+                for number in range(per_cell):
+                    level = min(5, points // 100 + rng.choice([-1, 0, 0, 1]))
+                    level = max(1, level)
+                    a = rng.randint(2, 10 * level * (number % 5 + 1))
+                    b = rng.randint(2, 9 * level)
+                    if operator == '+':
+                        answer, text = a + b, f'{a} + {b}'
+                    elif operator == '-':
+                        answer, text = a, f'{a + b} - {b}'
+                    elif operator == '×':
+                        answer, text = a * b, f'{a} × {b}'
+                    elif operator == '÷':
+                        answer, text = a, f'{a * b} ÷ {b}'
+                    elif operator == '/':
+                        answer, text = f'{2 * a}/{b}', f'{a}/{b} + {a}/{b}'
+                    else:
+                        answer, text = 4 * a, f'4 × {a}'
+                    question_ar = f'{category_ar}: كم يساوي {text}؟ ({number})'
+                    question_fr = f'{category_fr} : combien font {text} ? ({number})'
+                    yield (category_ar, points, question_ar, question_fr, str(answer), str(answer),
+                           None, None, level,
+                           content_hash(category_ar, question_ar, question_fr, str(answer), str(answer)))
+
+    return _insert(conn, '''
+        INSERT OR IGNORE INTO math_jeopardy_questions
+            (category, points, question_ar, question_fr, answer_ar, answer_fr,
+             explanation_ar, explanation_fr, difficulty_level, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows())
+
+
+def populate_games(conn, rng, count):
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+    question_ids = [row[0] for row in conn.execute('SELECT id FROM math_jeopardy_questions')]
+    points = dict(conn.execute('SELECT id, points FROM math_jeopardy_questions').fetchall())
+    if not user_ids or not question_ids:
+        return 0
+    step = timedelta(days=365) / max(count, 1)
+
+    def rows():
+        for index in range(count):
+            board = rng.sample(question_ids, min(25, len(question_ids)))
+            skill = rng.random()
+            answers = {qid: points[qid] if rng.random() < skill else 0 for qid in board}
+            started = START + step * index
+            completed = started + timedelta(minutes=rng.randint(3, 30))
+            yield (rng.choice(user_ids), 'math_jeopardy', rng.choice(['arabic', 'french', 'mixed']),
+                   sum(answers.values()), len(answers), sum(1 for p in answers.values() if p),
+                   started.strftime('%Y-%m-%d %H:%M:%S'), completed.strftime('%Y-%m-%d %H:%M:%S'),
+                   games._encode_answers(answers), 0, json.dumps(board))
+
+    return _insert(conn, '''
+        INSERT INTO game_sessions (user_id, game_type, language_mode, score, questions_answered,
+                                   correct_answers, started_at, completed_at, answers, best_streak,
+                                   board_questions)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows())
+
+
+def generate(path, users=20000, conversations_per_user=10, messages=1000000, games_count=50000,
+             schools_per_moughataa=5, questions_per_cell=40, seed=1, log=print):
+    """Create a benchmark database at path (which must not exist yet)"""
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    pool = db.ConnectionPool(path, size=1)
+    conn = pool.acquire()
+    db.configure_storage(conn)
+    migrations.migrate(conn)
+
+    for label, step in (
+        ('schools', lambda: populate_schools(conn, rng, schools_per_moughataa)),
+        ('users', lambda: populate_users(conn, rng, users)),
+        ('conversations', lambda: populate_conversations(conn, rng, conversations_per_user)),
+        ('messages', lambda: populate_messages(conn, rng, messages)),
+        ('questions', lambda: populate_questions(conn, rng, questions_per_cell)),
+        ('game sessions', lambda: populate_games(conn, rng, games_count)),
+    ):
+        started = time.perf_counter()
+        count = step()
+        log(f'{label:14s} {count:>10d} rows in {time.perf_counter() - started:6.1f}s')
+
+    started = time.perf_counter()
+    with db.write_transaction(conn):
+        search.create_index(conn)
+        stats.rebuild(conn)
+        leaderboard.rebuild(conn)
+    conn.execute('ANALYZE')
+    log(f'{"derived tables":14s} {"":>10s}      in {time.perf_counter() - started:6.1f}s')
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--conversations-per-user', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--games', type=int, default=50000)
+    parser.add_argument('--schools-per-moughataa', type=int, default=5)
+    parser.add_argument('--questions-per-cell', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.path, args.users, args.conversations_per_user, args.messages, args.games,
+             args.schools_per_moughataa, args.questions_per_cell, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+SQLite contention benchmark
+Runs concurrent reader and writer processes against a scratch database and
+reports throughput and lock errors, once per journal mode, so the effect of
+WAL + write_transaction() can be compared with the default rollback journal.
+
+    python benchmarks/sqlite_contention.py --readers 8 --writers 4 --seconds 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+def setup(path, journal_mode, rows=20000):
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    conn.execute('''
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.executemany(
+        'INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)',
+        ((i % 500, i % 97, f'message {i}') for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def reader(path, busy_timeout, deadline, results):
+    pool = db.ConnectionPool(path, size=1, busy_timeout=busy_timeout)
+    conn = pool.acquire()
+    ops = errors = 0
+    worst = 0.0
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            conn.execute(
+                'SELECT COUNT(*) FROM messages WHERE conversation_id = ?', (ops % 500,)
+            ).fetchone()
+            ops += 1
+        except sqlite3.OperationalError:
+            errors += 1
+        worst = max(worst, time.perf_counter() - started)
+    results.put(('read', ops, errors, worst))
+
+
+def writer(path, busy_timeout, deadline, results, use_retry):
+    pool = db.ConnectionPool(path, size=1, busy_timeout=busy_timeout)
+    conn = pool.acquire()
+    ops = errors = 0
+    worst = 0.0
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            if use_retry:
+                with db.write_transaction(conn):
+                    conn.execute(
+                        'INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)',
+                        (ops % 500, 1, 'benchmark')
+                    )
+            else:
+                conn.execute(
+                    'INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)',
+                    (ops % 500, 1, 'benchmark')
+                )
+                conn.commit()
+            ops += 1
+        except sqlite3.OperationalError:
+            if conn.in_transaction:
+                conn.rollback()
+            errors += 1
+        worst = max(worst, time.perf_counter() - started)
+    results.put(('write', ops, errors, worst))
+
+
+def run(journal_mode, args):
+    workdir = tempfile.mkdtemp(prefix='tedris-bench-')
+    path = os.path.join(workdir, 'bench.db')
+    setup(path, journal_mode)
+
+    use_retry = journal_mode.lower() == 'wal'
+    busy_timeout = args.busy_timeout
+    results = multiprocessing.Queue()
+    deadline = time.time() + args.seconds
+    procs = [
+        multiprocessing.Process(target=reader, args=(path, busy_timeout, deadline, results))
+        for _ in range(args.readers)
+    ] + [
+        multiprocessing.Process(target=writer, args=(path, busy_timeout, deadline, results, use_retry))
+        for _ in range(args.writers)
+    ]
+    for proc in procs:
+        proc.start()
+    totals = {'read': [0, 0, 0.0], 'write': [0, 0, 0.0]}
+    for _ in procs:
+        kind, ops, errors, worst = results.get()
+        totals[kind][0] += ops
+        totals[kind][1] += errors
+        totals[kind][2] = max(totals[kind][2], worst)
+    for proc in procs:
+        proc.join()
+
+    label = f'{journal_mode} (busy_timeout={busy_timeout}ms, retry={"on" if use_retry else "off"})'
+    print(label)
+    for kind, (ops, errors, worst) in totals.items():
+        print(f'  {kind:5s}: {ops / args.seconds:10.0f} ops/s  '
+              f'{errors:6d} lock errors  worst {worst * 1000:8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--busy-timeout', type=int, default=db.DB_BUSY_TIMEOUT)
+    args = parser.parse_args()
+
+    for journal_mode in ('DELETE', 'WAL'):
+        run(journal_mode, args)
+
+
+if __name__ == '__main__':
+    main()
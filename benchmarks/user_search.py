@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+User search benchmark
+Compares the old LIKE '%q%' search with the FTS5 index from search.py on a
+scratch database of synthetic users.
+
+    python benchmarks/user_search.py --users 100000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import search  # noqa: E402
+
+FIRST_NAMES = ['محمد', 'أحمد', 'فاطمة', 'عائشة', 'إبراهيم', 'مريم', 'سيدي', 'خديجة',
+               'عبد الله', 'آمنة', 'يحيى', 'زينب', 'Mohamed', 'Aïcha', 'Élodie', 'Moussa']
+LINKS = ['ولد', 'بنت', 'ould', 'mint']
+SCHOOLS = ['ثانوية', 'إعدادية', 'مدرسة', 'Lycée', 'Collège']
+TOWNS = ['نواكشوط', 'أطار', 'روصو', 'كيفه', 'النعمة', 'Nouadhibou', 'Zouérate']
+QUERIES = ['محمد', 'احمد', 'فاطمه', 'ابراهيم ولد', 'aicha', 'elodie', '2234', 'ثانويه اطار', 'moussa mint']
+
+
+def populate(conn, count):
+    rng = random.Random(42)
+    rows = []
+    for i in range(count):
+        name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LINKS)} {rng.choice(FIRST_NAMES)}'
+        school = f'{rng.choice(SCHOOLS)} {rng.choice(TOWNS)} {rng.randint(1, 40)}'
+        rows.append((name, str(10_000_000 + i), str(22_000_000 + i), 'x', 'طالب', 'آدرار', 'أطار', school))
+    conn.executemany('''
+        INSERT INTO users (full_name, nni, phone, password_hash, user_category, wilaya, moughataa, school)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+
+
+def like_search(conn, query):
+    return conn.execute('''
+        SELECT id, full_name, user_category, school, is_online, last_seen
+        FROM users
+        WHERE id != ? AND is_verified = TRUE AND (
+            full_name LIKE ? OR
+            phone LIKE ? OR
+            school LIKE ?
+        )
+        ORDER BY is_online DESC, full_name ASC
+        LIMIT 20
+    ''', (0, f'%{query}%', f'%{query}%', f'%{query}%')).fetchall()
+
+
+def fts_search(conn, query):
+    return search.search_users(conn, query, 0)
+
+
+def measure(conn, func, repeat):
+    timings = {}
+    for query in QUERIES:
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func(conn, query)
+            samples.append((time.perf_counter() - started) * 1000)
+        timings[query] = statistics.median(samples)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='tedris-bench-'), 'bench.db')
+    conn = db.ConnectionPool(path, size=1).acquire()
+    migrations.migrate(conn)
+
+    started = time.perf_counter()
+    populate(conn, args.users)
+    print(f'inserted {args.users} users in {time.perf_counter() - started:.1f}s')
+
+    started = time.perf_counter()
+    with db.write_transaction(conn):
+        search.create_index(conn)
+    print(f'built search index in {time.perf_counter() - started:.1f}s\n')
+
+    like = measure(conn, like_search, args.repeat)
+    fts = measure(conn, fts_search, args.repeat)
+
+    print(f'{"query":16s} {"LIKE ms":>10s} {"FTS ms":>10s} {"speedup":>8s}  hits')
+    for query in QUERIES:
+        hits = len(fts_search(conn, query))
+        speedup = like[query] / fts[query] if fts[query] else float('inf')
+        print(f'{query:16s} {like[query]:10.2f} {fts[query]:10.2f} {speedup:7.1f}x  {hits}')
+    print(f'\nmedian: LIKE {statistics.median(like.values()):.2f} ms, '
+          f'FTS {statistics.median(fts.values()):.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Database connection layer for Tedris
+Keeps a small pool of SQLite connections per worker and binds one of them
+to each Flask request
+"""
+
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, init runs unguarded
+    fcntl = None
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'tedris.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_BUSY_TIMEOUT = int(os.environ.get('DB_BUSY_TIMEOUT', 5000))
+
+# Storage tuning, applied by configure_storage() and to every new connection
+DB_JOURNAL_MODE = os.environ.get('DB_JOURNAL_MODE', 'WAL')
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+DB_CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', -20000))  # negative = KiB
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+DB_TEMP_STORE = os.environ.get('DB_TEMP_STORE', 'MEMORY')
+DB_WRITE_RETRIES = int(os.environ.get('DB_WRITE_RETRIES', 5))
+DB_RETRY_BACKOFF = float(os.environ.get('DB_RETRY_BACKOFF', 0.05))
+
+# Called as query_observer(sql, seconds) after every statement run through a
+# PooledConnection when set (see metrics.py)
+query_observer = None
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free in time"""
+
+
+class PooledConnection:
+    """sqlite3 connection handed out by the pool
+
+    close() gives the connection back to the pool instead of closing it.
+    Connections bound to a request are released at teardown, so close()
+    is a no-op for them.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._request_bound = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def _observed(self, method, sql, *args):
+        observer = query_observer
+        if observer is None:
+            return method(sql, *args)
+        started = time.perf_counter()
+        try:
+            return method(sql, *args)
+        finally:
+            observer(sql, time.perf_counter() - started)
+
+    def execute(self, sql, parameters=()):
+        return self._observed(self._raw.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._observed(self._raw.executemany, sql, seq_of_parameters)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._raw.__exit__(*exc_info)
+
+    def close(self):
+        if self._request_bound or self._raw is None:
+            return
+        self.release()
+
+    def release(self):
+        """Return the underlying connection to the pool"""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(raw)
+
+
+class ConnectionPool:
+    """Bounded LIFO pool of SQLite connections
+
+    LIFO order keeps the most recently used (warmest) connections in play.
+    The pool remembers the pid it was created in so that connections opened
+    in a gunicorn master are never reused by forked workers.
+    """
+
+    def __init__(self, path, size=5, timeout=10.0, busy_timeout=5000):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        apply_connection_pragmas(conn)
+        return conn
+
+    def acquire(self):
+        """Check out a connection, opening a new one if none is idle"""
+        if self._pid != os.getpid():
+            self._reset()
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+
+        try:
+            raw = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                raw = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        """Put a connection back, discarding any uncommitted work"""
+        if self._pid != os.getpid():
+            return
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+            self._idle.put(raw)
+        except sqlite3.Error:
+            raw.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def apply_connection_pragmas(conn):
+    """Per-connection PRAGMAs (these are not stored in the database file)"""
+    conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = {DB_CACHE_SIZE}')
+    conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA temp_store = {DB_TEMP_STORE}')
+
+
+def configure_storage(conn):
+    """Switch the database file to the configured journal mode
+
+    WAL is persistent, so this only needs to run once per database (from
+    init_db()); it lets readers keep going while a single writer commits.
+    Returns the journal mode SQLite actually selected.
+    """
+    mode = conn.execute(f'PRAGMA journal_mode = {DB_JOURNAL_MODE}').fetchone()[0]
+    if mode.lower() == 'wal':
+        # Keep the WAL from growing without bound under steady chat traffic
+        conn.execute('PRAGMA wal_autocheckpoint = 1000')
+    return mode
+
+
+def is_locked_error(error):
+    message = str(error).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+@contextmanager
+def write_transaction(conn, retries=None):
+    """Run a block inside a BEGIN IMMEDIATE transaction
+
+    Taking the write lock up front avoids the read-to-write upgrade
+    deadlock that busy_timeout cannot resolve. If the lock is still held
+    by another writer after busy_timeout, BEGIN is retried with jittered
+    backoff before giving up. Commits on success, rolls back on error.
+    """
+    retries = DB_WRITE_RETRIES if retries is None else retries
+    if conn.in_transaction:
+        # Don't fold earlier implicit work into a fresh transaction silently
+        conn.commit()
+
+    attempt = 0
+    while True:
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            break
+        except sqlite3.OperationalError as e:
+            if not is_locked_error(e) or attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(DB_RETRY_BACKOFF * (2 ** (attempt - 1)) * (1 + random.random()))
+
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+pool = ConnectionPool(
+    DATABASE_PATH,
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    busy_timeout=DB_BUSY_TIMEOUT
+)
+
+
+@contextmanager
+def init_lock(path=DATABASE_PATH):
+    """Exclusive lock held while a process initializes the database
+
+    An advisory lock on a file next to the database, so that of several
+    servers (or workers, without preload) starting at once one migrates
+    while the others wait and then find nothing left to do.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f'{path}.init-lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_db_connection():
+    """Get the connection for the current request, or a pooled one outside requests"""
+    if not has_app_context():
+        return pool.acquire()
+
+    if 'db' not in g:
+        conn = pool.acquire()
+        conn._request_bound = True
+        g.db = conn
+    return g.db
+
+
+def close_db(exception=None):
+    """Release the request's connection back to the pool"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.release()
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
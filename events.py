@@ -0,0 +1,214 @@
+"""
+Real-time event hub for Tedris
+Routes fan events out to the logged-in users' Server-Sent Events streams.
+The backend decides how events travel between gunicorn workers:
+
+- 'local'  : in-process only (single worker / development)
+- 'sqlite' : events are appended to the events table and every worker
+             tails it, so all workers see all events
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import db
+
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'local')
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))
+EVENTS_RETENTION = int(os.environ.get('EVENTS_RETENTION', 300))
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+EVENTS_KEEPALIVE = int(os.environ.get('EVENTS_KEEPALIVE', 15))
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One open event stream of one user"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.closed = False
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A stalled client; close it so it reconnects and resyncs
+            self.closed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LocalBackend:
+    """Delivers events to subscribers of this process only"""
+
+    def start(self, dispatch):
+        self._dispatch = dispatch
+
+    def publish(self, user_ids, event_type, data):
+        for user_id in user_ids:
+            self._dispatch(user_id, event_type, data)
+
+
+class SQLiteBackend:
+    """Shares events between workers through the events table
+
+    publish() inserts one row per recipient, on the caller's connection (a
+    request's own, so a send needs one pool slot, not two), in the caller's
+    transaction if one is open; a daemon thread in each worker
+    tails the table by id and dispatches rows to its own subscribers. Rows
+    older than EVENTS_RETENTION seconds are pruned as they are read.
+    """
+
+    def __init__(self, poll_interval=EVENTS_POLL_INTERVAL, retention=EVENTS_RETENTION):
+        self.poll_interval = poll_interval
+        self.retention = retention
+
+    def start(self, dispatch):
+        self._dispatch = dispatch
+        conn = db.get_db_connection()
+        try:
+            self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        finally:
+            conn.close()
+        thread = threading.Thread(target=self._run, name='events-tail', daemon=True)
+        thread.start()
+
+    def publish(self, user_ids, event_type, data):
+        payload = json.dumps(data)
+        rows = [(user_id, event_type, payload, time.time()) for user_id in user_ids]
+        conn = db.get_db_connection()
+        try:
+            if conn.in_transaction:
+                # Commits with the caller's writes
+                self._insert(conn, rows)
+            else:
+                with db.write_transaction(conn):
+                    self._insert(conn, rows)
+        finally:
+            # Keeps a request's connection; returns one taken from the pool
+            conn.close()
+
+    def _insert(self, conn, rows):
+        conn.executemany(
+            'INSERT INTO events (user_id, event_type, payload, created_at) VALUES (?, ?, ?, ?)', rows
+        )
+
+    def _run(self):
+        last_prune = time.time()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                conn = db.pool.acquire()
+                try:
+                    rows = conn.execute(
+                        'SELECT id, user_id, event_type, payload FROM events WHERE id > ? ORDER BY id',
+                        (self._last_id,)
+                    ).fetchall()
+                    if time.time() - last_prune > self.retention:
+                        last_prune = time.time()
+                        with db.write_transaction(conn):
+                            conn.execute('DELETE FROM events WHERE created_at < ?',
+                                         (last_prune - self.retention,))
+                finally:
+                    conn.close()
+            except Exception:
+                logger.exception('Reading the events table failed; retrying')
+                continue
+
+            for row in rows:
+                self._last_id = row['id']
+                self._dispatch(row['user_id'], row['event_type'], json.loads(row['payload']))
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+class EventHub:
+    """In-process pub/sub keyed by user id"""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._subscribers = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Started lazily, and again after a fork, since threads don't survive it
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self.backend is None:
+                self.backend = BACKENDS[EVENTS_BACKEND]()
+            self._subscribers = {}
+            self.backend.start(self._dispatch)
+            self._pid = os.getpid()
+
+    def start(self):
+        """Start receiving events in this worker (subscribe and publish do it too)"""
+        self._ensure_started()
+
+    def listen(self, callback):
+        """Also hand every event this worker receives to callback(user_id, event_type, data)"""
+        self._listeners.append(callback)
+
+    def _dispatch(self, user_id, event_type, data):
+        for callback in self._listeners:
+            callback(user_id, event_type, data)
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            subscription.push((event_type, data))
+
+    def subscribe(self, user_id):
+        self._ensure_started()
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def publish(self, user_ids, event_type, data):
+        """Send an event to every open stream of the given users"""
+        self._ensure_started()
+        self.backend.publish(list(user_ids), event_type, data)
+
+    def stream(self, subscription, keepalive=EVENTS_KEEPALIVE):
+        """Yield Server-Sent Events for a subscription until the client goes away"""
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield 'retry: 3000\n\n'
+            while not subscription.closed:
+                event = subscription.get(timeout=keepalive)
+                if event is None:
+                    yield ': keepalive\n\n'
+                    continue
+                event_type, data = event
+                yield f'event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+        finally:
+            self.unsubscribe(subscription)
+
+
+hub = EventHub()
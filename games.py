@@ -0,0 +1,492 @@
+"""
+Live Math Jeopardy sessions
+Sessions being played are kept in memory: the dealt board, which
+questions were answered and for how many points, score and streaks. An
+answer is validated and scored without touching SQLite; the session row
+is written when the game completes and, while it is in progress, by a
+checkpoint every GAME_CHECKPOINT_INTERVAL seconds.
+
+Each live session has one owner, the worker holding it (its pid is in
+game_sessions.owner): the worker that started it, or the first one to
+receive an answer for it after its owner let it go. Only the owner scores
+a session, so there is a single copy of its answers however requests are
+spread over workers. A worker receiving an answer for a session another
+worker owns forwards it to the owner's unix socket
+(GAME_SOCKET_PREFIX.<pid>.sock) and relays the reply; it reads the owner
+from the session row and remembers it until the next checkpoint.
+
+- Sessions idle for GAME_IDLE_TIMEOUT seconds, and every session when the
+  worker exits, are written and released (owner set to NULL); the next
+  worker to receive an answer for one takes it over.
+- If the owner is gone without releasing its sessions (a killed worker),
+  its socket refuses the forward and the sender takes the session over
+  from the last checkpoint; answers after it are lost and can be given
+  again.
+- An owner only writes a session whose row still names it, so a worker
+  whose session was taken over drops its copy rather than overwrite the
+  new owner's.
+
+Without unix sockets (Windows) answers aren't forwarded and sessions move
+to whichever worker answers them, so run a single worker there.
+"""
+
+import atexit
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime
+
+import db
+import leaderboard
+
+GAME_CHECKPOINT_INTERVAL = int(os.environ.get('GAME_CHECKPOINT_INTERVAL', 15))
+# Sessions idle for this long are written out and released
+GAME_IDLE_TIMEOUT = int(os.environ.get('GAME_IDLE_TIMEOUT', 1800))
+# Each worker takes forwarded answers on GAME_SOCKET_PREFIX.<pid>.sock
+GAME_SOCKET_PREFIX = os.environ.get('GAME_SOCKET_PREFIX', f'{db.DATABASE_PATH}.games')
+GAME_FORWARD_TIMEOUT = float(os.environ.get('GAME_FORWARD_TIMEOUT', 5))
+# Recent sessions used to judge a player's accuracy for board selection
+GAME_HISTORY_SESSIONS = int(os.environ.get('GAME_HISTORY_SESSIONS', 10))
+
+# Times an answer is routed again while its session changes hands
+_ROUTE_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class GameError(Exception):
+    """Rejected game request; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class _Moved(Exception):
+    """The worker asked doesn't hold the session (any more)"""
+
+
+class GameSession:
+    """State of one game; answers maps question id to points earned
+
+    question_ids is the board the player was dealt; None for sessions
+    started before boards were sampled, which accept any question.
+    """
+
+    __slots__ = ('id', 'user_id', 'language_mode', 'question_ids', 'total_questions',
+                 'answers', 'streak', 'best_streak', 'completed_at', 'dirty', 'touched')
+
+    def __init__(self, session_id, user_id, language_mode, question_ids, total_questions,
+                 answers=None, best_streak=0, completed_at=None):
+        self.id = session_id
+        self.user_id = user_id
+        self.language_mode = language_mode
+        self.question_ids = question_ids
+        self.total_questions = len(question_ids) if question_ids is not None else total_questions
+        self.answers = answers or {}
+        self.streak = 0
+        self.best_streak = best_streak
+        self.completed_at = completed_at
+        self.dirty = False
+        self.touched = time.monotonic()
+
+    @property
+    def score(self):
+        return sum(self.answers.values())
+
+    @property
+    def correct_answers(self):
+        return sum(1 for points in self.answers.values() if points > 0)
+
+    @property
+    def completed(self):
+        return self.completed_at is not None
+
+    def snapshot(self):
+        return {
+            'total_score': self.score,
+            'questions_answered': len(self.answers),
+            'correct_answers': self.correct_answers,
+            'streak': self.streak,
+            'best_streak': self.best_streak,
+            'completed': self.completed
+        }
+
+
+def _encode_answers(answers):
+    return json.dumps({str(question_id): points for question_id, points in answers.items()},
+                      separators=(',', ':'))
+
+
+def _decode_answers(value):
+    if not value:
+        return {}
+    return {int(question_id): points for question_id, points in json.loads(value).items()}
+
+
+def _decode_board(value):
+    return frozenset(json.loads(value)) if value else None
+
+
+def player_history(conn, user_id, sessions=GAME_HISTORY_SESSIONS):
+    """(accuracy, recently asked question ids) over a player's last sessions
+
+    accuracy is None for players with no answers yet.
+    """
+    answered = 0
+    correct = 0
+    asked = set()
+    for row in conn.execute('''
+        SELECT answers FROM game_sessions
+        WHERE user_id = ?
+        ORDER BY started_at DESC
+        LIMIT ?
+    ''', (user_id, sessions)):
+        for question_id, points in _decode_answers(row['answers']).items():
+            answered += 1
+            correct += points > 0
+            asked.add(question_id)
+    return (correct / answered if answered else None), asked
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _ForwardHandler(socketserver.StreamRequestHandler):
+        """One forwarded answer: a JSON line in, a JSON line out"""
+
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            reply = self.server.store._serve(request)
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+    class _ForwardServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, path, store):
+            super().__init__(path, _ForwardHandler)
+            self.store = store
+else:  # Windows: no unix sockets, so nothing is forwarded
+    _ForwardServer = None
+
+
+class GameStore:
+    """Live sessions owned by this worker, checkpointed to game_sessions
+
+    Answers for sessions other workers own are forwarded to them.
+    """
+
+    def __init__(self, checkpoint_interval=GAME_CHECKPOINT_INTERVAL, idle_timeout=GAME_IDLE_TIMEOUT,
+                 socket_prefix=GAME_SOCKET_PREFIX, forward_timeout=GAME_FORWARD_TIMEOUT):
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_timeout = idle_timeout
+        self.socket_prefix = socket_prefix
+        self.forward_timeout = forward_timeout
+        self._lock = threading.Lock()
+        self._sessions = {}
+        # Session id -> owner pid, for sessions owned by other workers
+        self._owners = {}
+        self._server = None
+        self._pid = None
+
+    def _socket_path(self, pid):
+        return f'{self.socket_prefix}.{pid}.sock'
+
+    def _ensure_started(self):
+        # Neither the socket nor the checkpoint thread survive a fork, so set up one per worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._sessions = {}
+            self._owners = {}
+            self._server = self._listen()
+        thread = threading.Thread(target=self._run, name='game-checkpoint', daemon=True)
+        thread.start()
+
+    def _listen(self):
+        if _ForwardServer is None:
+            return None
+        path = self._socket_path(self._pid)
+        try:
+            # Left behind by an earlier process with this pid
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        try:
+            server = _ForwardServer(path, self)
+        except OSError:
+            logger.exception('Cannot listen on %s; other workers will take over sessions started here',
+                             path)
+            return None
+        os.chmod(path, 0o600)
+        thread = threading.Thread(target=server.serve_forever, name='game-forward', daemon=True)
+        thread.start()
+        return server
+
+    def start(self, conn, user_id, game_type, language_mode, question_ids):
+        """Create a session row for a dealt board, owned by this worker; returns its id"""
+        self._ensure_started()
+        question_ids = frozenset(question_ids)
+        with db.write_transaction(conn):
+            cursor = conn.execute('''
+                INSERT INTO game_sessions (user_id, game_type, language_mode, board_questions, owner)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, game_type, language_mode, json.dumps(sorted(question_ids)), self._pid))
+        game = GameSession(cursor.lastrowid, user_id, language_mode, question_ids, len(question_ids))
+        with self._lock:
+            self._sessions[game.id] = game
+        return game.id
+
+    def answer(self, conn, session_id, user_id, question_id, points, correct, total_questions):
+        """Record an answer with the session's owner
+
+        Returns (the session's language mode, updated session snapshot).
+        Raises GameError if the session isn't user_id's, is completed, or
+        the question was already answered or isn't on its board.
+        total_questions sizes sessions that have no dealt board.
+        """
+        self._ensure_started()
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
+            raise GameError('Invalid session') from None
+        request = {'session_id': session_id, 'user_id': user_id, 'question_id': question_id,
+                   'points': points, 'correct': correct}
+
+        for attempt in range(_ROUTE_ATTEMPTS):
+            if attempt:
+                # The session is being released or taken over; give that a moment
+                time.sleep(0.01 * attempt)
+            try:
+                return self._answer_held(conn, **request)
+            except _Moved:
+                pass
+            owner = self._owner(conn, session_id, user_id)
+            if owner is not None and owner != self._pid and _ForwardServer is not None:
+                try:
+                    return self._forward(owner, request)
+                except _Moved:
+                    with self._lock:
+                        self._owners.pop(session_id, None)
+                    continue
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The owner exited without releasing its sessions
+                    pass
+            self._take_over(conn, session_id, owner, total_questions)
+        raise GameError('Game is busy, try again', 503)
+
+    def _answer_held(self, conn, session_id, user_id, question_id, points, correct):
+        """Score an answer for a session held here; raises _Moved if it isn't"""
+        with self._lock:
+            game = self._sessions.get(session_id)
+            if game is None:
+                raise _Moved()
+            if game.user_id != user_id:
+                raise GameError('Session not found', 404)
+            if game.question_ids is not None and question_id not in game.question_ids:
+                raise GameError('Question is not on this board')
+            if game.completed:
+                raise GameError('Game already completed', 409)
+            if question_id in game.answers:
+                raise GameError('Question already answered', 409)
+            game.answers[question_id] = points if correct else 0
+            game.streak = game.streak + 1 if correct else 0
+            game.best_streak = max(game.best_streak, game.streak)
+            if len(game.answers) >= game.total_questions:
+                game.completed_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            game.dirty = True
+            game.touched = time.monotonic()
+            snapshot = game.snapshot()
+
+        if game.completed:
+            # Written at once, so the leaderboards count it; a failed write is retried by the checkpoint
+            if self._write(conn, [game]):
+                raise _Moved()
+        return game.language_mode, snapshot
+
+    def _owner(self, conn, session_id, user_id):
+        """Pid of the worker holding the session, or None if nobody does"""
+        with self._lock:
+            owner = self._owners.get(session_id)
+        if owner is not None:
+            return owner
+        row = conn.execute(
+            'SELECT user_id, completed_at, owner FROM game_sessions WHERE id = ?', (session_id,)
+        ).fetchone()
+        if not row or row['user_id'] != user_id:
+            raise GameError('Session not found', 404)
+        if row['completed_at'] is not None:
+            raise GameError('Game already completed', 409)
+        if row['owner'] is not None and row['owner'] != self._pid:
+            with self._lock:
+                self._owners[session_id] = row['owner']
+        return row['owner']
+
+    def _forward(self, owner, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.forward_timeout)
+            try:
+                sock.connect(self._socket_path(owner))
+                sock.sendall(json.dumps(request).encode() + b'\n')
+                reply = sock.makefile('rb').readline()
+            except (ConnectionRefusedError, FileNotFoundError):
+                raise
+            except OSError:
+                logger.exception('Forwarding an answer to worker %d failed', owner)
+                reply = None
+        if not reply:
+            raise GameError('Game is unavailable, try again', 503)
+        reply = json.loads(reply)
+        if reply.get('moved'):
+            raise _Moved()
+        if 'error' in reply:
+            raise GameError(reply['error'], reply['status'])
+        return reply['language_mode'], reply['progress']
+
+    def _serve(self, request):
+        """Reply to an answer forwarded by another worker"""
+        try:
+            language_mode, progress = self._answer_held(None, **request)
+        except _Moved:
+            return {'moved': True}
+        except GameError as e:
+            return {'error': e.message, 'status': e.status}
+        except Exception:
+            logger.exception('Forwarded answer for session %s failed', request.get('session_id'))
+            return {'error': 'Internal error', 'status': 500}
+        return {'language_mode': language_mode, 'progress': progress}
+
+    def _take_over(self, conn, session_id, owner, total_questions):
+        """Become the session's owner if it is still owner's, loading it from its row"""
+        with db.write_transaction(conn):
+            cursor = conn.execute('''
+                UPDATE game_sessions SET owner = ?
+                WHERE id = ? AND owner IS ? AND completed_at IS NULL
+            ''', (self._pid, session_id, owner))
+            if not cursor.rowcount:
+                # Another worker got there first, or it just completed; route again
+                return
+            row = conn.execute('''
+                SELECT id, user_id, language_mode, board_questions, answers, best_streak, completed_at
+                FROM game_sessions WHERE id = ?
+            ''', (session_id,)).fetchone()
+        game = GameSession(row['id'], row['user_id'], row['language_mode'],
+                           _decode_board(row['board_questions']), total_questions,
+                           _decode_answers(row['answers']), row['best_streak'] or 0,
+                           row['completed_at'])
+        with self._lock:
+            self._owners.pop(session_id, None)
+            # Another request here may have taken it meanwhile; keep the first copy
+            self._sessions.setdefault(game.id, game)
+
+    def _write(self, conn, games, release=False):
+        """Store sessions held here in one transaction
+
+        Completed sessions, and all of them with release, are written
+        without an owner. Returns the sessions whose rows another worker
+        had taken over; their copies are dropped.
+        """
+        release_conn = conn is None
+        if release_conn:
+            conn = db.get_db_connection()
+        changes = []
+        lost = []
+        try:
+            with db.write_transaction(conn):
+                for game in games:
+                    with self._lock:
+                        values = (game.score, len(game.answers), game.correct_answers,
+                                  _encode_answers(game.answers), game.best_streak,
+                                  game.completed_at)
+                        game.dirty = False
+                    owner = None if release or game.completed else self._pid
+                    cursor = conn.execute('''
+                        UPDATE game_sessions
+                        SET score = ?, questions_answered = ?, correct_answers = ?,
+                            answers = ?, best_streak = ?, completed_at = ?, owner = ?
+                        WHERE id = ? AND owner = ?
+                    ''', (*values, owner, game.id, self._pid))
+                    if not cursor.rowcount:
+                        lost.append(game)
+                    elif owner is None and game.completed:
+                        change = leaderboard.record_game(
+                            conn, game.user_id, game.score, game.correct_answers, game.completed_at
+                        )
+                        if change is not None:
+                            changes.append(change)
+        except Exception:
+            with self._lock:
+                for game in games:
+                    game.dirty = True
+            raise
+        finally:
+            if release_conn:
+                conn.close()
+
+        with self._lock:
+            for game in games:
+                if release or game.completed or game in lost:
+                    self._sessions.pop(game.id, None)
+        for game in lost:
+            logger.warning('Game session %d was taken over by another worker; '
+                           'answers since its last checkpoint are lost', game.id)
+        for change in changes:
+            leaderboard.boards.apply(change)
+        return lost
+
+    def checkpoint(self):
+        """Write sessions with unsaved answers and release idle ones; returns how many written"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [game for game in self._sessions.values()
+                    if now - game.touched > self.idle_timeout]
+            dirty = [game for game in self._sessions.values()
+                     if game.dirty and now - game.touched <= self.idle_timeout]
+            # Owners are read from the rows again, so stale ones don't pile up
+            self._owners = {}
+        if idle:
+            self._write(None, idle, release=True)
+        if dirty:
+            self._write(None, dirty)
+        return len(idle) + len(dirty)
+
+    def close(self):
+        """Stop taking forwarded answers and release every session held here"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            try:
+                os.unlink(self._socket_path(self._pid))
+            except FileNotFoundError:
+                pass
+            self._server = None
+        with self._lock:
+            games = list(self._sessions.values())
+        if games:
+            self._write(None, games, release=True)
+
+    def _run(self):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            try:
+                self.checkpoint()
+            except Exception:
+                logger.exception('Checkpointing game sessions failed; retrying')
+
+
+store = GameStore()
+
+
+@atexit.register
+def _release_on_exit():
+    if store._pid == os.getpid():
+        try:
+            store.close()
+        except Exception:
+            logger.exception('Releasing game sessions at exit failed')
@@ -0,0 +1,89 @@
+"""
+gunicorn configuration for Tedris
+
+    gunicorn -c gunicorn.conf.py
+
+Workers default to one per CPU: SQLite takes one writer at a time, so
+more processes than cores mostly wait on the write lock. Each worker runs
+threads (gthread), since most of a request's time in them is spent
+waiting on SQLite rather than computing. Two limits follow from that:
+
+- An open chat page holds its /api/events stream, and with it a thread,
+  for as long as it stays open. Threads are sized for GUNICORN_STREAMS
+  open streams per worker plus two per CPU (at least four) for ordinary
+  requests; once a worker's streams take every thread, its other
+  requests queue. Size GUNICORN_STREAMS for the chat tabs expected open
+  at once, divided by the workers.
+- Each request thread holds a database connection while it runs, and the
+  background threads (presence, game checkpoints, events tail, message
+  log writer) take one each now and then. DB_POOL_SIZE defaults to the
+  threads plus those, so no request waits on the pool; set it lower only
+  knowing that requests beyond it wait DB_POOL_TIMEOUT and then fail.
+
+Override with WEB_CONCURRENCY, GUNICORN_STREAMS, GUNICORN_THREADS and
+DB_POOL_SIZE. With more than one worker, chat events go through the
+database (EVENTS_BACKEND=sqlite, see events.py) unless EVENTS_BACKEND
+says otherwise.
+
+The app is preloaded (wsgi.py): the master migrates the schema once and
+loads the caches, and workers fork from it. Reloading:
+
+- kill -HUP <master> replaces the workers gracefully, with the preloaded
+  code, so it picks up configuration but not code changes;
+- kill -USR2 <master> starts a new master and workers with the new code
+  next to the old ones; then kill -WINCH and -TERM the old master.
+
+Or set GUNICORN_PRELOAD=0 to load the app in each worker, which makes HUP
+reload code too. Workers finish their requests within GUNICORN_GRACEFUL
+seconds when stopped; game sessions are checkpointed and released on
+exit.
+
+The time from config load until the master is ready to fork workers
+(which includes preloading) is logged with its steps, and a warning when
+it exceeds STARTUP_TARGET seconds.
+"""
+
+import os
+import sys
+import time
+
+_config_loaded = time.perf_counter()
+
+STARTUP_TARGET = float(os.environ.get('STARTUP_TARGET', 5))
+
+_cpus = os.cpu_count() or 1
+
+wsgi_app = 'wsgi:app'
+bind = f'{os.environ.get("HOST", "0.0.0.0")}:{os.environ.get("PORT", 5000)}'
+workers = int(os.environ.get('WEB_CONCURRENCY', _cpus))
+streams = int(os.environ.get('GUNICORN_STREAMS', 32))
+threads = int(os.environ.get('GUNICORN_THREADS', streams + max(4, 2 * _cpus)))
+worker_class = 'gthread'
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# Read by events.py and db.py when the app is loaded, which happens after this file
+os.environ.setdefault('EVENTS_BACKEND', 'sqlite' if workers > 1 else 'local')
+# One connection per thread, plus the background threads' (the message log writer may hold two)
+os.environ.setdefault('DB_POOL_SIZE', str(threads + 5))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL', 30))
+keepalive = 5
+
+# Recycling workers bounds slow leaks; jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    elapsed = time.perf_counter() - _config_loaded
+    timings = getattr(sys.modules.get('wsgi'), 'startup_timings', None)
+    steps = ', '.join(f'{step} {seconds:.2f}s' for step, seconds in (timings or {}).items())
+    server.log.info('Ready in %.2fs%s (%d workers x %d threads)',
+                    elapsed, f' ({steps})' if steps else '', server.num_workers, server.cfg.threads)
+    if elapsed > STARTUP_TARGET:
+        server.log.warning('Startup took %.2fs, over the %.1fs target', elapsed, STARTUP_TARGET)
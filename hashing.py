@@ -0,0 +1,121 @@
+"""
+Password hashing off the request threads
+Hashing and checking passwords is deliberately CPU-heavy. Running it inline
+lets a burst of logins occupy every worker thread, so it goes through a
+small process pool instead: at most HASH_QUEUE_SIZE calls may be waiting
+or running per worker, and a call that can't get a slot, or doesn't finish,
+within HASH_TIMEOUT seconds fails with HashUnavailable.
+
+PASSWORD_HASH_METHOD is the full werkzeug method string. A stored hash made
+with a different method still verifies; needs_rehash() tells the caller to
+replace it with a new one while the plain password is at hand.
+HASH_WORKERS=0 hashes inline, which is simpler for development.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', 2))
+HASH_QUEUE_SIZE = int(os.environ.get('HASH_QUEUE_SIZE', 16))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+# Never plain fork: the pool starts inside a worker whose other threads
+# (presence, events, game checkpoints) may hold a lock the child would inherit
+# held. forkserver children fork from a clean single-threaded server.
+HASH_START_METHOD = os.environ.get(
+    'HASH_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+
+# Called as hash_observer(operation, seconds) after each hash or check (see metrics.py)
+hash_observer = None
+
+
+class HashUnavailable(Exception):
+    """The hashing pool is saturated or too slow; try again later"""
+
+
+def hash_password(password, method=PASSWORD_HASH_METHOD):
+    """Hash inline with the configured method (for pools that aren't this service's)"""
+    return generate_password_hash(password, method=method)
+
+
+def needs_rehash(password_hash, method=PASSWORD_HASH_METHOD):
+    """Whether a stored hash was made with other parameters than method"""
+    return password_hash.split('$', 1)[0] != method
+
+
+class HashService:
+    """Bounded per-worker process pool for hashing and verifying passwords"""
+
+    def __init__(self, workers=HASH_WORKERS, queue_size=HASH_QUEUE_SIZE,
+                 timeout=HASH_TIMEOUT, method=PASSWORD_HASH_METHOD):
+        self.workers = workers
+        self.timeout = timeout
+        self.method = method
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        # Child processes can't be shared across a fork, so each worker starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context(HASH_START_METHOD))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, func, *args):
+        observer = hash_observer
+        if observer is None:
+            return self._call(func, *args)
+        started = time.perf_counter()
+        try:
+            return self._call(func, *args)
+        finally:
+            observer(func.__name__, time.perf_counter() - started)
+
+    def _call(self, func, *args):
+        if self.workers <= 0:
+            return func(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashUnavailable('hashing queue is full')
+        try:
+            future = self._pool().submit(func, *args)
+            try:
+                return future.result(timeout=self.timeout)
+            except FutureTimeout:
+                future.cancel()
+                raise HashUnavailable('hashing timed out') from None
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """New hash of password with the configured method"""
+        return self._run(hash_password, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return needs_rehash(password_hash, self.method)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._pid = None
+
+
+service = HashService()
@@ -0,0 +1,173 @@
+"""
+Math Jeopardy question bank
+The question bank changes rarely, so each worker loads it once and serves
+boards and question lookups from memory. Triggers on
+math_jeopardy_questions bump a version number in resource_versions; the
+bank compares it at most every JEOPARDY_VERSION_CHECK seconds and reloads
+when it changed. Answers are compiled for matching (see answers.py) at
+load time, not per submission.
+
+Boards are sampled per player. Questions are grouped at load time into
+buckets by category, points and difficulty level; a board takes one
+question per (category, points) cell from the bucket whose difficulty best
+fits the cell and the player's recent accuracy, so building one costs
+O(board size) however large the bank is.
+"""
+
+import os
+import random
+import threading
+import time
+
+import answers
+import versions
+
+JEOPARDY_VERSION_CHECK = float(os.environ.get('JEOPARDY_VERSION_CHECK', 5))
+JEOPARDY_BOARD_CATEGORIES = int(os.environ.get('JEOPARDY_BOARD_CATEGORIES', 5))
+
+# Recent accuracy at or above / at or below which boards get one level harder / easier
+SKILLED_ACCURACY = 0.8
+STRUGGLING_ACCURACY = 0.4
+
+# Random picks tried per cell before accepting a recently asked question
+_FRESH_ATTEMPTS = 3
+
+
+def question_text(question, language_mode):
+    """Question text shown on the board for a language mode"""
+    if language_mode == 'french':
+        return question['question_fr']
+    return question['question_ar']
+
+
+class QuestionBank:
+    """In-memory copy of math_jeopardy_questions, bucketed for board sampling"""
+
+    def __init__(self, check_interval=JEOPARDY_VERSION_CHECK):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self.questions = {}
+        self.answer_keys = {}
+        # category -> points -> difficulty level -> [question id]
+        self.buckets = {}
+        self.levels = []
+
+    @property
+    def version(self):
+        return self._version
+
+    def _load(self, conn, version):
+        questions = {}
+        answer_keys = {}
+        buckets = {}
+        levels = set()
+        for row in conn.execute('''
+            SELECT id, category, points, question_ar, question_fr, answer_ar, answer_fr,
+                   explanation_ar, explanation_fr, difficulty_level
+            FROM math_jeopardy_questions
+            ORDER BY category, points
+        '''):
+            question = dict(row)
+            question['difficulty_level'] = question['difficulty_level'] or 1
+            questions[row['id']] = question
+            answer_keys[row['id']] = answers.compile_answers(row['answer_ar'], row['answer_fr'])
+            buckets.setdefault(row['category'], {}).setdefault(row['points'], {}) \
+                .setdefault(question['difficulty_level'], []).append(row['id'])
+            levels.add(question['difficulty_level'])
+
+        self.questions = questions
+        self.answer_keys = answer_keys
+        self.buckets = buckets
+        self.levels = sorted(levels)
+        self._version = version
+
+    def refresh(self, conn, force=False):
+        """Reload if the question table changed since the last load"""
+        now = time.monotonic()
+        if not force and self._version is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and self._version is not None and now - self._checked_at < self.check_interval:
+                return
+            version = versions.get(conn, 'math_jeopardy_questions')
+            if force or version != self._version:
+                self._load(conn, version)
+            self._checked_at = now
+
+    def _target_level(self, tier, tiers, shift):
+        """Difficulty level index for the tier-th of tiers point values"""
+        top = len(self.levels) - 1
+        base = round(tier * top / (tiers - 1)) if tiers > 1 else 0
+        return min(max(base + shift, 0), top)
+
+    def _pick(self, by_level, target, exclude, rng):
+        # Nearest non-empty level to the target, then a fresh question from it
+        for distance in range(len(self.levels)):
+            for index in {target - distance, target + distance}:
+                if 0 <= index < len(self.levels) and self.levels[index] in by_level:
+                    candidates = by_level[self.levels[index]]
+                    for _ in range(_FRESH_ATTEMPTS):
+                        question_id = rng.choice(candidates)
+                        if question_id not in exclude:
+                            return question_id
+                    return question_id
+        return None
+
+    def sample_board(self, conn, language_mode, accuracy=None, exclude=(),
+                     categories=JEOPARDY_BOARD_CATEGORIES, rng=random):
+        """Board for one player and the ids of the questions on it
+
+        accuracy is the player's recent share of correct answers (None for
+        a new player); exclude holds questions they were asked recently.
+        """
+        self.refresh(conn)
+        buckets = self.buckets
+        names = sorted(buckets)
+        if len(names) > categories:
+            names = sorted(rng.sample(names, categories))
+
+        shift = 0
+        if accuracy is not None:
+            if accuracy >= SKILLED_ACCURACY:
+                shift = 1
+            elif accuracy <= STRUGGLING_ACCURACY:
+                shift = -1
+
+        board = {}
+        question_ids = []
+        for category in names:
+            tiers = sorted(buckets[category])
+            for tier, points in enumerate(tiers):
+                target = self._target_level(tier, len(tiers), shift)
+                question_id = self._pick(buckets[category][points], target, exclude, rng)
+                if question_id is None:
+                    continue
+                board.setdefault(category, {})[points] = {
+                    'id': question_id,
+                    'question': question_text(self.questions[question_id], language_mode),
+                    'answered': False
+                }
+                question_ids.append(question_id)
+        return board, question_ids
+
+    def get(self, conn, question_id):
+        """Question dict by id, or None"""
+        self.refresh(conn)
+        try:
+            return self.questions.get(int(question_id))
+        except (TypeError, ValueError):
+            return None
+
+    def check_answer(self, conn, question_id, submission):
+        """Whether submission is an accepted answer to the question"""
+        self.refresh(conn)
+        try:
+            compiled = self.answer_keys.get(int(question_id))
+        except (TypeError, ValueError):
+            return False
+        return compiled is not None and answers.is_correct(compiled, submission)
+
+
+bank = QuestionBank()
@@ -0,0 +1,304 @@
+"""
+Game leaderboards for Tedris
+Totals per user are rolled up into leaderboard_scores as game sessions
+complete, in the same transaction, for four kinds of board: global, per
+wilaya, per user category and per ISO week. Nothing aggregates
+game_sessions at request time; rebuild() recomputes everything from it.
+
+Each worker keeps the boards it serves as sorted lists of rank keys, so a
+user's rank is a binary search and a page is a slice. A worker applies its
+own changes to the loaded boards directly. Every row records the
+leaderboard version (see versions.py) that last changed it, so when
+another worker has changed scores since, only the rows changed after the
+version a worker holds are read and applied. Boards are reloaded from
+scratch only after rebuild(), which bumps a separate epoch.
+"""
+
+import bisect
+import os
+import threading
+import time
+from datetime import datetime
+
+import versions
+
+LEADERBOARD_PAGE_SIZE = 20
+LEADERBOARD_MAX_PAGE_SIZE = 100
+LEADERBOARD_VERSION_CHECK = float(os.environ.get('LEADERBOARD_VERSION_CHECK', 5))
+
+SCOPES = ('global', 'wilaya', 'category', 'week')
+
+_RESOURCE = 'leaderboard'
+# Bumped by rebuild(), which changes rows without versioning each one
+_EPOCH = 'leaderboard-epoch'
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS leaderboard_scores (
+            board TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            score INTEGER NOT NULL DEFAULT 0,
+            games INTEGER NOT NULL DEFAULT 0,
+            correct_answers INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (board, user_id)
+        ) WITHOUT ROWID
+    ''')
+    # Rebuilds walk completed sessions only
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_game_sessions_completed
+        ON game_sessions (completed_at, user_id) WHERE completed_at IS NOT NULL
+    ''')
+    rebuild(conn)
+
+
+def add_change_versions(conn):
+    """Version of the change that last touched each row, for delta refreshes"""
+    conn.execute('ALTER TABLE leaderboard_scores ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_leaderboard_scores_version ON leaderboard_scores (version)')
+    versions.bump(conn, _EPOCH)
+
+
+def week_of(timestamp):
+    """ISO week ('2024-W07') of a 'YYYY-MM-DD HH:MM:SS' timestamp"""
+    year, week, _ = datetime.strptime(timestamp[:10], '%Y-%m-%d').isocalendar()
+    return f'{year}-W{week:02d}'
+
+
+def current_week():
+    return week_of(datetime.utcnow().strftime('%Y-%m-%d'))
+
+
+def board_key(scope, value=''):
+    return 'global' if scope == 'global' else f'{scope}:{value}'
+
+
+def _boards_for(user_category, wilaya, completed_at):
+    return (board_key('global'),
+            board_key('wilaya', wilaya),
+            board_key('category', user_category),
+            board_key('week', week_of(completed_at)))
+
+
+def rebuild(conn):
+    """Recompute every board from completed game sessions"""
+    conn.execute('DELETE FROM leaderboard_scores')
+    totals = {}
+    for row in conn.execute('''
+        SELECT g.user_id, g.score, g.correct_answers, g.completed_at, u.user_category, u.wilaya
+        FROM game_sessions g
+        JOIN users u ON u.id = g.user_id
+        WHERE g.completed_at IS NOT NULL
+    '''):
+        for board in _boards_for(row['user_category'], row['wilaya'], row['completed_at']):
+            total = totals.setdefault((board, row['user_id']), [0, 0, 0])
+            total[0] += row['score'] or 0
+            total[1] += 1
+            total[2] += row['correct_answers'] or 0
+    conn.executemany('''
+        INSERT INTO leaderboard_scores (board, user_id, score, games, correct_answers)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(board, user_id, *total) for (board, user_id), total in totals.items()])
+    versions.bump(conn, _RESOURCE)
+    versions.bump(conn, _EPOCH)
+    return len(totals)
+
+
+def record_game(conn, user_id, score, correct_answers, completed_at):
+    """Add a completed session to the user's boards; call inside its write transaction
+
+    Returns the change to hand to boards.apply() once the transaction commits.
+    """
+    user = conn.execute('SELECT user_category, wilaya FROM users WHERE id = ?', (user_id,)).fetchone()
+    if not user:
+        return None
+    version = versions.bump(conn, _RESOURCE)
+    updated = []
+    for board in _boards_for(user['user_category'], user['wilaya'], completed_at):
+        row = conn.execute('''
+            INSERT INTO leaderboard_scores (board, user_id, score, games, correct_answers, version)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (board, user_id) DO UPDATE SET
+                score = score + excluded.score,
+                games = games + 1,
+                correct_answers = correct_answers + excluded.correct_answers,
+                version = excluded.version
+            RETURNING score, games, correct_answers
+        ''', (board, user_id, score, correct_answers, version)).fetchone()
+        updated.append((board, user_id, row['score'], row['games'], row['correct_answers']))
+    return version, updated
+
+
+def _rank_key(user_id, score, correct_answers):
+    # Ascending order of this key is rank order; ties go to the earlier account
+    return (-score, -correct_answers, user_id)
+
+
+class Board:
+    """One leaderboard as a sorted list of rank keys"""
+
+    __slots__ = ('keys', 'entries')
+
+    def __init__(self, rows=()):
+        self.keys = []
+        self.entries = {}
+        for user_id, score, games, correct_answers in rows:
+            self.entries[user_id] = (score, games, correct_answers)
+            self.keys.append(_rank_key(user_id, score, correct_answers))
+        self.keys.sort()
+
+    def set(self, user_id, score, games, correct_answers):
+        previous = self.entries.get(user_id)
+        if previous is not None:
+            old = _rank_key(user_id, previous[0], previous[2])
+            del self.keys[bisect.bisect_left(self.keys, old)]
+        self.entries[user_id] = (score, games, correct_answers)
+        bisect.insort(self.keys, _rank_key(user_id, score, correct_answers))
+
+    def rank(self, user_id):
+        """1-based rank of a user, or None if they haven't played"""
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        return bisect.bisect_left(self.keys, _rank_key(user_id, entry[0], entry[2])) + 1
+
+    def page(self, offset, limit):
+        """[(rank, user_id, score, games, correct_answers)] for one page"""
+        return [(offset + i + 1, key[2], *self.entries[key[2]])
+                for i, key in enumerate(self.keys[offset:offset + limit])]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class Leaderboards:
+    """Per-worker cache of the boards it has served"""
+
+    def __init__(self, check_interval=LEADERBOARD_VERSION_CHECK):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._boards = {}
+        self._version = None
+        self._epoch = None
+        self._checked_at = 0.0
+
+    def _refresh(self, conn):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return
+        version = versions.get(conn, _RESOURCE)
+        epoch = versions.get(conn, _EPOCH)
+        with self._lock:
+            held = self._version
+            if held is not None and version == held and epoch == self._epoch:
+                self._checked_at = now
+                return
+            if held is None or epoch != self._epoch or not self._boards:
+                # Rebuilt (or nothing loaded): reload lazily
+                self._boards = {}
+                self._version = version
+                self._epoch = epoch
+                self._checked_at = now
+                return
+
+        # Only the rows changed since the version held: a few recent ones,
+        # which the planner can't tell from a range of most of the table
+        rows = conn.execute('''
+            SELECT board, user_id, score, games, correct_answers
+            FROM leaderboard_scores INDEXED BY idx_leaderboard_scores_version
+            WHERE version > ?
+        ''', (held,)).fetchall()
+        with self._lock:
+            if self._version != held or self._epoch != epoch:
+                # apply() or another refresh moved on meanwhile; these rows may be older
+                return
+            for board, user_id, score, games, correct_answers in rows:
+                loaded = self._boards.get(board)
+                if loaded is not None:
+                    loaded.set(user_id, score, games, correct_answers)
+            self._version = version
+            self._checked_at = now
+
+    def board(self, conn, board):
+        self._refresh(conn)
+        with self._lock:
+            loaded = self._boards.get(board)
+            version = self._version
+        if loaded is not None:
+            return loaded
+        rows = conn.execute('''
+            SELECT user_id, score, games, correct_answers FROM leaderboard_scores
+            WHERE board = ?
+        ''', (board,)).fetchall()
+        loaded = Board(tuple(row) for row in rows)
+        with self._lock:
+            if self._version != version:
+                # Changed while loading; serve this copy but don't keep it
+                return loaded
+            return self._boards.setdefault(board, loaded)
+
+    def apply(self, change):
+        """Apply a committed record_game() change to the loaded boards"""
+        if change is None:
+            return
+        version, updated = change
+        with self._lock:
+            if self._version is None or version != self._version + 1:
+                # Someone else's change came in between; the next read fetches both
+                self._checked_at = 0.0
+                return
+            for board, user_id, score, games, correct_answers in updated:
+                loaded = self._boards.get(board)
+                if loaded is not None:
+                    loaded.set(user_id, score, games, correct_answers)
+            self._version = version
+
+
+boards = Leaderboards()
+
+
+def leaderboard(conn, board, user_id, offset=0, limit=LEADERBOARD_PAGE_SIZE):
+    """One page of a board plus the requesting user's own standing"""
+    loaded = boards.board(conn, board)
+    with boards._lock:
+        page = loaded.page(offset, limit)
+        total = len(loaded)
+        my_rank = loaded.rank(user_id)
+        mine = loaded.entries.get(user_id)
+
+    names = {}
+    user_ids = [entry[1] for entry in page]
+    if user_ids:
+        placeholders = ', '.join('?' * len(user_ids))
+        for row in conn.execute(f'''
+            SELECT id, full_name, wilaya, school FROM users WHERE id IN ({placeholders})
+        ''', user_ids):
+            names[row['id']] = row
+
+    entries = []
+    for rank, entry_user_id, score, games, correct_answers in page:
+        user = names.get(entry_user_id)
+        entries.append({
+            'rank': rank,
+            'user_id': entry_user_id,
+            'full_name': user['full_name'] if user else None,
+            'wilaya': user['wilaya'] if user else None,
+            'school': user['school'] if user else None,
+            'score': score,
+            'games': games,
+            'correct_answers': correct_answers
+        })
+
+    return {
+        'board': board,
+        'entries': entries,
+        'total': total,
+        'offset': offset,
+        'has_more': offset + len(entries) < total,
+        'me': None if mine is None else {
+            'rank': my_rank,
+            'score': mine[0],
+            'games': mine[1],
+            'correct_answers': mine[2]
+        }
+    }
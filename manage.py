@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Tedris management commands
+
+    python manage.py migrate
+    python manage.py check-plans
+    python manage.py repair-unread
+    python manage.py rebuild-stats
+    python manage.py rebuild-leaderboard
+    python manage.py import-questions questions.csv [--format csv|jsonl] [--batch-size N] [--dry-run]
+    python manage.py export-questions questions.jsonl [--format csv|jsonl]
+    python manage.py import-users users.csv [--report report.csv] [--workers N] [--dry-run]
+    python manage.py set-admin PHONE [--revoke]
+"""
+
+import argparse
+import sys
+import time
+
+import db
+import leaderboard
+import migrations
+import question_io
+import stats
+
+
+def cmd_migrate(args):
+    """Apply pending schema migrations"""
+    conn = db.get_db_connection()
+    db.configure_storage(conn)
+    applied = migrations.migrate(conn)
+    version = migrations.current_version(conn)
+    conn.close()
+
+    if applied:
+        print(f'Applied migrations {", ".join(map(str, applied))}; schema is at version {version}')
+    else:
+        print(f'Schema is up to date (version {version})')
+    return 0
+
+
+def cmd_check_plans(args):
+    """Fail if any hot query falls back to a table or index scan, or a paginated one to a sort"""
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    problems = migrations.check_query_plans(conn)
+    conn.close()
+
+    for name, detail in problems:
+        print(f'{name}: {detail}')
+    if problems:
+        print(f'{len(problems)} problem(s) found')
+        return 1
+    print(f'All {len(migrations.QUERY_PLAN_CHECKS)} queries use indexes')
+    return 0
+
+
+def cmd_repair_unread(args):
+    """Recompute the per-conversation unread counters from messages"""
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    with db.write_transaction(conn):
+        repaired = migrations.backfill_unread_counters(conn)
+    conn.close()
+
+    print(f'Recomputed unread counters for {repaired} conversation(s)')
+    return 0
+
+
+def cmd_rebuild_stats(args):
+    """Recompute the admin statistics counters from users"""
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    with db.write_transaction(conn):
+        stats.rebuild(conn)
+    stats.cache.invalidate()
+    total = stats.dashboard(conn)['total_users']
+    conn.close()
+
+    print(f'Rebuilt statistics for {total} user(s)')
+    return 0
+
+
+def cmd_rebuild_leaderboard(args):
+    """Recompute the game leaderboards from completed sessions"""
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    with db.write_transaction(conn):
+        entries = leaderboard.rebuild(conn)
+    conn.close()
+
+    print(f'Rebuilt {entries} leaderboard entries')
+    return 0
+
+
+def cmd_import_questions(args):
+    """Load Math Jeopardy questions from a CSV or JSONL file"""
+    fmt = args.format or question_io.detect_format(args.path)
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    with open(args.path, encoding='utf-8-sig', newline='') as stream:
+        report = question_io.import_questions(conn, stream, fmt, args.batch_size, args.dry_run)
+    conn.close()
+
+    for line_number, error in report.errors:
+        print(f'{args.path}:{line_number}: {error}')
+    if report.invalid > len(report.errors):
+        print(f'... and {report.invalid - len(report.errors)} more invalid row(s)')
+    action = 'validated' if args.dry_run else f'{report.inserted} inserted, {report.duplicates} duplicate(s)'
+    print(f'{report.read} row(s) read: {action}, {report.invalid} invalid '
+          f'in {report.elapsed:.2f}s ({report.rate:.0f} rows/s)')
+    return 1 if report.invalid else 0
+
+
+def cmd_export_questions(args):
+    """Write the Math Jeopardy question bank to a CSV or JSONL file"""
+    fmt = args.format or question_io.detect_format(args.path)
+    conn = db.get_db_connection()
+    started = time.perf_counter()
+    with open(args.path, 'w', encoding='utf-8', newline='') as stream:
+        count = question_io.export_questions(conn, stream, fmt, args.batch_size)
+    conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f'Exported {count} question(s) in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} rows/s)')
+    return 0
+
+
+def cmd_import_users(args):
+    """Create accounts in bulk from a CSV file"""
+    import user_import
+
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    report_stream = open(args.report, 'w', encoding='utf-8', newline='') if args.report else None
+    try:
+        with open(args.path, encoding='utf-8-sig', newline='') as stream:
+            report = user_import.import_users(
+                conn, stream, report_stream,
+                args.batch_size or user_import.USER_BATCH_SIZE,
+                args.workers or user_import.USER_IMPORT_WORKERS,
+                args.dry_run
+            )
+    finally:
+        if report_stream:
+            report_stream.close()
+    conn.close()
+
+    action = 'validated' if args.dry_run else 'created'
+    print(f'{report.read} row(s) read: {report.created} {action}, {report.duplicates} duplicate(s), '
+          f'{report.invalid} invalid in {report.elapsed:.2f}s ({report.rate:.0f} rows/s, '
+          f'{report.hash_seconds:.2f}s hashing)')
+    if args.report:
+        print(f'Per-row report written to {args.report}')
+    return 1 if report.invalid else 0
+
+
+def cmd_set_admin(args):
+    """Grant (or with --revoke, take away) administrator access by phone number"""
+    conn = db.get_db_connection()
+    migrations.migrate(conn)
+    with db.write_transaction(conn):
+        updated = conn.execute(
+            'UPDATE users SET is_admin = ? WHERE phone = ?', (not args.revoke, args.phone)
+        ).rowcount
+    conn.close()
+
+    if not updated:
+        print(f'No user with phone {args.phone}')
+        return 1
+    print(f'{args.phone} is {"no longer" if args.revoke else "now"} an administrator')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tedris management commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('migrate', help=cmd_migrate.__doc__).set_defaults(func=cmd_migrate)
+    subparsers.add_parser('check-plans', help=cmd_check_plans.__doc__).set_defaults(func=cmd_check_plans)
+    subparsers.add_parser('repair-unread', help=cmd_repair_unread.__doc__).set_defaults(func=cmd_repair_unread)
+    subparsers.add_parser('rebuild-stats', help=cmd_rebuild_stats.__doc__).set_defaults(func=cmd_rebuild_stats)
+    subparsers.add_parser('rebuild-leaderboard',
+                          help=cmd_rebuild_leaderboard.__doc__).set_defaults(func=cmd_rebuild_leaderboard)
+
+    for name, func in (('import-questions', cmd_import_questions), ('export-questions', cmd_export_questions)):
+        command = subparsers.add_parser(name, help=func.__doc__)
+        command.add_argument('path')
+        command.add_argument('--format', choices=question_io.FORMATS,
+                             help='default: from the file extension')
+        command.add_argument('--batch-size', type=int, default=question_io.QUESTION_BATCH_SIZE)
+        command.set_defaults(func=func)
+    subparsers.choices['import-questions'].add_argument(
+        '--dry-run', action='store_true', help='validate only, insert nothing')
+
+    command = subparsers.add_parser('import-users', help=cmd_import_users.__doc__)
+    command.add_argument('path')
+    command.add_argument('--report', help='CSV file for the per-row results and generated passwords')
+    command.add_argument('--batch-size', type=int)
+    command.add_argument('--workers', type=int, help='password hashing processes (default: CPU count)')
+    command.add_argument('--dry-run', action='store_true', help='validate and check duplicates only')
+    command.set_defaults(func=cmd_import_users)
+
+    command = subparsers.add_parser('set-admin', help=cmd_set_admin.__doc__)
+    command.add_argument('phone')
+    command.add_argument('--revoke', action='store_true')
+    command.set_defaults(func=cmd_set_admin)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,426 @@
+"""
+Chat message persistence, with an optional write-behind log
+store_message() writes one message the synchronous way: find or create
+the conversation, insert, update the conversation's last message and the
+recipient's unread counter, all in the caller's write transaction.
+
+With MESSAGE_WRITE_BEHIND=1, send_message() instead appends the message to
+an append-only log file next to the database and answers at once with a
+client id; a background writer applies the log to SQLite in groups of up
+to MESSAGE_FLUSH_BATCH messages per transaction, then pushes the usual
+chat events (carrying the client id, so the sender can match them).
+Acknowledging costs an fsync of the log instead of a turn at SQLite's
+write lock, which pays off when many workers send at once; the writer
+pushes events from its own process, so with several workers use
+EVENTS_BACKEND=sqlite (gunicorn.conf.py's default).
+
+- Durability: an append is fsync'ed before it is acknowledged (unless
+  MESSAGE_LOG_FSYNC=0), so an acknowledged message survives a crash.
+- Ordering: every worker appends to the same file under an exclusive
+  lock, and a single writer (whichever process holds the flush lock)
+  applies it in file order. Messages therefore get ids in the order they
+  were acknowledged, which keeps each conversation in order however the
+  participants' requests are spread over workers.
+- Recovery: the log position applied so far is committed in the same
+  transaction as the messages (message_log_state), so replaying from it
+  after a crash applies every message exactly once. init_db() replays
+  before the server starts; a writer taking over the flush lock does too.
+- Bad entries: an entry that fails to store for any reason other than
+  the database being busy is moved to MESSAGE_DEAD_LETTER_PATH and
+  skipped, so one bad entry can't hold up the rest of the log.
+
+The first line of the file names its generation. Once everything in it
+is applied and it has grown past MESSAGE_LOG_MAX_BYTES, the writer
+truncates it and starts the next generation; a stored position from an
+older generation than the file's means its entries were all applied.
+"""
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, so no shared log either
+    fcntl = None
+
+import db
+from events import hub
+from response_cache import responses
+
+MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND', '0') == '1'
+MESSAGE_LOG_PATH = os.environ.get('MESSAGE_LOG_PATH', f'{db.DATABASE_PATH}.messages.log')
+# Entries that can't be stored, one JSON line each with the reason
+MESSAGE_DEAD_LETTER_PATH = os.environ.get('MESSAGE_DEAD_LETTER_PATH', f'{MESSAGE_LOG_PATH}.dead')
+MESSAGE_LOG_FSYNC = os.environ.get('MESSAGE_LOG_FSYNC', '1') != '0'
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 0.05))
+MESSAGE_FLUSH_BATCH = int(os.environ.get('MESSAGE_FLUSH_BATCH', 500))
+MESSAGE_LOG_MAX_BYTES = int(os.environ.get('MESSAGE_LOG_MAX_BYTES', 16 * 1024 * 1024))
+# How often a process waiting for the flush lock checks whether it is free
+MESSAGE_FLUSH_TAKEOVER = float(os.environ.get('MESSAGE_FLUSH_TAKEOVER', 1))
+
+_STATE = 'messages'
+
+logger = logging.getLogger(__name__)
+
+if MESSAGE_WRITE_BEHIND and fcntl is None:
+    logger.warning('MESSAGE_WRITE_BEHIND needs file locks (fcntl); storing messages synchronously')
+    MESSAGE_WRITE_BEHIND = False
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_log_state (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL,
+            position INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def store_message(conn, sender_id, recipient_id, content, created_at):
+    """Write one message; call inside a write transaction
+
+    Returns (conversation id, message id, recipient's unread count).
+    """
+    # Find or create conversation
+    conversation = conn.execute('''
+        SELECT id FROM conversations
+        WHERE (participant1_id = ? AND participant2_id = ?)
+           OR (participant1_id = ? AND participant2_id = ?)
+    ''', (sender_id, recipient_id, recipient_id, sender_id)).fetchone()
+
+    if not conversation:
+        cursor = conn.execute('''
+            INSERT INTO conversations (participant1_id, participant2_id)
+            VALUES (?, ?)
+        ''', (min(sender_id, recipient_id), max(sender_id, recipient_id)))
+        conversation_id = cursor.lastrowid
+    else:
+        conversation_id = conversation['id']
+
+    cursor = conn.execute('''
+        INSERT INTO messages (conversation_id, sender_id, content, created_at)
+        VALUES (?, ?, ?, ?)
+    ''', (conversation_id, sender_id, content, created_at))
+    message_id = cursor.lastrowid
+
+    # Update conversation's last message and the recipient's unread counter
+    conn.execute('''
+        UPDATE conversations
+        SET last_message_id = ?, updated_at = CURRENT_TIMESTAMP,
+            participant1_unread = participant1_unread + (participant1_id = ?),
+            participant2_unread = participant2_unread + (participant2_id = ?)
+        WHERE id = ?
+    ''', (message_id, recipient_id, recipient_id, conversation_id))
+
+    unread_count = conn.execute('''
+        SELECT CASE WHEN participant1_id = ? THEN participant1_unread ELSE participant2_unread END
+        FROM conversations WHERE id = ?
+    ''', (recipient_id, conversation_id)).fetchone()[0]
+    return conversation_id, message_id, unread_count
+
+
+def publish_message(conversation_id, message_id, unread_count, sender_id, recipient_id,
+                    sender_name, content, created_at, client_id=None):
+    """Push a stored message to both participants' open chat pages"""
+    # This worker's cached lists change now; other workers hear it from the events below
+    responses.bump(('conversations', sender_id), ('conversations', recipient_id))
+
+    message = {
+        'id': message_id,
+        'content': content,
+        'sender_id': sender_id,
+        'sender_name': sender_name,
+        'is_read': False,
+        'created_at': created_at
+    }
+    event = {'conversation_id': conversation_id, 'message': message}
+    if client_id is not None:
+        event['client_id'] = client_id
+    hub.publish([sender_id, recipient_id], 'message', event)
+    hub.publish([recipient_id], 'unread', {
+        'conversation_id': conversation_id,
+        'unread_count': unread_count
+    })
+
+
+class Accepted:
+    """A message taken into the log, not yet in SQLite"""
+
+    __slots__ = ('client_id', 'created_at')
+
+    def __init__(self, client_id, created_at):
+        self.client_id = client_id
+        self.created_at = created_at
+
+
+def _header(generation):
+    return json.dumps({'generation': generation}).encode() + b'\n'
+
+
+def _stored_state(conn):
+    row = conn.execute(
+        'SELECT generation, position FROM message_log_state WHERE name = ?', (_STATE,)
+    ).fetchone()
+    return (row['generation'], row['position']) if row else (0, 0)
+
+
+class MessageLog:
+    """Append-only message log shared by the workers of one host, and its writer"""
+
+    def __init__(self, path=MESSAGE_LOG_PATH, fsync=MESSAGE_LOG_FSYNC,
+                 flush_interval=MESSAGE_FLUSH_INTERVAL, batch_size=MESSAGE_FLUSH_BATCH,
+                 max_bytes=MESSAGE_LOG_MAX_BYTES, dead_letter_path=MESSAGE_DEAD_LETTER_PATH):
+        self.path = path
+        self.dead_letter_path = dead_letter_path
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._fd = None
+        self._pid = None
+        # Held while this process is the writer: the flush lock's fd, and
+        # the (generation, position) it has applied up to
+        self._flush_fd = None
+        self._applied = None
+
+    def _open(self):
+        # Neither the fd's lock ownership nor the writer thread survive a fork
+        if self._pid == os.getpid():
+            return self._fd
+        with self._lock:
+            if self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+                self._flush_fd = None
+                self._applied = None
+                self._pid = os.getpid()
+                thread = threading.Thread(target=self._run, name='message-log', daemon=True)
+                thread.start()
+        return self._fd
+
+    def append(self, sender_id, recipient_id, content, sender_name):
+        """Durably log a message; returns Accepted. Raises OSError if it can't be"""
+        fd = self._open()
+        created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            position = os.fstat(fd).st_size
+            if position == 0:
+                # New file: continue from the generation last applied
+                conn = db.pool.acquire()
+                try:
+                    generation = _stored_state(conn)[0] + 1
+                finally:
+                    conn.close()
+                os.write(fd, _header(generation))
+                position = os.fstat(fd).st_size
+            else:
+                generation = json.loads(os.pread(fd, 64, 0).split(b'\n', 1)[0])['generation']
+            client_id = f'{generation}-{position}'
+            line = json.dumps({'id': client_id, 's': sender_id, 'r': recipient_id, 'c': content,
+                               'n': sender_name, 't': created_at}, ensure_ascii=False).encode('utf-8') + b'\n'
+            if os.write(fd, line) != len(line):
+                # Disk full: drop the partial line rather than leave it for the writer
+                os.ftruncate(fd, position)
+                raise OSError('short write to message log')
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        if self.fsync:
+            os.fsync(fd)
+        self._wake.set()
+        return Accepted(client_id, created_at)
+
+    def _try_become_writer(self, block=False):
+        if self._flush_fd is not None:
+            return True
+        fd = os.open(f'{self.path}.flush-lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._flush_fd = fd
+        self._applied = None
+        return True
+
+    def _release_writer(self):
+        if self._flush_fd is not None:
+            os.close(self._flush_fd)
+            self._flush_fd = None
+            self._applied = None
+
+    def _run(self):
+        while not self._try_become_writer():
+            self._wake.wait(MESSAGE_FLUSH_TAKEOVER)
+            self._wake.clear()
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                with self._lock:
+                    self.flush()
+            except Exception:
+                logger.exception('Flushing the message log failed; retrying')
+                self._wake.wait(MESSAGE_FLUSH_TAKEOVER)
+
+    def flush(self, publish=True):
+        """Apply every complete entry past the applied position; returns how many
+
+        Only the process holding the flush lock may call this.
+        """
+        try:
+            log = open(self.path, 'rb')
+        except FileNotFoundError:
+            return 0
+        conn = db.pool.acquire()
+        try:
+            with log:
+                header = log.readline()
+                if not header.endswith(b'\n'):
+                    # Being created by an append
+                    return 0
+                file_generation = json.loads(header)['generation']
+                header_end = log.tell()
+                if self._applied is None:
+                    self._applied = _stored_state(conn)
+                generation, position = self._applied
+                if file_generation > generation:
+                    # A fresh file: everything in the previous one was applied
+                    position = header_end
+                elif file_generation < generation:
+                    raise RuntimeError(f'{self.path} is generation {file_generation}, '
+                                       f'older than the applied generation {generation}')
+                log.seek(position)
+
+                applied = 0
+                while True:
+                    batch, end = self._read_batch(log, position)
+                    if end == position:
+                        break
+                    results = self._apply(conn, batch, file_generation, end)
+                    self._applied = (file_generation, end)
+                    position = end
+                    applied += len(batch)
+                    if publish:
+                        for entry, stored in results:
+                            publish_message(*stored, entry['s'], entry['r'], entry.get('n'),
+                                            entry['c'], entry['t'], entry.get('id'))
+
+                if position >= self.max_bytes:
+                    self._start_generation(file_generation, position)
+            return applied
+        finally:
+            conn.close()
+
+    def _read_batch(self, log, position):
+        """Up to batch_size parsed entries from position, and where they end"""
+        batch = []
+        end = position
+        while len(batch) < self.batch_size:
+            line = log.readline()
+            if not line.endswith(b'\n'):
+                # End of file, or an append still being written
+                break
+            end += len(line)
+            try:
+                batch.append(json.loads(line))
+            except ValueError:
+                self._dead_letter(line.decode('utf-8', 'replace').rstrip('\n'), 'unreadable')
+        return batch, end
+
+    def _dead_letter(self, entry, reason):
+        logger.error('Moving message log entry to %s: %s', self.dead_letter_path, reason)
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'entry': entry, 'reason': reason}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _apply(self, conn, batch, generation, end):
+        results = []
+        with db.write_transaction(conn):
+            for entry in batch:
+                # Each entry in a savepoint, so a bad one is undone alone
+                conn.execute('SAVEPOINT entry')
+                try:
+                    stored = store_message(conn, entry['s'], entry['r'], entry['c'], entry['t'])
+                except sqlite3.OperationalError:
+                    # Busy or locked: the whole group is retried
+                    raise
+                except Exception as e:
+                    conn.execute('ROLLBACK TO entry')
+                    conn.execute('RELEASE entry')
+                    # Written before the commit: a crash may repeat it here, never lose it
+                    self._dead_letter(entry, f'{type(e).__name__}: {e}')
+                    continue
+                conn.execute('RELEASE entry')
+                results.append((entry, stored))
+            conn.execute('''
+                INSERT INTO message_log_state (name, generation, position) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET generation = excluded.generation, position = excluded.position
+            ''', (_STATE, generation, end))
+        return results
+
+    def _start_generation(self, generation, position):
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Only if nothing was appended since the last applied entry
+            if os.fstat(fd).st_size != position:
+                return
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, _header(generation + 1), 0)
+            os.fsync(fd)
+            self._applied = (generation + 1, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+
+    def _drop_torn_tail(self):
+        """Truncate an entry a crash left half written, so appends start on a new line"""
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            data = os.pread(fd, size, 0)
+            end = data.rfind(b'\n') + 1
+            if end < size:
+                logger.warning('Dropping %d bytes of an incomplete message log entry', size - end)
+                os.ftruncate(fd, end)
+        finally:
+            os.close(fd)
+
+    def replay(self):
+        """Apply whatever a previous run left in the log (startup recovery)
+
+        Skipped if another live process holds the flush lock: it is
+        applying the log already. Returns how many messages were applied.
+        """
+        if not os.path.exists(self.path) or not self._try_become_writer():
+            return 0
+        try:
+            self._drop_torn_tail()
+            with self._lock:
+                # No events: this runs before any client is connected
+                return self.flush(publish=False)
+        finally:
+            self._release_writer()
+
+
+log = MessageLog()
+
+
+@atexit.register
+def _flush_on_exit():
+    # Apply what this worker accepted, so a graceful restart leaves little to replay
+    if log._pid == os.getpid() and log._flush_fd is not None:
+        try:
+            with log._lock:
+                log.flush()
+        except Exception:
+            logger.exception('Flushing the message log at exit failed; it is replayed at startup')
@@ -0,0 +1,223 @@
+"""
+Request-level performance metrics for Tedris
+Every request is timed and labelled with its route rule (not the raw path,
+so /api/conversations/<int:conversation_id>/messages is one series), and
+records how many SQL statements it ran and how long they took, how long
+password hashing took and how large the response was. The statements are
+counted by an observer on db.PooledConnection, the hashing by one on
+hashing.HashService.
+
+GET /metrics serves everything in the Prometheus text format. The numbers
+are per worker process: with several gunicorn workers each scrape sees the
+worker that answered it, so scrape the workers separately or sum rates
+rather than reading absolute counts. METRICS_TOKEN, if set, must be sent
+as a Bearer token; METRICS_ENABLED=0 turns the whole layer off.
+
+Requests slower than METRICS_SLOW_REQUEST_MS (0 = never) are logged with
+the first SLOW_REQUEST_MAX_QUERIES statements they ran and their timings.
+"""
+
+import bisect
+import hmac
+import os
+import threading
+import time
+
+from flask import Response, g, has_app_context, request
+
+import db
+import hashing
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_SLOW_REQUEST_MS = float(os.environ.get('METRICS_SLOW_REQUEST_MS', 0))
+SLOW_REQUEST_MAX_QUERIES = 50
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Thread-safe fixed-bucket histogram, one series per label values tuple"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total, count)
+                      for labels, (counts, total, count) in sorted(self._series.items())]
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{_number(bound) if bound != "+Inf" else bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+request_latency = Histogram(
+    'tedris_http_request_duration_seconds', 'Time to produce a response, by route',
+    ('method', 'endpoint', 'status'), LATENCY_BUCKETS)
+request_queries = Histogram(
+    'tedris_http_request_queries', 'SQL statements run per request',
+    ('method', 'endpoint'), QUERY_COUNT_BUCKETS)
+request_sql_time = Histogram(
+    'tedris_http_request_sql_seconds', 'Time spent in SQL per request',
+    ('method', 'endpoint'), LATENCY_BUCKETS)
+response_size = Histogram(
+    'tedris_http_response_size_bytes', 'Response body size (streamed responses excluded)',
+    ('method', 'endpoint'), SIZE_BUCKETS)
+query_latency = Histogram(
+    'tedris_sql_statement_duration_seconds', 'Time of single SQL statements',
+    (), SQL_LATENCY_BUCKETS)
+hash_latency = Histogram(
+    'tedris_password_hash_duration_seconds', 'Password hashing and checking time, queueing included',
+    ('operation',), LATENCY_BUCKETS)
+
+HISTOGRAMS = (request_latency, request_queries, request_sql_time, response_size,
+              query_latency, hash_latency)
+
+# hashing.HashService function names -> operation label
+_HASH_OPERATIONS = {'hash_password': 'hash', 'check_password_hash': 'verify'}
+
+
+class RequestStats:
+    """What one request spent, collected on g while it runs"""
+
+    __slots__ = ('started', 'queries', 'sql_seconds', 'hash_seconds', 'statements')
+
+    def __init__(self, capture):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.hash_seconds = 0.0
+        # (sql, seconds) of the first statements, kept only for the slow-request log
+        self.statements = [] if capture else None
+
+
+def _current():
+    return g.get('request_stats') if has_app_context() else None
+
+
+def observe_query(sql, seconds):
+    query_latency.observe(seconds)
+    stats = _current()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.sql_seconds += seconds
+    if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_MAX_QUERIES:
+        stats.statements.append((sql, seconds))
+
+
+def observe_hash(operation, seconds):
+    hash_latency.observe(seconds, _HASH_OPERATIONS.get(operation, operation))
+    stats = _current()
+    if stats is not None:
+        stats.hash_seconds += seconds
+
+
+def render():
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _endpoint():
+    # The rule keeps label values bounded whatever paths clients ask for
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _log_slow(app, stats, elapsed, status):
+    statements = '\n'.join(f'  {seconds * 1000:8.2f} ms  {" ".join(sql.split())}'
+                           for sql, seconds in stats.statements)
+    if stats.queries > len(stats.statements):
+        statements += f'\n  ... {stats.queries - len(stats.statements)} more'
+    app.logger.warning(
+        'Slow request: %s %s -> %s in %.1f ms (%d queries, %.1f ms SQL, %.1f ms hashing)\n%s',
+        request.method, request.full_path.rstrip('?'), status, elapsed * 1000,
+        stats.queries, stats.sql_seconds * 1000, stats.hash_seconds * 1000, statements
+    )
+
+
+def metrics_view():
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+def init_app(app, enabled=METRICS_ENABLED, slow_request_ms=METRICS_SLOW_REQUEST_MS):
+    if not enabled:
+        return
+    db.query_observer = observe_query
+    hashing.hash_observer = observe_hash
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats(capture=slow_request_ms > 0)
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        method = request.method
+        endpoint = _endpoint()
+        request_latency.observe(elapsed, method, endpoint, str(response.status_code))
+        request_queries.observe(stats.queries, method, endpoint)
+        request_sql_time.observe(stats.sql_seconds, method, endpoint)
+        # Measuring a streamed body would buffer it; event streams have no
+        # size until they end, long after this runs
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = response.calculate_content_length()
+        if size is not None:
+            response_size.observe(size, method, endpoint)
+        if slow_request_ms > 0 and elapsed * 1000 >= slow_request_ms:
+            _log_slow(app, stats, elapsed, response.status_code)
+        return response
+
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,535 @@
+"""
+Versioned schema migrations for Tedris
+Each migration runs once, in order, and is recorded in schema_version
+"""
+
+import re
+
+import leaderboard
+import message_log
+import question_io
+import search
+import stats
+from db import write_transaction
+
+
+def _columns(conn, table):
+    return {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _initial_schema(conn):
+    """Tables as originally created by init_db()"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            full_name TEXT NOT NULL,
+            nni TEXT UNIQUE NOT NULL,
+            phone TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            user_category TEXT NOT NULL,
+            wilaya TEXT NOT NULL,
+            moughataa TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            is_online BOOLEAN DEFAULT FALSE,
+            last_seen TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user1_id) REFERENCES users (id),
+            FOREIGN KEY (user2_id) REFERENCES users (id),
+            UNIQUE(user1_id, user2_id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_read BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+            FOREIGN KEY (sender_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            question_ar TEXT NOT NULL,
+            question_fr TEXT NOT NULL,
+            answer_ar TEXT NOT NULL,
+            answer_fr TEXT NOT NULL,
+            explanation_ar TEXT,
+            explanation_fr TEXT,
+            difficulty INTEGER DEFAULT 1,
+            points INTEGER DEFAULT 100,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            game_type TEXT NOT NULL,
+            language_mode TEXT NOT NULL,
+            score INTEGER DEFAULT 0,
+            questions_answered INTEGER DEFAULT 0,
+            correct_answers INTEGER DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+def _align_schema_with_queries(conn):
+    """Bring the tables in line with the columns the routes actually use"""
+    # users: school and verification flag used by /api/users/search.
+    # Accounts are created without verification, so they default to verified.
+    user_columns = _columns(conn, 'users')
+    if 'school' not in user_columns:
+        conn.execute('ALTER TABLE users ADD COLUMN school TEXT')
+    if 'is_verified' not in user_columns:
+        conn.execute('ALTER TABLE users ADD COLUMN is_verified BOOLEAN DEFAULT TRUE')
+
+    # conversations: participant columns plus last message bookkeeping.
+    # Rebuilt rather than altered so updated_at gets a proper default.
+    if 'participant1_id' not in _columns(conn, 'conversations'):
+        conn.execute('''
+            CREATE TABLE conversations_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                participant1_id INTEGER NOT NULL,
+                participant2_id INTEGER NOT NULL,
+                last_message_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (participant1_id) REFERENCES users (id),
+                FOREIGN KEY (participant2_id) REFERENCES users (id),
+                FOREIGN KEY (last_message_id) REFERENCES messages (id),
+                UNIQUE(participant1_id, participant2_id)
+            )
+        ''')
+        conn.execute('''
+            INSERT INTO conversations_new (id, participant1_id, participant2_id, created_at, updated_at)
+            SELECT id, MIN(user1_id, user2_id), MAX(user1_id, user2_id), created_at, created_at
+            FROM conversations
+        ''')
+        conn.execute('DROP TABLE conversations')
+        conn.execute('ALTER TABLE conversations_new RENAME TO conversations')
+
+    # messages: the routes use created_at
+    if 'created_at' not in _columns(conn, 'messages'):
+        conn.execute('ALTER TABLE messages RENAME COLUMN timestamp TO created_at')
+    conn.execute('''
+        UPDATE conversations
+        SET last_message_id = (SELECT MAX(id) FROM messages WHERE conversation_id = conversations.id)
+        WHERE last_message_id IS NULL
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS math_jeopardy_questions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            category TEXT NOT NULL,
+            points INTEGER NOT NULL DEFAULT 100,
+            question_ar TEXT NOT NULL,
+            question_fr TEXT NOT NULL,
+            answer_ar TEXT NOT NULL,
+            answer_fr TEXT NOT NULL,
+            explanation_ar TEXT,
+            explanation_fr TEXT,
+            difficulty_level INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schools (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            wilaya TEXT,
+            moughataa TEXT,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _add_indexes(conn):
+    """Secondary indexes for the chat, search and game queries"""
+    # Message history of a conversation, in order
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_created
+        ON messages (conversation_id, created_at)
+    ''')
+    # Unread counts / mark-as-read: both equality columns first, then the
+    # sender_id != ? range, so the index covers the whole predicate
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_unread
+        ON messages (conversation_id, is_read, sender_id)
+    ''')
+    # UNIQUE(participant1_id, participant2_id) already covers lookups that
+    # start with participant1_id; this one serves "participant2_id = ?"
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_participant2
+        ON conversations (participant2_id, participant1_id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_jeopardy_category_points
+        ON math_jeopardy_questions (category, points)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_game_sessions_user
+        ON game_sessions (user_id, started_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_schools_active_name
+        ON schools (is_active, name)
+    ''')
+
+
+def _message_keyset_index(conn):
+    """Index for paging messages by id within a conversation"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_id
+        ON messages (conversation_id, id)
+    ''')
+    # History is no longer ordered by created_at, so this one only costs writes
+    conn.execute('DROP INDEX IF EXISTS idx_messages_conversation_created')
+
+
+def _events_table(conn):
+    """Event log shared between workers by the 'sqlite' events backend"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at)')
+
+
+def backfill_unread_counters(conn):
+    """Recompute every conversation's per-participant unread counters from messages"""
+    cursor = conn.execute('''
+        UPDATE conversations SET
+            participant1_unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE conversation_id = conversations.id AND is_read = FALSE
+                  AND sender_id != conversations.participant1_id
+            ),
+            participant2_unread = (
+                SELECT COUNT(*) FROM messages
+                WHERE conversation_id = conversations.id AND is_read = FALSE
+                  AND sender_id != conversations.participant2_id
+            )
+    ''')
+    return cursor.rowcount
+
+
+def _unread_counters(conn):
+    """Denormalized unread counters, maintained by send_message() and get_messages()"""
+    columns = _columns(conn, 'conversations')
+    if 'participant1_unread' not in columns:
+        conn.execute('ALTER TABLE conversations ADD COLUMN participant1_unread INTEGER NOT NULL DEFAULT 0')
+    if 'participant2_unread' not in columns:
+        conn.execute('ALTER TABLE conversations ADD COLUMN participant2_unread INTEGER NOT NULL DEFAULT 0')
+    backfill_unread_counters(conn)
+
+
+def _admin_listing_indexes(conn):
+    """Indexes for the admin user listing, newest first, with optional filters
+
+    The rowid is implicitly the last column of every index, which gives the
+    (created_at, id) keyset order.
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_category_created
+        ON users (user_category, created_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_wilaya_created
+        ON users (wilaya, created_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_region_created
+        ON users (wilaya, moughataa, created_at)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_online_created
+        ON users (is_online, created_at)
+    ''')
+
+
+def add_version_triggers(conn, table):
+    """Bump resource_versions[table] on every insert, update and delete of table
+
+    Lets per-worker caches of the table notice changes made by any process.
+    """
+    conn.execute('INSERT OR IGNORE INTO resource_versions (name, version) VALUES (?, 0)', (table,))
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE resource_versions SET version = version + 1 WHERE name = '{table}';
+            END
+        ''')
+
+
+def _question_bank_versions(conn):
+    """Version counter for the in-memory Math Jeopardy question bank"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS resource_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    add_version_triggers(conn, 'math_jeopardy_questions')
+
+
+def _game_session_state(conn):
+    """Per-question answers and best streak for checkpointed game sessions"""
+    columns = _columns(conn, 'game_sessions')
+    if 'answers' not in columns:
+        conn.execute('ALTER TABLE game_sessions ADD COLUMN answers TEXT')
+    if 'best_streak' not in columns:
+        conn.execute('ALTER TABLE game_sessions ADD COLUMN best_streak INTEGER DEFAULT 0')
+
+
+def _game_session_boards(conn):
+    """Question ids dealt to each game session"""
+    if 'board_questions' not in _columns(conn, 'game_sessions'):
+        conn.execute('ALTER TABLE game_sessions ADD COLUMN board_questions TEXT')
+
+
+def _game_session_owners(conn):
+    """Worker (pid) holding each live game session"""
+    if 'owner' not in _columns(conn, 'game_sessions'):
+        conn.execute('ALTER TABLE game_sessions ADD COLUMN owner INTEGER')
+
+
+def _admin_flag(conn):
+    """Administrators, the only users allowed on /admin and /api/admin/*"""
+    if 'is_admin' not in _columns(conn, 'users'):
+        conn.execute('ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT FALSE')
+
+
+def _question_content_hashes(conn):
+    """Content hash for deduplicating imported questions (see question_io.py)"""
+    if 'content_hash' not in _columns(conn, 'math_jeopardy_questions'):
+        conn.execute('ALTER TABLE math_jeopardy_questions ADD COLUMN content_hash TEXT')
+    question_io.backfill_content_hashes(conn)
+    # Questions entered twice before hashing keep their first copy's hash only
+    conn.execute('''
+        UPDATE math_jeopardy_questions SET content_hash = NULL
+        WHERE id NOT IN (SELECT MIN(id) FROM math_jeopardy_questions GROUP BY content_hash)
+    ''')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_questions_content_hash
+        ON math_jeopardy_questions (content_hash)
+    ''')
+
+
+def _school_versions(conn):
+    """Version counter for the cached school lists (see reference_data.py)"""
+    add_version_triggers(conn, 'schools')
+
+
+# (version, description, function) - append only, never renumber
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'align schema with queries', _align_schema_with_queries),
+    (3, 'chat and game indexes', _add_indexes),
+    (4, 'message keyset pagination index', _message_keyset_index),
+    (5, 'events table', _events_table),
+    (6, 'unread counters', _unread_counters),
+    (7, 'user search index', search.create_index),
+    (8, 'admin statistics counters', stats.create_tables),
+    (9, 'admin user listing indexes', _admin_listing_indexes),
+    (10, 'question bank versioning', _question_bank_versions),
+    (11, 'game session state', _game_session_state),
+    (12, 'leaderboards', leaderboard.create_tables),
+    (13, 'game session boards', _game_session_boards),
+    (14, 'question content hashes', _question_content_hashes),
+    (15, 'school versioning', _school_versions),
+    (16, 'message log position', message_log.create_tables),
+    (17, 'leaderboard change versions', leaderboard.add_change_versions),
+    (18, 'game session owners', _game_session_owners),
+    (19, 'administrator flag', _admin_flag),
+]
+
+
+def current_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def pending(conn):
+    """Whether any migration has yet to be applied"""
+    return current_version(conn) < MIGRATIONS[-1][0]
+
+
+def migrate(conn):
+    """Apply pending migrations, each in its own transaction
+
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if version <= current_version(conn):
+            continue
+        with write_transaction(conn):
+            # Re-check under the write lock in case another process got here first
+            done = conn.execute(
+                'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+            ).fetchone()
+            if done:
+                continue
+            apply(conn)
+            conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+        applied.append(version)
+    return applied
+
+
+# Hot queries that must be served by an index lookup. Each entry is
+# (name, sql, params); a plan step that scans a table or index fails the check.
+QUERY_PLAN_CHECKS = [
+    ('get_conversations', '''
+        SELECT c.id, u.full_name, m.content,
+            CASE WHEN c.participant1_id = ? THEN c.participant1_unread ELSE c.participant2_unread END
+        FROM conversations c
+        JOIN users u ON u.id = CASE WHEN c.participant1_id = ? THEN c.participant2_id ELSE c.participant1_id END
+        LEFT JOIN messages m ON m.id = c.last_message_id
+        WHERE c.participant1_id = ? OR c.participant2_id = ?
+        ORDER BY c.updated_at DESC
+    ''', (1, 1, 1, 1)),
+    ('get_messages_latest', '''
+        SELECT m.id, m.content, u.full_name
+        FROM messages m
+        JOIN users u ON u.id = m.sender_id
+        WHERE m.conversation_id = ? AND m.id < ?
+        ORDER BY m.id DESC
+        LIMIT ?
+    ''', (1, 1000, 51)),
+    ('get_messages_after', '''
+        SELECT m.id, m.content, u.full_name
+        FROM messages m
+        JOIN users u ON u.id = m.sender_id
+        WHERE m.conversation_id = ? AND m.id > ?
+        ORDER BY m.id ASC
+        LIMIT ?
+    ''', (1, 1000, 51)),
+    ('search_users', '''
+        SELECT u.id, u.full_name
+        FROM (
+            SELECT rowid, bm25(users_fts, 10.0, 5.0, 1.0) AS score
+            FROM users_fts
+            WHERE users_fts MATCH ?
+            ORDER BY score
+            LIMIT ?
+        ) f
+        JOIN users u ON u.id = f.rowid
+        WHERE u.id != ? AND u.is_verified = TRUE
+        ORDER BY f.score
+        LIMIT 20
+    ''', ('"ahmed"*', 1000, 1)),
+    ('admin_users', '''
+        SELECT id, full_name, created_at FROM users
+        WHERE (created_at, id) < (?, ?)
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', ('2030-01-01 00:00:00', 1, 51)),
+    ('admin_users_by_category', '''
+        SELECT id, full_name, created_at FROM users
+        WHERE user_category = ? AND (created_at, id) < (?, ?)
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', ('طالب', '2030-01-01 00:00:00', 1, 51)),
+    ('admin_users_by_region', '''
+        SELECT id, full_name, created_at FROM users
+        WHERE wilaya = ? AND moughataa = ?
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', ('آدرار', 'أطار', 51)),
+    ('find_conversation', '''
+        SELECT id FROM conversations
+        WHERE (participant1_id = ? AND participant2_id = ?)
+           OR (participant1_id = ? AND participant2_id = ?)
+    ''', (1, 2, 2, 1)),
+    ('leaderboard_board', '''
+        SELECT user_id, score, games, correct_answers FROM leaderboard_scores
+        WHERE board = ?
+    ''', ('global',)),
+    ('leaderboard_changes', '''
+        SELECT board, user_id, score, games, correct_answers
+        FROM leaderboard_scores INDEXED BY idx_leaderboard_scores_version
+        WHERE version > ?
+    ''', (1,)),
+    ('active_schools', '''
+        SELECT name FROM schools WHERE is_active = 1 ORDER BY name
+    ''', ()),
+]
+
+# "SCAN t" reads every row of t, "SCAN t USING [COVERING] INDEX" every entry
+# of an index; both grow with the table. Lookups show up as "SEARCH t ...",
+# and full-text MATCH queries as "SCAN t VIRTUAL TABLE INDEX ..."
+_FULL_SCAN = re.compile(r'^SCAN (\w+)(?!.* VIRTUAL TABLE INDEX )')
+# Scans of a subquery's (already bounded) result are fine
+_SUBQUERY = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (\w+)')
+
+# Keyset-paginated queries, whose order must come from the index they
+# search: a temporary b-tree means every matching row is read and sorted
+# before LIMIT applies, which is what paging by key exists to avoid
+KEYSET_PAGINATED = {
+    'get_messages_latest', 'get_messages_after',
+    'admin_users', 'admin_users_by_category', 'admin_users_by_region',
+}
+
+
+def check_query_plans(conn, checks=None):
+    """Run EXPLAIN QUERY PLAN over the hot queries
+
+    Returns a list of (name, plan detail) for every scan found, and every
+    sort of a KEYSET_PAGINATED query; an empty list means every query is
+    served by index lookups in index order.
+    """
+    problems = []
+    for name, sql, params in checks or QUERY_PLAN_CHECKS:
+        subqueries = set()
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[3]
+            subquery = _SUBQUERY.match(detail)
+            if subquery:
+                subqueries.add(subquery.group(1))
+                continue
+            scan = _FULL_SCAN.match(detail)
+            if scan and scan.group(1) not in subqueries:
+                problems.append((name, detail))
+            elif name in KEYSET_PAGINATED and detail.startswith('USE TEMP B-TREE'):
+                problems.append((name, detail))
+    return problems
@@ -0,0 +1,54 @@
+"""
+Text normalization shared by user search and answer matching
+Folds the spelling variants that Arabic and French users type
+interchangeably so that they compare equal.
+"""
+
+import re
+import unicodedata
+
+# Harakat, tanween, shadda, sukun, superscript alef and tatweel
+_ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+
+_ARABIC_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ؤ': 'و', 'ئ': 'ي', 'ى': 'ي',
+    'ة': 'ه',
+})
+
+# Eastern Arabic (٠-٩) and Persian (۰-۹) digits, Arabic decimal/thousands marks
+_DIGITS = str.maketrans({
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+    **{chr(0x06f0 + i): str(i) for i in range(10)},
+    '٫': '.', '٬': ',',
+})
+
+_SPACES = re.compile(r'\s+')
+
+
+def fold_arabic(text):
+    """Drop diacritics and unify alef/hamza/ta marbuta/alef maqsura forms"""
+    return _ARABIC_MARKS.sub('', text).translate(_ARABIC_LETTERS)
+
+
+def fold_digits(text):
+    """Eastern Arabic digits to ASCII"""
+    return text.translate(_DIGITS)
+
+
+def fold_accents(text):
+    """Strip Latin accents (é -> e, ç -> c) without touching Arabic letters"""
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(
+        ch for ch in decomposed
+        if not (unicodedata.combining(ch) and '\u0300' <= ch <= '\u036f')
+    )
+
+
+def normalize_text(text):
+    """Lowercased, folded, whitespace-collapsed form of text"""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text)
+    text = fold_accents(fold_digits(fold_arabic(text)))
+    return _SPACES.sub(' ', text).strip().lower()
@@ -0,0 +1,177 @@
+"""
+Presence tracking for Tedris
+Online state lives in memory and is driven by heartbeats; last_seen is
+written to the users table in periodic batches instead of one UPDATE per
+event. Users seen by another worker are judged from the persisted
+last_seen, which is at most one flush interval behind.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import db
+
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 90))
+PRESENCE_FLUSH_INTERVAL = int(os.environ.get('PRESENCE_FLUSH_INTERVAL', 30))
+
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+logger = logging.getLogger(__name__)
+
+
+def _to_timestamp(epoch):
+    """Epoch seconds to the UTC format SQLite's CURRENT_TIMESTAMP uses"""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime(_TIMESTAMP_FORMAT)
+
+
+def _from_timestamp(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:19], _TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class PresenceTracker:
+    """Per-worker view of who is online, flushed to users.last_seen in batches"""
+
+    def __init__(self, ttl=PRESENCE_TTL, flush_interval=PRESENCE_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._logged_out = set()
+        self._dirty = set()
+        # Updates a failed flush couldn't write, by user; users who went
+        # offline are gone from _last_seen, so they can't be recomputed
+        self._retry = {}
+        self._pid = None
+
+    def _ensure_started(self):
+        # The flusher thread doesn't survive a fork, so start one per worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._last_seen = {}
+            self._logged_out = set()
+            self._dirty = set()
+            self._retry = {}
+        thread = threading.Thread(target=self._run, name='presence-flush', daemon=True)
+        thread.start()
+
+    def touch(self, user_id):
+        """Record activity (login, heartbeat) for a user"""
+        self._ensure_started()
+        with self._lock:
+            self._last_seen[user_id] = time.time()
+            self._logged_out.discard(user_id)
+            self._dirty.add(user_id)
+
+    def mark_offline(self, user_id):
+        """Record an explicit logout"""
+        self._ensure_started()
+        with self._lock:
+            self._last_seen[user_id] = time.time()
+            self._logged_out.add(user_id)
+            self._dirty.add(user_id)
+
+    def _online_at(self, seen, now):
+        return seen is not None and now - seen < self.ttl
+
+    def status(self, user_id, persisted_last_seen=None, persisted_online=True):
+        """(is_online, last_seen) for a user
+
+        persisted_last_seen/persisted_online are the users.last_seen and
+        is_online columns, used for users this worker hasn't seen.
+        """
+        now = time.time()
+        with self._lock:
+            seen = self._last_seen.get(user_id)
+            logged_out = user_id in self._logged_out
+        if seen is not None:
+            return (not logged_out and self._online_at(seen, now)), _to_timestamp(seen)
+
+        # Another worker may be serving this user; its flushes lag by up to one interval
+        persisted = _from_timestamp(persisted_last_seen)
+        is_online = (bool(persisted_online) and persisted is not None
+                     and now - persisted < self.ttl + self.flush_interval)
+        return is_online, persisted_last_seen
+
+    def is_online(self, user_id, persisted_last_seen=None, persisted_online=True):
+        return self.status(user_id, persisted_last_seen, persisted_online)[0]
+
+    def flush(self):
+        """Write pending last_seen/is_online changes in one transaction"""
+        now = time.time()
+        with self._lock:
+            updates = {}
+            for user_id in self._dirty:
+                seen = self._last_seen.get(user_id)
+                if seen is None:
+                    continue
+                online = user_id not in self._logged_out and self._online_at(seen, now)
+                updates[user_id] = (online, _to_timestamp(seen), user_id)
+            self._dirty = set()
+
+            # Users whose heartbeats stopped go offline in the table too
+            for user_id, seen in list(self._last_seen.items()):
+                if self._online_at(seen, now):
+                    continue
+                if user_id not in self._logged_out and user_id not in updates:
+                    updates[user_id] = (False, _to_timestamp(seen), user_id)
+                del self._last_seen[user_id]
+                self._logged_out.discard(user_id)
+
+            # What a failed flush left, unless newer state was computed above
+            for user_id, update in self._retry.items():
+                updates.setdefault(user_id, update)
+            self._retry = {}
+            updates = list(updates.values())
+
+        if not updates:
+            return 0
+
+        conn = db.pool.acquire()
+        try:
+            with db.write_transaction(conn):
+                conn.executemany(
+                    'UPDATE users SET is_online = ?, last_seen = ? WHERE id = ?',
+                    updates
+                )
+        except Exception:
+            # Keep the changes, offline transitions included, for the next attempt
+            with self._lock:
+                for update in updates:
+                    self._retry.setdefault(update[2], update)
+            raise
+        finally:
+            conn.close()
+        return len(updates)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing presence failed; retrying')
+
+
+tracker = PresenceTracker()
+
+
+@atexit.register
+def _flush_on_exit():
+    if tracker._pid == os.getpid():
+        try:
+            tracker.flush()
+        except Exception:
+            logger.exception('Flushing presence at exit failed')
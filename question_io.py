@@ -0,0 +1,206 @@
+"""
+Bulk import and export of the Math Jeopardy question bank
+Files are CSV (with a header row) or JSON Lines, using the column names of
+math_jeopardy_questions. Rows are streamed and inserted QUESTION_BATCH_SIZE
+at a time, with one executemany per write transaction. Every question
+carries a content hash of its normalized text; a unique index on it lets
+INSERT OR IGNORE drop duplicates, whether they are already in the bank or
+repeated within the file.
+"""
+
+import csv
+import hashlib
+import json
+import re
+import time
+
+from db import write_transaction
+from normalize import normalize_text
+
+QUESTION_BATCH_SIZE = 1000
+# Invalid rows listed in a report; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+FIELDS = ('category', 'points', 'question_ar', 'question_fr', 'answer_ar', 'answer_fr',
+          'explanation_ar', 'explanation_fr', 'difficulty_level')
+REQUIRED_FIELDS = ('category', 'points', 'question_ar', 'question_fr', 'answer_ar', 'answer_fr')
+DIFFICULTY_LEVELS = range(1, 6)
+FORMATS = ('csv', 'jsonl')
+
+_ARABIC = re.compile('[؀-ۿ]')
+# Latin letters with accents, leaving out × and ÷
+_LATIN = re.compile('[A-Za-zÀ-ÖØ-öø-ɏ]')
+# Two or more letters in a row: text, as opposed to a formula with a variable
+_WORD = re.compile(r'[^\W\d_]{2,}')
+
+
+class QuestionError(ValueError):
+    """A row that can't be imported"""
+
+
+def content_hash(category, question_ar, question_fr, answer_ar, answer_fr):
+    """Hash identifying a question regardless of spacing, case and diacritics"""
+    key = '\x1f'.join(normalize_text(value) for value in
+                      (category, question_ar, question_fr, answer_ar, answer_fr))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def backfill_content_hashes(conn):
+    """Hash questions that don't have one yet"""
+    rows = conn.execute('''
+        SELECT id, category, question_ar, question_fr, answer_ar, answer_fr
+        FROM math_jeopardy_questions WHERE content_hash IS NULL
+    ''').fetchall()
+    conn.executemany(
+        'UPDATE math_jeopardy_questions SET content_hash = ? WHERE id = ?',
+        [(content_hash(row['category'], row['question_ar'], row['question_fr'],
+                       row['answer_ar'], row['answer_fr']), row['id']) for row in rows]
+    )
+    return len(rows)
+
+
+def validate(record):
+    """Row dict -> insert tuple; raises QuestionError"""
+    values = {}
+    for field in FIELDS:
+        value = record.get(field)
+        values[field] = value.strip() if isinstance(value, str) else value
+
+    missing = [field for field in REQUIRED_FIELDS if values[field] in (None, '')]
+    if missing:
+        raise QuestionError(f'missing {", ".join(missing)}')
+
+    try:
+        points = int(values['points'])
+    except (TypeError, ValueError):
+        raise QuestionError(f'points is not a number: {values["points"]!r}') from None
+    if points <= 0:
+        raise QuestionError(f'points must be positive: {points}')
+
+    difficulty = values['difficulty_level']
+    try:
+        difficulty = int(difficulty) if difficulty not in (None, '') else 1
+    except (TypeError, ValueError):
+        raise QuestionError(f'difficulty_level is not a number: {difficulty!r}') from None
+    if difficulty not in DIFFICULTY_LEVELS:
+        raise QuestionError(f'difficulty_level must be 1-5: {difficulty}')
+
+    # Each language column must actually be in its language, when it has words at
+    # all: "5 × 3 = ?" or "x + 2 = 5" is the same in both
+    if _WORD.search(values['question_ar']) and not _ARABIC.search(values['question_ar']):
+        raise QuestionError('question_ar has no Arabic text')
+    if _ARABIC.search(values['question_fr']) or (_WORD.search(values['question_fr'])
+                                                 and not _LATIN.search(values['question_fr'])):
+        raise QuestionError('question_fr is not French text')
+    if _ARABIC.search(values['answer_fr']):
+        raise QuestionError('answer_fr contains Arabic text')
+    if values['explanation_fr'] and _ARABIC.search(values['explanation_fr']):
+        raise QuestionError('explanation_fr contains Arabic text')
+
+    return (values['category'], points, values['question_ar'], values['question_fr'],
+            values['answer_ar'], values['answer_fr'],
+            values['explanation_ar'] or None, values['explanation_fr'] or None, difficulty,
+            content_hash(values['category'], values['question_ar'], values['question_fr'],
+                         values['answer_ar'], values['answer_fr']))
+
+
+def detect_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_records(stream, fmt):
+    """Yield (line number, row dict) from a CSV or JSONL stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, QuestionError(f'invalid JSON: {e}')
+            continue
+        if not isinstance(record, dict):
+            record = QuestionError('not a JSON object')
+        yield line_number, record
+
+
+class ImportReport:
+    """Counters and the first invalid rows of one import"""
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+
+def _insert_batch(conn, batch, report):
+    with write_transaction(conn):
+        cursor = conn.executemany('''
+            INSERT OR IGNORE INTO math_jeopardy_questions
+                (category, points, question_ar, question_fr, answer_ar, answer_fr,
+                 explanation_ar, explanation_fr, difficulty_level, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+    # rowcount leaves out the rows OR IGNORE skipped
+    report.inserted += cursor.rowcount
+    report.duplicates += len(batch) - cursor.rowcount
+
+
+def import_questions(conn, stream, fmt, batch_size=QUESTION_BATCH_SIZE, dry_run=False):
+    """Validate and insert every question in stream; returns an ImportReport"""
+    report = ImportReport()
+    batch = []
+    for line_number, record in read_records(stream, fmt):
+        report.read += 1
+        try:
+            if isinstance(record, Exception):
+                raise record
+            batch.append(validate(record))
+        except QuestionError as e:
+            report.invalid += 1
+            if len(report.errors) < MAX_REPORTED_ERRORS:
+                report.errors.append((line_number, str(e)))
+            continue
+        if len(batch) >= batch_size:
+            if not dry_run:
+                _insert_batch(conn, batch, report)
+            batch = []
+    if batch and not dry_run:
+        _insert_batch(conn, batch, report)
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+
+def export_questions(conn, stream, fmt, batch_size=QUESTION_BATCH_SIZE):
+    """Write the question bank to stream in import format; returns the row count"""
+    cursor = conn.execute(f'''
+        SELECT {", ".join(FIELDS)} FROM math_jeopardy_questions ORDER BY id
+    ''')
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            if writer:
+                writer.writerow(tuple(row))
+            else:
+                stream.write(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n')
+        count += len(rows)
+    return count
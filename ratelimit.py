@@ -0,0 +1,94 @@
+"""
+In-memory sliding-window rate limiting
+Each limiter remembers the timestamps of recent attempts per key (a phone
+number, a client IP) and refuses a new one once limit attempts fall within
+the last window seconds. State is per worker, so with N workers a client
+can get at most N times the limit through; that is enough to keep
+brute-force bursts from queueing up password hashes.
+
+Many users can share one address: a school's NAT puts a classroom behind
+it, and behind a reverse proxy every client has the proxy's address
+unless TRUSTED_PROXIES is set (see app.py). So the login limit per IP
+counts failed attempts only, and is generous; the per-phone limits are
+what stop guessing at one account.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+LOGIN_PHONE_LIMIT = int(os.environ.get('LOGIN_PHONE_LIMIT', 5))
+# Failed logins only
+LOGIN_IP_LIMIT = int(os.environ.get('LOGIN_IP_LIMIT', 100))
+LOGIN_WINDOW = int(os.environ.get('LOGIN_WINDOW', 300))
+
+# Forgotten-password resets and registrations hash a password too
+PASSWORD_RESET_LIMIT = int(os.environ.get('PASSWORD_RESET_LIMIT', 5))
+PASSWORD_RESET_IP_LIMIT = int(os.environ.get('PASSWORD_RESET_IP_LIMIT', 30))
+REGISTER_IP_LIMIT = int(os.environ.get('REGISTER_IP_LIMIT', 20))
+ACCOUNT_WINDOW = int(os.environ.get('ACCOUNT_WINDOW', 3600))
+
+# Keys with no recent attempts are dropped every this many calls
+_SWEEP_EVERY = 1000
+
+
+class SlidingWindowLimiter:
+    """At most limit attempts per key within any window seconds"""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._attempts = {}
+        self._calls = 0
+
+    def hit(self, key):
+        """Record an attempt; returns 0 if allowed, else seconds until it would be"""
+        return self._attempt(key, record=True)
+
+    def check(self, key):
+        """Like hit(), without recording anything; pair with record()"""
+        return self._attempt(key, record=False)
+
+    def record(self, key):
+        """Count an attempt that check() let through (a failed login, say)"""
+        now = time.monotonic()
+        with self._lock:
+            self._attempts.setdefault(key, deque()).append(now)
+
+    def _attempt(self, key, record):
+        now = time.monotonic()
+        with self._lock:
+            self._calls += 1
+            if self._calls % _SWEEP_EVERY == 0:
+                self._sweep(now)
+
+            attempts = self._attempts.get(key)
+            if attempts is None:
+                if record:
+                    self._attempts[key] = deque([now])
+                return 0
+            while attempts and now - attempts[0] >= self.window:
+                attempts.popleft()
+            if len(attempts) >= self.limit:
+                return self.window - (now - attempts[0])
+            if record:
+                attempts.append(now)
+            return 0
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _sweep(self, now):
+        for key in [key for key, attempts in self._attempts.items()
+                    if not attempts or now - attempts[-1] >= self.window]:
+            del self._attempts[key]
+
+
+login_by_phone = SlidingWindowLimiter(LOGIN_PHONE_LIMIT, LOGIN_WINDOW)
+login_failures_by_ip = SlidingWindowLimiter(LOGIN_IP_LIMIT, LOGIN_WINDOW)
+password_reset_by_phone = SlidingWindowLimiter(PASSWORD_RESET_LIMIT, ACCOUNT_WINDOW)
+password_reset_by_ip = SlidingWindowLimiter(PASSWORD_RESET_IP_LIMIT, ACCOUNT_WINDOW)
+register_by_ip = SlidingWindowLimiter(REGISTER_IP_LIMIT, ACCOUNT_WINDOW)
@@ -0,0 +1,254 @@
+"""
+Reference data for Tedris: wilayas, moughataas, user categories, schools
+The geographic hierarchy is defined once here, in Arabic and French. The
+Arabic names are what forms submit and what registration validates
+against. JSON payloads are serialized once, with a strong ETag each, so
+the endpoints serving them only compare ETags and copy bytes.
+
+Schools come from the schools table. The active ones are kept in memory
+(SchoolCatalog), sorted and indexed by word prefix per wilaya and
+moughataa, and reloaded whenever the table's version in resource_versions
+changes (checked at most every REFERENCE_VERSION_CHECK seconds). The
+bundle embeds the whole list; /api/schools serves filtered pages of it.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+import threading
+import time
+
+import versions
+from normalize import normalize_text
+
+REFERENCE_VERSION_CHECK = float(os.environ.get('REFERENCE_VERSION_CHECK', 30))
+
+SCHOOLS_PAGE_SIZE = 50
+SCHOOLS_MAX_PAGE_SIZE = 200
+SCHOOLS_MAX_AGE = 300
+
+# (code, Arabic, French, [(Arabic, French) moughataas])
+_WILAYAS = [
+    ('nouakchott_north', 'نواكشوط الشمالية', 'Nouakchott-Nord',
+     [('تفرغ زينة', 'Tevragh Zeina'), ('دار النعيم', 'Dar Naïm'), ('توجونين', 'Toujounine')]),
+    ('nouakchott_west', 'نواكشوط الغربية', 'Nouakchott-Ouest',
+     [('كرفور', 'Carrefour'), ('تيارت', 'Teyarett'), ('الميناء', 'El Mina')]),
+    ('nouakchott_south', 'نواكشوط الجنوبية', 'Nouakchott-Sud',
+     [('الرياض', 'Riyadh'), ('عرفات', 'Arafat'), ('الخير', 'El Khair')]),
+    ('hodh_chargui', 'الحوض الشرقي', 'Hodh Ech Chargui',
+     [('النعمة', 'Néma'), ('الباسكنو', 'Bassikounou'), ('فصاله', 'Fassala'),
+      ('أمجريه الجديدة', 'Amourj El Jedida')]),
+    ('hodh_gharbi', 'الحوض الغربي', 'Hodh El Gharbi',
+     [('العيون', 'Aïoun'), ('تمبدغه', 'Timbédra'), ('كوبني', 'Kobenni'), ('بوتلميت', 'Boutilimit')]),
+    ('assaba', 'العصابة', 'Assaba',
+     [('كيفه', 'Kiffa'), ('العصابة', 'Assaba'), ('بركيول', 'Barkéol'), ('قورو', 'Guérou')]),
+    ('gorgol', 'كوركول', 'Gorgol',
+     [('سيلبابي', 'Sélibaby'), ('مبوت', 'Mbout'), ('يارل', 'Yarel'), ('فولو فولبه', 'Foulo Foulbé')]),
+    ('brakna', 'البراكنة', 'Brakna',
+     [('ألاك', 'Aleg'), ('بوكي', 'Boghé'), ('مال', 'Mâle'), ('مقطع لحجار', 'Magta-Lahjar'),
+      ('أفديرك', 'Fdérik')]),
+    ('trarza', 'الترارزة', 'Trarza',
+     [('روصو', 'Rosso'), ('المذرذرة', 'Méderdra'), ('بوتيليميت', 'Boutilimit'),
+      ('كور ماصين', 'Keur Macène')]),
+    ('adrar', 'آدرار', 'Adrar',
+     [('أطار', 'Atar'), ('شنقيط', 'Chinguetti'), ('وادان', 'Ouadane'), ('أوجفت', 'Aoujeft')]),
+    ('dakhlet_nouadhibou', 'داخلت نواديبو', 'Dakhlet Nouadhibou',
+     [('نواديبو', 'Nouadhibou')]),
+    ('tagant', 'تكانت', 'Tagant',
+     [('تيجكجه', 'Tidjikja'), ('تامشكط', 'Tamchekett'), ('بومديد', 'Boumdeid'), ('كنكوصه', 'Kankossa')]),
+    ('guidimakha', 'كيدي ماغا', 'Guidimakha',
+     [('كيدي ماغا', 'Guidimakha'), ('جعوار', 'Djaouar'), ('كوبني', 'Kobenni'), ('نيملان', 'Nimlane')]),
+    ('inchiri', 'إنشيري', 'Inchiri',
+     [('أكجوجت', 'Akjoujt'), ('بنشاب', 'Bennichab'), ('زويرات', 'Zouérate')]),
+    ('tiris_zemmour', 'تيرس زمور', 'Tiris Zemmour',
+     [('بير أم كرين', 'Bir Moghreïn'), ('الكليبه', 'El Guelb'), ('زويرات', 'Zouérate')]),
+]
+
+# (Arabic, French)
+_USER_CATEGORIES = [
+    ('طالب', 'Élève'),
+    ('معلم', 'Instituteur'),
+    ('أستاذ', 'Professeur'),
+    ('مدير مدرسة', "Directeur d'école"),
+    ('مفتش تربوي', 'Inspecteur pédagogique'),
+    ('إداري', 'Administratif'),
+    ('ولي أمر', "Parent d'élève"),
+]
+
+# Lookups used by validation
+WILAYAS_MOUGHATAAS = {ar: [moughataa for moughataa, _ in moughataas]
+                      for _, ar, _, moughataas in _WILAYAS}
+USER_CATEGORIES = [ar for ar, _ in _USER_CATEGORIES]
+
+# Cache-Control max-age of the reference endpoints; bundle URLs carrying the
+# current version (?v=) are immutable and cached for a year
+REFERENCE_MAX_AGE = 86400
+REFERENCE_IMMUTABLE_MAX_AGE = 31536000
+
+
+class Payload:
+    """Serialized JSON body with its strong ETag"""
+
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, data):
+        self.body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+
+
+def _moughataa_entries(moughataas):
+    return [{'value': ar, 'label_ar': ar, 'label_fr': fr} for ar, fr in moughataas]
+
+
+def _wilaya_entries():
+    return [{
+        'value': ar,
+        'code': code,
+        'label_ar': ar,
+        'label_fr': fr,
+        'moughataas': _moughataa_entries(moughataas)
+    } for code, ar, fr, moughataas in _WILAYAS]
+
+
+def _build_moughataa_payloads():
+    payloads = {}
+    for code, ar, fr, moughataas in _WILAYAS:
+        payload = Payload(_moughataa_entries(moughataas))
+        # Reachable by Arabic name, French name or code
+        for key in (ar, fr, code):
+            payloads[key] = payload
+    return payloads
+
+
+# Built once at import: the geography never changes while the app runs
+_MOUGHATAAS = _build_moughataa_payloads()
+_EMPTY = Payload([])
+
+
+def moughataas(wilaya):
+    """Payload listing one wilaya's moughataas (empty list if unknown)"""
+    return _MOUGHATAAS.get(wilaya, _EMPTY)
+
+
+class SchoolCatalog:
+    """Active schools in memory, filterable by region and searchable by prefix"""
+
+    def __init__(self, check_interval=REFERENCE_VERSION_CHECK):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # (schools in name order,
+        #  (wilaya, moughataa) -> positions in schools, '' matching any
+        #  (either may be given alone),
+        #  (wilaya, moughataa) -> sorted [(word, position)] for prefix search)
+        # swapped as one tuple so readers never mix two loads
+        self._state = ([], {}, {})
+
+    @property
+    def version(self):
+        return self._version
+
+    def refresh(self, conn):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._version is not None and now - self._checked_at < self.check_interval:
+                return
+            version = versions.get(conn, 'schools')
+            if version != self._version:
+                self._load(conn)
+                self._version = version
+            self._checked_at = now
+
+    def _load(self, conn):
+        rows = conn.execute('''
+            SELECT id, name, wilaya, moughataa FROM schools
+            WHERE is_active = 1
+        ''').fetchall()
+        schools = sorted(({'id': row['id'], 'name': row['name'],
+                           'wilaya': row['wilaya'] or '', 'moughataa': row['moughataa'] or ''}
+                          for row in rows),
+                         key=lambda school: (normalize_text(school['name']), school['id']))
+
+        groups = {}
+        words = {}
+        for position, school in enumerate(schools):
+            keys = {('', ''), (school['wilaya'], ''), ('', school['moughataa']),
+                    (school['wilaya'], school['moughataa'])}
+            tokens = set(normalize_text(school['name']).split())
+            for key in keys:
+                groups.setdefault(key, []).append(position)
+                words.setdefault(key, []).extend((token, position) for token in tokens)
+        for entries in words.values():
+            entries.sort()
+
+        self._state = (schools, groups, words)
+
+    def search(self, conn, query='', wilaya='', moughataa='', offset=0, limit=SCHOOLS_PAGE_SIZE):
+        """(page of schools, total matches) in name order
+
+        Every word of query must start one of the words of a school's name.
+        """
+        self.refresh(conn)
+        schools, groups, words = self._state
+        key = (wilaya, moughataa)
+        tokens = normalize_text(query).split()
+        if not tokens:
+            positions = groups.get(key, [])
+        else:
+            words = words.get(key, [])
+            matches = None
+            for token in tokens:
+                found = set()
+                index = bisect.bisect_left(words, (token,))
+                while index < len(words) and words[index][0].startswith(token):
+                    found.add(words[index][1])
+                    index += 1
+                matches = found if matches is None else matches & found
+                if not matches:
+                    break
+            positions = sorted(matches)
+        return [schools[position] for position in positions[offset:offset + limit]], len(positions)
+
+    def grouped(self):
+        """{wilaya: {moughataa: [{id, name}]}} of every active school"""
+        schools = {}
+        for school in self._state[0]:
+            schools.setdefault(school['wilaya'], {}).setdefault(school['moughataa'], []).append(
+                {'id': school['id'], 'name': school['name']}
+            )
+        return schools
+
+
+catalog = SchoolCatalog()
+
+
+class ReferenceBundle:
+    """Everything the registration form needs, in one cached payload"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._payload = None
+        self._version = None
+
+    def get(self, conn):
+        catalog.refresh(conn)
+        if self._payload is not None and self._version == catalog.version:
+            return self._payload
+        with self._lock:
+            if self._payload is None or self._version != catalog.version:
+                version = catalog.version
+                self._payload = Payload({
+                    'wilayas': _wilaya_entries(),
+                    'user_categories': [{'value': ar, 'label_ar': ar, 'label_fr': fr}
+                                        for ar, fr in _USER_CATEGORIES],
+                    'schools': catalog.grouped()
+                })
+                self._version = version
+            return self._payload
+
+
+bundle = ReferenceBundle()
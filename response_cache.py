@@ -0,0 +1,81 @@
+"""
+Cached JSON responses for read-heavy, frequently polled endpoints
+Each entry is a serialized body with its ETag (reference_data.Payload),
+stored under a key such as ('conversations', user_id) together with the
+version of the resource it was built from. Writes bump the version
+(bump(('conversations', user_id)) when a message is sent or read), which
+makes the entries built before them misses. Entries also expire after
+RESPONSE_CACHE_TTL seconds, which bounds how stale the parts nobody bumps
+for can get (online status, another user's new name), and the least
+recently used ones are evicted beyond RESPONSE_CACHE_SIZE.
+
+Versions are per worker. Other workers learn about writes through the
+event hub (see events.py): app.py bumps the conversations of every user
+an event is dispatched to, so with EVENTS_BACKEND=sqlite they catch up
+within EVENTS_POLL_INTERVAL; with the local backend and several workers
+only the TTL applies. ETags are hashes of the body, never versions, so
+they mean the same thing whichever worker answers.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from reference_data import Payload
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 5000))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 15))
+
+
+class ResponseCache:
+    """Per-worker LRU of serialized responses, invalidated by resource version"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (version, expires at, Payload), least recently used first
+        self._entries = OrderedDict()
+        self._versions = {}
+
+    def version(self, resource):
+        return self._versions.get(resource, 0)
+
+    def bump(self, *resources):
+        """Invalidate every entry built from these resources"""
+        with self._lock:
+            for resource in resources:
+                self._versions[resource] = self._versions.get(resource, 0) + 1
+
+    def get(self, key, version):
+        """Payload cached under key for this version, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version or entry[1] < time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, version, data):
+        """Serialize data and cache it under key; returns the Payload
+
+        version must be the one read before building data, so that a bump
+        made meanwhile leaves the entry already stale.
+        """
+        payload = Payload(data)
+        if self.max_entries <= 0:
+            return payload
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+responses = ResponseCache()
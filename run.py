@@ -2,23 +2,36 @@
 """
 Tedris2 - Python Flask Application
 Educational platform for Mauritania
+
+    python run.py              # production: gunicorn with gunicorn.conf.py
+    DEBUG=true python run.py   # development: Werkzeug server with the debugger
 """
 
 import os
-from app import app, init_database
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
 
 if __name__ == '__main__':
+    debug = os.environ.get('DEBUG', 'False').lower() == 'true'
+    
+    if not debug:
+        # gunicorn.conf.py reads HOST and PORT itself
+        os.chdir(ROOT)
+        os.execv(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'])
+    
+    from app import app, init_db
+    
     # Initialize database on startup
-    init_database()
+    init_db()
     
     # Get configuration from environment variables
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5000))
-    debug = os.environ.get('DEBUG', 'True').lower() == 'true'
     
     # Run the application
     app.run(
-        debug=debug,
+        debug=True,
         host=host,
         port=port
     )
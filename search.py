@@ -0,0 +1,86 @@
+"""
+Full-text user search for the chat
+users_fts holds a normalized copy of each user's name, phone and school
+(see normalize.py) keyed by user id, so queries are index lookups with
+prefix matching instead of LIKE '%q%' scans over users.
+"""
+
+import re
+
+from normalize import normalize_text
+
+SEARCH_LIMIT = 20
+
+# The best this many matches by bm25 are joined with users and filtered.
+# bm25 is computed for every match so that the window holds the most
+# relevant ones rather than the oldest (lowest rowid); the window bounds
+# the join and the sort, not the scoring.
+SEARCH_CANDIDATES = 1000
+
+# Relative bm25 weights of the indexed columns: name, phone, school
+_WEIGHTS = (10.0, 5.0, 1.0)
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def create_index(conn):
+    """Create users_fts and fill it from users"""
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            name, phone, school,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+    ''')
+    conn.execute('DELETE FROM users_fts')
+    conn.executemany(
+        'INSERT INTO users_fts (rowid, name, phone, school) VALUES (?, ?, ?, ?)',
+        (_index_row(row['id'], row['full_name'], row['phone'], row['school'])
+         for row in conn.execute('SELECT id, full_name, phone, school FROM users'))
+    )
+
+
+def _index_row(user_id, full_name, phone, school):
+    return (user_id, normalize_text(full_name), phone or '', normalize_text(school))
+
+
+def index_user(conn, user_id, full_name, phone, school=None):
+    """Add or refresh one user in the search index (call inside the write transaction)"""
+    conn.execute('DELETE FROM users_fts WHERE rowid = ?', (user_id,))
+    conn.execute(
+        'INSERT INTO users_fts (rowid, name, phone, school) VALUES (?, ?, ?, ?)',
+        _index_row(user_id, full_name, phone, school)
+    )
+
+
+def build_match_query(query):
+    """Turn user input into an FTS5 query: every word must match as a prefix
+
+    Returns None when the input has nothing searchable in it.
+    """
+    tokens = _TOKEN.findall(normalize_text(query))
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def search_users(conn, query, exclude_user_id, limit=SEARCH_LIMIT):
+    """Best matches for query, most relevant first"""
+    match = build_match_query(query)
+    if match is None:
+        return []
+
+    return conn.execute(f'''
+        SELECT u.id, u.full_name, u.user_category, u.school, u.is_online, u.last_seen
+        FROM (
+            SELECT rowid, bm25(users_fts, {', '.join(map(str, _WEIGHTS))}) AS score
+            FROM users_fts
+            WHERE users_fts MATCH ?
+            ORDER BY score
+            LIMIT ?
+        ) f
+        JOIN users u ON u.id = f.rowid
+        WHERE u.id != ? AND u.is_verified = TRUE
+        ORDER BY f.score, u.is_online DESC
+        LIMIT ?
+    ''', (match, SEARCH_CANDIDATES, exclude_user_id, limit)).fetchall()
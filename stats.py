@@ -0,0 +1,170 @@
+"""
+Admin statistics for Tedris
+Registration counters are rolled up as users are created (in the same
+transaction), so the admin dashboard reads a handful of small rows instead
+of aggregating the users table. The assembled payload is cached per worker
+for STATS_CACHE_TTL seconds.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL', 30))
+RECENT_DAYS = 7
+DAILY_HISTORY_DAYS = 30
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily_registrations (
+            day TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    rebuild(conn)
+
+
+def rebuild(conn):
+    """Recompute every counter from the users table
+
+    Call cache.invalidate() once the transaction commits.
+    """
+    conn.execute('DELETE FROM stats_counters')
+    conn.execute('DELETE FROM stats_daily_registrations')
+    conn.execute('''
+        INSERT INTO stats_counters (dimension, key, value)
+        SELECT 'total', '', COUNT(*) FROM users
+    ''')
+    conn.execute('''
+        INSERT INTO stats_counters (dimension, key, value)
+        SELECT 'category', user_category, COUNT(*) FROM users GROUP BY user_category
+    ''')
+    conn.execute('''
+        INSERT INTO stats_counters (dimension, key, value)
+        SELECT 'wilaya', wilaya, COUNT(*) FROM users GROUP BY wilaya
+    ''')
+    conn.execute('''
+        INSERT INTO stats_counters (dimension, key, value)
+        SELECT 'moughataa', wilaya || '/' || moughataa, COUNT(*) FROM users GROUP BY wilaya, moughataa
+    ''')
+    conn.execute('''
+        INSERT INTO stats_daily_registrations (day, count)
+        SELECT date(created_at), COUNT(*) FROM users GROUP BY date(created_at)
+    ''')
+
+
+def record_registrations(conn, users):
+    """Count new users; call inside the transaction that inserts them
+
+    users is an iterable of (user_category, wilaya, moughataa) tuples.
+    Call cache.invalidate() once the transaction commits.
+    """
+    day = datetime.utcnow().strftime('%Y-%m-%d')
+    increments = {}
+    registered = 0
+    for user_category, wilaya, moughataa in users:
+        registered += 1
+        for key in (('total', ''),
+                    ('category', user_category),
+                    ('wilaya', wilaya),
+                    ('moughataa', f'{wilaya}/{moughataa}')):
+            increments[key] = increments.get(key, 0) + 1
+    if not registered:
+        return
+
+    conn.executemany('''
+        INSERT INTO stats_counters (dimension, key, value) VALUES (?, ?, ?)
+        ON CONFLICT (dimension, key) DO UPDATE SET value = value + excluded.value
+    ''', [(dimension, key, count) for (dimension, key), count in increments.items()])
+    conn.execute('''
+        INSERT INTO stats_daily_registrations (day, count) VALUES (?, ?)
+        ON CONFLICT (day) DO UPDATE SET count = count + excluded.count
+    ''', (day, registered))
+
+
+def record_registration(conn, user_category, wilaya, moughataa):
+    record_registrations(conn, [(user_category, wilaya, moughataa)])
+
+
+def _build_payload(conn):
+    counters = {}
+    for row in conn.execute('SELECT dimension, key, value FROM stats_counters'):
+        counters.setdefault(row['dimension'], {})[row['key']] = row['value']
+
+    today = datetime.utcnow().date()
+    first_day = (today - timedelta(days=DAILY_HISTORY_DAYS - 1)).isoformat()
+    recorded = dict(conn.execute(
+        'SELECT day, count FROM stats_daily_registrations WHERE day >= ?', (first_day,)
+    ).fetchall())
+    daily = []
+    for offset in range(DAILY_HISTORY_DAYS - 1, -1, -1):
+        day = (today - timedelta(days=offset)).isoformat()
+        daily.append({'day': day, 'count': recorded.get(day, 0)})
+
+    moughataas = {}
+    for key, value in counters.get('moughataa', {}).items():
+        wilaya, _, moughataa = key.partition('/')
+        moughataas.setdefault(wilaya, {})[moughataa] = value
+
+    return {
+        'total_users': counters.get('total', {}).get('', 0),
+        'recent_registrations': sum(entry['count'] for entry in daily[-RECENT_DAYS:]),
+        'categories': counters.get('category', {}),
+        'wilayas': counters.get('wilaya', {}),
+        'moughataas': moughataas,
+        'daily_registrations': daily,
+        'generated_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+
+class DashboardCache:
+    """Dashboard payload cached for a short TTL
+
+    Invalidate it after the counters change, once their transaction has
+    committed: earlier, a reader could rebuild it from the old counts and
+    serve them for the whole TTL.
+    """
+
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._payload = None
+        self._expires = 0.0
+        self._generation = 0
+
+    def get(self, conn):
+        with self._lock:
+            if self._payload is not None and time.monotonic() < self._expires:
+                return self._payload
+            generation = self._generation
+        payload = _build_payload(conn)
+        with self._lock:
+            # Invalidated meanwhile: this may have read the counts from before
+            if generation == self._generation:
+                self._payload = payload
+                self._expires = time.monotonic() + self.ttl
+        return payload
+
+    def invalidate(self):
+        # Only affects this worker; others pick the change up within the TTL
+        with self._lock:
+            self._payload = None
+            self._generation += 1
+
+
+cache = DashboardCache()
+
+
+def dashboard(conn):
+    """Statistics shown on /admin and returned by /api/admin/stats"""
+    return cache.get(conn)
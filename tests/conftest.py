@@ -0,0 +1,74 @@
+"""Shared fixtures: a fresh, migrated database per test"""
+
+import itertools
+
+import pytest
+
+import db
+import migrations
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    """Connection pool over a new database, standing in for db.pool"""
+    pool = db.ConnectionPool(str(tmp_path / 'tedris.db'), size=5, timeout=5, busy_timeout=5000)
+    conn = pool.acquire()
+    db.configure_storage(conn)
+    migrations.migrate(conn)
+    conn.close()
+    monkeypatch.setattr(db, 'pool', pool)
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture
+def conn(pool):
+    conn = pool.acquire()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def add_user(conn):
+    """add_user(**fields) inserts a user and returns its id"""
+    numbers = itertools.count(1)
+
+    def add_user(**fields):
+        number = next(numbers)
+        row = {
+            'full_name': f'User {number}',
+            'nni': f'{number:010d}',
+            'phone': f'{number:08d}',
+            'password_hash': 'x',
+            'user_category': 'student',
+            'wilaya': 'Nouakchott Nord',
+            'moughataa': 'Dar Naim',
+            **fields
+        }
+        with db.write_transaction(conn):
+            cursor = conn.execute(
+                f'INSERT INTO users ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                tuple(row.values())
+            )
+        return cursor.lastrowid
+
+    return add_user
+
+
+@pytest.fixture
+def client(pool):
+    """Test client for the app; log in with client.log_in(user_id)"""
+    from app import app
+    from response_cache import responses
+
+    # Cached responses are per process, and user ids repeat from test to test
+    responses.clear()
+    app.config['TESTING'] = True
+    client = app.test_client()
+
+    def log_in(user_id):
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+
+    client.log_in = log_in
+    return client
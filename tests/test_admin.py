@@ -0,0 +1,41 @@
+"""Admin pages and APIs are for administrators only"""
+
+import pytest
+
+import db
+
+ADMIN_APIS = ['/api/admin/users', '/api/admin/stats']
+
+
+@pytest.mark.parametrize('path', ADMIN_APIS)
+def test_admin_apis_need_a_login(client, path):
+    assert client.get(path).status_code == 401
+
+
+@pytest.mark.parametrize('path', ADMIN_APIS)
+def test_admin_apis_refuse_other_users(client, add_user, path):
+    client.log_in(add_user())
+    assert client.get(path).status_code == 403
+
+
+def test_admin_page_redirects_other_users(client, add_user):
+    client.log_in(add_user())
+    response = client.get('/admin')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/dashboard')
+
+
+@pytest.mark.parametrize('path', ADMIN_APIS)
+def test_admins_are_served(client, add_user, path):
+    client.log_in(add_user(is_admin=True))
+    assert client.get(path).status_code == 200
+
+
+def test_revoking_takes_effect_at_once(client, conn, add_user):
+    user_id = add_user(is_admin=True)
+    client.log_in(user_id)
+    assert client.get('/api/admin/users').status_code == 200
+
+    with db.write_transaction(conn):
+        conn.execute('UPDATE users SET is_admin = FALSE WHERE id = ?', (user_id,))
+    assert client.get('/api/admin/users').status_code == 403
@@ -0,0 +1,82 @@
+"""Answer matching (answers.py): which submissions count as correct"""
+
+import pytest
+
+import answers
+
+# (answer_ar, answer_fr, submission, expected)
+CORPUS = [
+    ('4', '4', '4', True),
+    ('4', '4', ' 4 ', True),
+    ('4', '4', '٤', True),
+    ('4', '4', '۴', True),
+    ('4', '4', '4.0', True),
+    ('4', '4', '+4', True),
+    ('4', '4', '44', False),
+    ('4', '4', '', False),
+    ('4', '4', '   ', False),
+    ('4', '4', None, False),
+    ('12', '12', '1', False),
+    ('12', '12', '2', False),
+    ('0.5', '0,5', '1/2', True),
+    ('0.5', '0,5', '٠٫٥', True),
+    ('0.5', '0,5', '0,5', True),
+    ('0.5', '0,5', '.5', True),
+    ('0.5', '0,5', '50%', True),
+    ('0.5', '0,5', '2/4', True),
+    ('0.5', '0,5', '5', False),
+    ('1/2', '1/2', '0.5', True),
+    ('1/2', '1/2', '1 / 2', True),
+    ('3/4', '3/4', '0.75', True),
+    ('3/4', '3/4', '4/3', False),
+    ('1 1/2', '1 1/2', '1.5', True),
+    ('1 1/2', '1 1/2', '3/2', True),
+    ('-3', '-3', '−3', True),
+    ('-3', '-3', '3', False),
+    ('س = 5', 'x = 5', '5', True),
+    ('س = 5', 'x = 5', 'x=5', True),
+    ('س = 5', 'x = 5', 'X = 5', True),
+    ('س = 5', 'x = 5', '6', False),
+    ('مثلث', 'triangle', 'مثلث', True),
+    ('مثلث', 'triangle', 'Triangle', True),
+    ('مثلث', 'triangle', 'TRIANGLE ', True),
+    ('مثلث', 'triangle', 'tri', False),
+    ('زاوية قائمة', 'angle droit', 'زاويه قائمه', True),
+    ('زاوية قائمة', 'angle droit', 'زاوِيَة قائِمَة', True),
+    ('زاوية قائمة', 'angle droit', 'angle  droit', True),
+    ('زاوية قائمة', 'angle droit', 'زاوية', False),
+    ('أربعة', 'quatre', 'اربعه', True),
+    ('أربعة', 'quatre', 'quatre', True),
+    ('متساوي الأضلاع', 'équilatéral', 'equilateral', True),
+    ('متساوي الأضلاع', 'équilatéral', 'Équilatéral', True),
+    ('متساوي الأضلاع', 'équilatéral', 'متساوي الاضلاع', True),
+    ('3.14', '3,14', '3,14', True),
+    ('3.14', '3,14', '3.140', True),
+    ('3.14', '3,14', '3.1', False),
+    ('12 | اثنا عشر', '12 | douze', 'douze', True),
+    ('12 | اثنا عشر', '12 | douze', 'اثنا عشر', True),
+    ('12 | اثنا عشر', '12 | douze', '12', True),
+    ('12 | اثنا عشر', '12 | douze', 'onze', False),
+    ('25%', '25 %', '0.25', True),
+    ('25%', '25 %', '1/4', True),
+    ('25%', '25 %', '25', False),
+    ('1/0', '1/0', '1/0', True),
+    ('1/0', '1/0', '0', False),
+    ('1 1/2', '1 1/2', '11/2', False),
+    ('12', '12', '1 2', False),
+    ('1000', '1000', '1,000', True),
+    ('1000', '1000', '1', False),
+    ('1', '1', '1,000', False),
+    ('12345678', '12345678', '12,345,678', True),
+    ('1.5', '1,5', '1,5', True),
+    ('0.125', '0,125', '0,125', True),
+    ('زاوية قائمة', 'angle droit', 'angledroit', False),
+    ('4', '4', '4' + ' ' * answers.MAX_ANSWER_LENGTH, False),
+    ('4', '4', '4' + ' ' * 199 + 'junk', False),
+]
+
+
+@pytest.mark.parametrize('answer_ar, answer_fr, submission, expected', CORPUS)
+def test_answer_matching(answer_ar, answer_fr, submission, expected):
+    compiled = answers.compile_answers(answer_ar, answer_fr)
+    assert answers.is_correct(compiled, submission) == expected
@@ -0,0 +1,130 @@
+"""Live game sessions: scored in memory, held and written by one worker"""
+
+import multiprocessing
+
+import pytest
+
+import db
+from games import GameError, GameStore
+
+BOARD = [101, 102, 103]
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = GameStore(socket_prefix=str(tmp_path / 'g'))
+    yield store
+    store.close()
+
+
+def session_row(conn, session_id):
+    return conn.execute('SELECT * FROM game_sessions WHERE id = ?', (session_id,)).fetchone()
+
+
+def test_answers_are_scored_in_memory_until_a_checkpoint(conn, add_user, store):
+    user_id = add_user()
+    session_id = store.start(conn, user_id, 'math_jeopardy', 'arabic', BOARD)
+
+    language_mode, progress = store.answer(conn, session_id, user_id, 101, 100, True, 0)
+    assert language_mode == 'arabic'
+    assert progress['total_score'] == 100
+    assert session_row(conn, session_id)['answers'] is None
+
+    with pytest.raises(GameError) as error:
+        store.answer(conn, session_id, user_id, 101, 100, True, 0)
+    assert error.value.status == 409
+
+    assert store.checkpoint() == 1
+    row = session_row(conn, session_id)
+    assert (row['score'], row['questions_answered'], row['owner']) == (100, 1, store._pid)
+
+
+def test_rejects_other_players_and_questions_off_the_board(conn, add_user, store):
+    user_id = add_user()
+    session_id = store.start(conn, user_id, 'math_jeopardy', 'arabic', BOARD)
+
+    with pytest.raises(GameError) as error:
+        store.answer(conn, session_id, add_user(), 101, 100, True, 0)
+    assert error.value.status == 404
+    with pytest.raises(GameError) as error:
+        store.answer(conn, session_id, user_id, 999, 100, True, 0)
+    assert error.value.status == 400
+
+
+def test_completing_a_game_writes_and_releases_it(conn, add_user, store):
+    user_id = add_user()
+    session_id = store.start(conn, user_id, 'math_jeopardy', 'french', BOARD)
+    for question_id in BOARD:
+        language_mode, progress = store.answer(conn, session_id, user_id, question_id, 200,
+                                               question_id != 102, 0)
+
+    assert progress['completed'] and progress['total_score'] == 400
+    row = session_row(conn, session_id)
+    assert row['completed_at'] is not None and row['owner'] is None
+    assert (row['score'], row['correct_answers']) == (400, 2)
+    assert conn.execute(
+        'SELECT score FROM leaderboard_scores WHERE board = ? AND user_id = ?', ('global', user_id)
+    ).fetchone()['score'] == 400
+
+    with pytest.raises(GameError) as error:
+        store.answer(conn, session_id, user_id, 101, 200, True, 0)
+    assert error.value.status == 409
+
+
+def _owner_worker(prefix, user_id, commands):
+    """Another worker: starts a session, then answers and checkpoints when told"""
+    store = GameStore(socket_prefix=prefix)
+    conn = db.pool.acquire()
+    commands.send(store.start(conn, user_id, 'math_jeopardy', 'arabic', BOARD))
+    while True:
+        command = commands.recv()
+        if command == 'exit':
+            # Without releasing its sessions, like a killed worker
+            return
+        session_id, question_id = command
+        store.answer(conn, session_id, user_id, question_id, 100, True, 0)
+        store.checkpoint()
+        commands.send('ok')
+
+
+@pytest.fixture
+def other_worker(tmp_path, add_user):
+    user_id = add_user()
+    commands, child_commands = multiprocessing.Pipe()
+    worker = multiprocessing.get_context('fork').Process(
+        target=_owner_worker, args=(str(tmp_path / 'g'), user_id, child_commands)
+    )
+    worker.start()
+    yield user_id, commands.recv(), commands, worker
+    if worker.is_alive():
+        commands.send('exit')
+    worker.join()
+
+
+def test_answers_are_forwarded_to_the_owner(conn, store, other_worker):
+    user_id, session_id, commands, worker = other_worker
+
+    language_mode, progress = store.answer(conn, session_id, user_id, 101, 100, True, 0)
+    assert progress['questions_answered'] == 1
+    assert store._sessions == {}
+
+    commands.send((session_id, 102))
+    assert commands.recv() == 'ok'
+    # The owner scored both answers, so a repeat is caught whoever receives it
+    with pytest.raises(GameError) as error:
+        store.answer(conn, session_id, user_id, 102, 100, True, 0)
+    assert error.value.status == 409
+    assert session_row(conn, session_id)['score'] == 200
+
+
+def test_sessions_of_an_exited_owner_are_taken_over(conn, store, other_worker):
+    user_id, session_id, commands, worker = other_worker
+    commands.send((session_id, 101))
+    assert commands.recv() == 'ok'
+    commands.send('exit')
+    worker.join()
+
+    # Resumed from the owner's last checkpoint
+    language_mode, progress = store.answer(conn, session_id, user_id, 102, 100, True, 0)
+    assert progress['questions_answered'] == 2
+    assert session_row(conn, session_id)['owner'] == store._pid
@@ -0,0 +1,83 @@
+"""Leaderboards: each worker's loaded boards follow changes made anywhere"""
+
+import pytest
+
+import db
+import leaderboard
+from leaderboard import Leaderboards
+
+GLOBAL = leaderboard.board_key('global')
+COMPLETED_AT = '2024-02-14 10:00:00'
+
+
+@pytest.fixture
+def players(conn, add_user):
+    return [add_user(), add_user(wilaya='Adrar'), add_user(user_category='teacher')]
+
+
+def record(conn, user_id, score, correct_answers=1):
+    with db.write_transaction(conn):
+        return leaderboard.record_game(conn, user_id, score, correct_answers, COMPLETED_AT)
+
+
+def standings(board):
+    return board.page(0, len(board))
+
+
+def fresh(conn, board):
+    return standings(Leaderboards(check_interval=0).board(conn, board))
+
+
+def test_changes_made_elsewhere_are_applied_to_the_loaded_board(conn, players):
+    record(conn, players[0], 300)
+    worker = Leaderboards(check_interval=0)
+    loaded = worker.board(conn, GLOBAL)
+
+    record(conn, players[1], 500)
+    record(conn, players[0], 400)
+
+    board = worker.board(conn, GLOBAL)
+    assert board is loaded
+    assert standings(board) == fresh(conn, GLOBAL)
+    assert [entry[1] for entry in standings(board)] == [players[0], players[1]]
+    assert board.rank(players[1]) == 2
+
+
+def test_own_changes_are_applied_without_a_refresh(conn, players):
+    worker = Leaderboards(check_interval=3600)
+    loaded = worker.board(conn, GLOBAL)
+
+    worker.apply(record(conn, players[2], 200))
+    assert worker.board(conn, GLOBAL) is loaded
+    assert loaded.rank(players[2]) == 1
+
+
+def test_a_missed_change_is_fetched_with_the_next_one(conn, players):
+    worker = Leaderboards(check_interval=3600)
+    worker.board(conn, GLOBAL)
+
+    # Recorded by another worker, then one of this worker's own
+    record(conn, players[0], 100)
+    worker.apply(record(conn, players[1], 200))
+
+    assert standings(worker.board(conn, GLOBAL)) == fresh(conn, GLOBAL)
+    assert len(worker.board(conn, GLOBAL)) == 2
+
+
+def test_boards_are_reloaded_after_a_rebuild(conn, players):
+    record(conn, players[0], 100)
+    worker = Leaderboards(check_interval=0)
+    loaded = worker.board(conn, GLOBAL)
+
+    with db.write_transaction(conn):
+        conn.execute('''
+            INSERT INTO game_sessions (user_id, game_type, language_mode, score, correct_answers,
+                                       completed_at)
+            VALUES (?, 'math_jeopardy', 'arabic', 700, 3, ?)
+        ''', (players[1], COMPLETED_AT))
+        leaderboard.rebuild(conn)
+
+    board = worker.board(conn, GLOBAL)
+    assert board is not loaded
+    # record() above wrote no session row, so only the rebuilt one counts
+    assert [entry[1:3] for entry in standings(board)] == [(players[1], 700)]
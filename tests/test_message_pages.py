@@ -0,0 +1,53 @@
+"""GET /api/conversations/<id>/messages: keyset pages of the history"""
+
+import pytest
+
+
+@pytest.fixture
+def history(client, add_user):
+    """Conversation id and its 7 message ids, oldest first; logged in as a participant"""
+    sender, recipient = add_user(), add_user()
+    client.log_in(sender)
+    message_ids = []
+    for number in range(7):
+        response = client.post('/api/send-message',
+                               json={'recipient_id': recipient, 'content': f'message {number}'})
+        message_ids.append(response.json['message_id'])
+    return response.json['conversation_id'], message_ids
+
+
+def page(client, conversation_id, **args):
+    response = client.get(f'/api/conversations/{conversation_id}/messages', query_string=args)
+    assert response.status_code == 200
+    return [message['id'] for message in response.json['messages']], response.json['has_more']
+
+
+def test_latest_page_is_the_most_recent_in_order(client, history):
+    conversation_id, message_ids = history
+    assert page(client, conversation_id, limit=3) == (message_ids[-3:], True)
+    assert page(client, conversation_id) == (message_ids, False)
+
+
+def test_before_id_scrolls_back(client, history):
+    conversation_id, message_ids = history
+    assert page(client, conversation_id, before_id=message_ids[4], limit=3) == (message_ids[1:4], True)
+    assert page(client, conversation_id, before_id=message_ids[1], limit=3) == (message_ids[:1], False)
+
+
+def test_after_id_returns_only_newer_messages(client, history):
+    conversation_id, message_ids = history
+    assert page(client, conversation_id, after_id=message_ids[2], limit=2) == (message_ids[3:5], True)
+    assert page(client, conversation_id, after_id=message_ids[-1]) == ([], False)
+
+
+def test_before_and_after_together_are_rejected(client, history):
+    conversation_id, message_ids = history
+    response = client.get(f'/api/conversations/{conversation_id}/messages',
+                          query_string={'before_id': message_ids[3], 'after_id': message_ids[1]})
+    assert response.status_code == 400
+
+
+def test_other_users_cannot_read_it(client, add_user, history):
+    conversation_id, _ = history
+    client.log_in(add_user())
+    assert client.get(f'/api/conversations/{conversation_id}/messages').status_code == 404
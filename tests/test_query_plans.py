@@ -0,0 +1,35 @@
+"""Hot queries keep their index plans (see migrations.check_query_plans)"""
+
+import pytest
+
+import db
+import migrations
+
+
+@pytest.fixture
+def conn(tmp_path):
+    pool = db.ConnectionPool(str(tmp_path / 'plans.db'), size=1, timeout=5, busy_timeout=5000)
+    conn = pool.acquire()
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+    pool.close_all()
+
+
+def test_hot_queries_use_indexes(conn):
+    assert migrations.check_query_plans(conn) == []
+
+
+def test_sorted_pagination_is_flagged(conn):
+    # Without the keyset index, history pages fall back to sorting every message
+    conn.execute('DROP INDEX idx_messages_conversation_id')
+    problems = migrations.check_query_plans(conn)
+    assert ('get_messages_latest', 'USE TEMP B-TREE FOR ORDER BY') in problems
+    assert ('get_messages_after', 'USE TEMP B-TREE FOR ORDER BY') in problems
+
+
+def test_full_scans_are_flagged(conn):
+    conn.execute('DROP INDEX idx_users_region_created')
+    conn.execute('DROP INDEX idx_users_wilaya_created')
+    names = {name for name, detail in migrations.check_query_plans(conn)}
+    assert 'admin_users_by_region' in names
@@ -0,0 +1,30 @@
+"""Question bank import: row validation"""
+
+import pytest
+
+from question_io import QuestionError, validate
+
+
+def row(**fields):
+    return {
+        'category': 'arithmetic', 'points': '100',
+        'question_ar': 'كم يساوي 5 × 3؟', 'question_fr': 'Combien font 5 × 3 ?',
+        'answer_ar': '15', 'answer_fr': '15',
+        **fields
+    }
+
+
+@pytest.mark.parametrize('question', ['5 × 3 = ?', 'x + 2 = 5', '√16'])
+def test_formulas_need_no_language(question):
+    assert validate(row(question_ar=question, question_fr=question))
+
+
+@pytest.mark.parametrize('fields, error', [
+    ({'question_ar': 'Combien font 5 × 3 ?'}, 'question_ar has no Arabic text'),
+    ({'question_fr': 'كم يساوي 5 × 3؟'}, 'question_fr is not French text'),
+    ({'question_fr': 'Сколько 5 × 3?'}, 'question_fr is not French text'),
+    ({'answer_fr': 'خمسة عشر'}, 'answer_fr contains Arabic text'),
+])
+def test_text_must_be_in_its_language(fields, error):
+    with pytest.raises(QuestionError, match=error):
+        validate(row(**fields))
@@ -0,0 +1,94 @@
+"""Rate limiting: the sliding window, and how login counts attempts"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import ratelimit
+from ratelimit import SlidingWindowLimiter
+
+PHONE = '22123456'
+PASSWORD = 'secret'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Stands in for time.monotonic; move it with clock.now += seconds"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: clock.now)
+    return clock
+
+
+def test_attempts_over_the_limit_are_refused_until_the_window_slides(clock):
+    limiter = SlidingWindowLimiter(limit=3, window=60)
+    assert [limiter.hit('a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.hit('a') == 60
+    assert limiter.hit('b') == 0
+
+    clock.now += 45
+    assert limiter.hit('a') == 15
+    clock.now += 15
+    assert limiter.hit('a') == 0
+
+
+def test_refused_attempts_are_not_counted(clock):
+    limiter = SlidingWindowLimiter(limit=1, window=60)
+    limiter.hit('a')
+    for _ in range(5):
+        clock.now += 10
+        limiter.hit('a')
+    clock.now += 10
+    assert limiter.hit('a') == 0
+
+
+def test_check_counts_only_what_is_recorded(clock):
+    limiter = SlidingWindowLimiter(limit=2, window=60)
+    assert [limiter.check('a') for _ in range(5)] == [0] * 5
+    limiter.record('a')
+    limiter.record('a')
+    assert limiter.check('a') == 60
+
+
+def test_reset_forgets_a_key(clock):
+    limiter = SlidingWindowLimiter(limit=1, window=60)
+    limiter.hit('a')
+    limiter.reset('a')
+    assert limiter.hit('a') == 0
+
+
+@pytest.fixture
+def login(client, add_user, monkeypatch):
+    """login(password) posts the login form for PHONE from one address"""
+    import app
+
+    add_user(phone=PHONE, password_hash=PASSWORD)
+    # Password hashing itself is not under test here
+    monkeypatch.setattr(app, 'hasher', SimpleNamespace(
+        verify=lambda password_hash, password: password == password_hash,
+        needs_rehash=lambda password_hash: False
+    ))
+    monkeypatch.setattr(ratelimit, 'login_by_phone', SlidingWindowLimiter(3, 300))
+    monkeypatch.setattr(ratelimit, 'login_failures_by_ip', SlidingWindowLimiter(5, 300))
+
+    def login(password, phone=PHONE):
+        client.get('/logout')
+        return client.post('/login', data={'phone': phone, 'password': password}).status_code
+
+    return login
+
+
+def test_successful_logins_use_up_no_limit(login):
+    assert all(login(PASSWORD) != 429 for _ in range(10))
+
+
+def test_failed_logins_are_limited_per_phone(login):
+    assert [login('wrong') for _ in range(3)] == [200] * 3
+    assert login(PASSWORD) == 429
+    # Other accounts behind the same address are unaffected
+    assert login('wrong', phone='22654321') == 200
+
+
+def test_failed_logins_are_limited_per_address(login):
+    phones = [f'2200000{n}' for n in range(5)]
+    assert [login('wrong', phone=phone) for phone in phones] == [200] * 5
+    assert login(PASSWORD) == 429
@@ -0,0 +1,46 @@
+"""POST /api/send-message: who and what can be sent"""
+
+import pytest
+
+
+@pytest.fixture
+def sender(client, add_user):
+    user_id = add_user()
+    client.log_in(user_id)
+    return user_id
+
+
+def send(client, **data):
+    return client.post('/api/send-message', json=data)
+
+
+def test_sends_to_another_user(client, conn, add_user, sender):
+    recipient_id = add_user()
+    response = send(client, recipient_id=recipient_id, content=' hello ')
+    assert response.status_code == 200
+    message = conn.execute('SELECT sender_id, content FROM messages WHERE id = ?',
+                           (response.json['message_id'],)).fetchone()
+    assert tuple(message) == (sender, 'hello')
+
+
+@pytest.mark.parametrize('recipient_id', ['2', 2.0, True, -1, 2 ** 63, 2 ** 70, [2], {'id': 2}])
+def test_rejects_recipients_that_are_not_user_ids(client, add_user, sender, recipient_id):
+    add_user()
+    assert send(client, recipient_id=recipient_id, content='hello').status_code == 400
+
+
+def test_rejects_sending_to_yourself(client, sender):
+    assert send(client, recipient_id=sender, content='hello').status_code == 400
+
+
+def test_unknown_recipient_is_not_found(client, sender):
+    assert send(client, recipient_id=sender + 1000, content='hello').status_code == 404
+
+
+@pytest.mark.parametrize('content', [None, '', '   ', 42, ['hello'], {'text': 'hello'}])
+def test_rejects_missing_or_non_text_content(client, add_user, sender, content):
+    assert send(client, recipient_id=add_user(), content=content).status_code == 400
+
+
+def test_rejects_bodies_that_are_not_objects(client, add_user, sender):
+    assert client.post('/api/send-message', json=[add_user(), 'hello']).status_code == 400
@@ -0,0 +1,36 @@
+"""Admin statistics: rolled-up counters and the dashboard cache"""
+
+import db
+import stats
+
+
+def register(conn, *users):
+    with db.write_transaction(conn):
+        stats.record_registrations(conn, users)
+    stats.cache.invalidate()
+
+
+def test_registrations_show_once_committed(conn):
+    stats.cache.invalidate()
+    before = stats.dashboard(conn)['total_users']
+    register(conn, ('student', 'Nouakchott Nord', 'Dar Naim'), ('teacher', 'Adrar', 'Atar'))
+
+    payload = stats.dashboard(conn)
+    assert payload['total_users'] == before + 2
+    assert payload['moughataas']['Adrar']['Atar'] == 1
+
+
+def test_payload_built_across_an_invalidation_is_not_kept(conn, monkeypatch):
+    build_payload = stats._build_payload
+
+    def racing_build(conn):
+        # The registration commits while this reader is building
+        payload = build_payload(conn)
+        register(conn, ('student', 'Adrar', 'Atar'))
+        return payload
+
+    stats.cache.invalidate()
+    monkeypatch.setattr(stats, '_build_payload', racing_build)
+    stale = stats.dashboard(conn)['total_users']
+    monkeypatch.setattr(stats, '_build_payload', build_payload)
+    assert stats.dashboard(conn)['total_users'] == stale + 1
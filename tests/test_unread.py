@@ -0,0 +1,64 @@
+"""Unread counters kept on conversations, per participant"""
+
+import pytest
+
+import db
+import migrations
+
+
+@pytest.fixture
+def pair(client, add_user):
+    """(sender, recipient); the client is logged in as the sender"""
+    sender, recipient = add_user(), add_user()
+    client.log_in(sender)
+    return sender, recipient
+
+
+def send(client, recipient_id, content):
+    response = client.post('/api/send-message', json={'recipient_id': recipient_id, 'content': content})
+    assert response.status_code == 200
+    return response.json['conversation_id']
+
+
+def unread_counts(client, user_id):
+    client.log_in(user_id)
+    return {conversation['id']: conversation['unread_count']
+            for conversation in client.get('/api/conversations').json}
+
+
+def test_sending_counts_for_the_recipient_only(client, pair):
+    sender, recipient = pair
+    conversation_id = send(client, recipient, 'one')
+    send(client, recipient, 'two')
+
+    assert unread_counts(client, recipient) == {conversation_id: 2}
+    assert unread_counts(client, sender) == {conversation_id: 0}
+
+
+def test_reading_resets_the_readers_counter(client, conn, pair):
+    sender, recipient = pair
+    conversation_id = send(client, recipient, 'one')
+    client.log_in(recipient)
+    send(client, sender, 'reply')
+
+    # The recipient opens the conversation: their own counter clears, the sender's stays
+    client.get(f'/api/conversations/{conversation_id}/messages')
+    assert unread_counts(client, recipient) == {conversation_id: 0}
+    assert unread_counts(client, sender) == {conversation_id: 1}
+    assert conn.execute(
+        'SELECT COUNT(*) FROM messages WHERE sender_id = ? AND is_read = FALSE', (sender,)
+    ).fetchone()[0] == 0
+
+
+def test_backfill_recomputes_counters_from_messages(client, conn, pair):
+    sender, recipient = pair
+    conversation_id = send(client, recipient, 'one')
+    send(client, recipient, 'two')
+    with db.write_transaction(conn):
+        conn.execute('UPDATE conversations SET participant1_unread = 7, participant2_unread = 7')
+        migrations.backfill_unread_counters(conn)
+
+    row = conn.execute('SELECT * FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+    counts = {row['participant1_id']: row['participant1_unread'],
+              row['participant2_id']: row['participant2_unread']}
+    assert counts == {sender: 0, recipient: 2}
@@ -0,0 +1,207 @@
+"""
+Bulk user provisioning for school-wide onboarding
+Streams a CSV of accounts (full_name, nni, phone, user_category, wilaya,
+moughataa, and optionally school and password) and creates them in batches
+of USER_BATCH_SIZE:
+
+- rows are validated with the same checks as the registration form;
+- duplicates are found with one query per batch against users, and with
+  in-memory sets against earlier rows of the file;
+- passwords are hashed in a process pool, since password hashing is
+  deliberately slow and would otherwise dominate the run;
+- each batch is inserted, indexed for search and counted in the admin
+  statistics in one write transaction.
+
+Every row gets a line in the report: created, duplicate or invalid, with
+the reason, plus the generated password for rows that had none.
+"""
+
+import csv
+import os
+import re
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import search
+import stats
+from app import validate_nni, validate_phone
+from db import write_transaction
+from hashing import hash_password
+from reference_data import USER_CATEGORIES, WILAYAS_MOUGHATAAS
+
+USER_BATCH_SIZE = 500
+USER_IMPORT_WORKERS = int(os.environ.get('USER_IMPORT_WORKERS', os.cpu_count() or 1))
+
+REQUIRED_FIELDS = ('full_name', 'nni', 'phone', 'user_category', 'wilaya', 'moughataa')
+REPORT_FIELDS = ('line', 'status', 'error', 'full_name', 'nni', 'phone', 'password')
+
+GENERATED_PASSWORD_LENGTH = 8
+
+
+class UserRow:
+    __slots__ = ('line', 'full_name', 'nni', 'phone', 'password', 'generated',
+                 'user_category', 'wilaya', 'moughataa', 'school', 'password_hash')
+
+    def __init__(self, line, record):
+        self.line = line
+        self.full_name = (record.get('full_name') or '').strip()
+        self.nni = (record.get('nni') or '').strip()
+        # Stored digits-only, the form validate_phone() accepts
+        self.phone = re.sub(r'[^\d]', '', record.get('phone') or '')
+        self.password = (record.get('password') or '').strip()
+        self.generated = not self.password
+        if self.generated:
+            self.password = ''.join(secrets.choice('0123456789') for _ in range(GENERATED_PASSWORD_LENGTH))
+        self.user_category = (record.get('user_category') or '').strip()
+        self.wilaya = (record.get('wilaya') or '').strip()
+        self.moughataa = (record.get('moughataa') or '').strip()
+        self.school = (record.get('school') or '').strip() or None
+        self.password_hash = None
+
+
+def validate(row, record):
+    """Reason the row can't be created, or None (the checks register() applies)"""
+    missing = [field for field in REQUIRED_FIELDS if not (record.get(field) or '').strip()]
+    if missing:
+        return f'missing {", ".join(missing)}'
+    if not validate_phone(row.phone):
+        return f'invalid phone: {record.get("phone")}'
+    if not validate_nni(row.nni):
+        return f'invalid nni: {row.nni}'
+    if len(row.password) < 6:
+        return 'password shorter than 6 characters'
+    if row.user_category not in USER_CATEGORIES:
+        return f'unknown user_category: {row.user_category}'
+    if row.wilaya not in WILAYAS_MOUGHATAAS:
+        return f'unknown wilaya: {row.wilaya}'
+    if row.moughataa not in WILAYAS_MOUGHATAAS[row.wilaya]:
+        return f'moughataa {row.moughataa} is not in {row.wilaya}'
+    return None
+
+
+def existing_keys(conn, rows):
+    """Phones and NNIs of rows that are already registered, in one query"""
+    phones = [row.phone for row in rows]
+    nnis = [row.nni for row in rows]
+    taken_phones = set()
+    taken_nnis = set()
+    if not rows:
+        return taken_phones, taken_nnis
+    for found in conn.execute(f'''
+        SELECT phone, nni FROM users
+        WHERE phone IN ({", ".join("?" * len(phones))})
+           OR nni IN ({", ".join("?" * len(nnis))})
+    ''', phones + nnis):
+        taken_phones.add(found['phone'])
+        taken_nnis.add(found['nni'])
+    return taken_phones, taken_nnis
+
+
+class UserImportReport:
+    """Counters for one import, with a report row per input row"""
+
+    def __init__(self, writer=None):
+        self.writer = writer
+        self.read = 0
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.started = time.perf_counter()
+        self.hash_seconds = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+    def add(self, row, status, error=''):
+        if status == 'created':
+            self.created += 1
+        elif status == 'duplicate':
+            self.duplicates += 1
+        else:
+            self.invalid += 1
+        if self.writer is not None:
+            self.writer.writerow((row.line, status, error, row.full_name, row.nni, row.phone,
+                                  row.password if row.generated and status == 'created' else ''))
+
+
+def _insert_batch(conn, rows):
+    with write_transaction(conn):
+        conn.executemany('''
+            INSERT INTO users (full_name, nni, phone, password_hash, user_category, wilaya, moughataa, school)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(row.full_name, row.nni, row.phone, row.password_hash, row.user_category,
+               row.wilaya, row.moughataa, row.school) for row in rows])
+        phones = [row.phone for row in rows]
+        for user in conn.execute(f'''
+            SELECT id, full_name, phone, school FROM users
+            WHERE phone IN ({", ".join("?" * len(phones))})
+        ''', phones).fetchall():
+            search.index_user(conn, user['id'], user['full_name'], user['phone'], user['school'])
+        stats.record_registrations(conn, [(row.user_category, row.wilaya, row.moughataa) for row in rows])
+    stats.cache.invalidate()
+
+
+def _process_batch(conn, pool, batch, seen_phones, seen_nnis, report, dry_run):
+    valid = []
+    for row, record in batch:
+        error = validate(row, record)
+        if error:
+            report.add(row, 'invalid', error)
+        elif row.phone in seen_phones or row.nni in seen_nnis:
+            report.add(row, 'duplicate', 'phone or nni repeated earlier in the file')
+        else:
+            seen_phones.add(row.phone)
+            seen_nnis.add(row.nni)
+            valid.append(row)
+
+    taken_phones, taken_nnis = existing_keys(conn, valid)
+    fresh = []
+    for row in valid:
+        if row.phone in taken_phones:
+            report.add(row, 'duplicate', 'phone already registered')
+        elif row.nni in taken_nnis:
+            report.add(row, 'duplicate', 'nni already registered')
+        else:
+            fresh.append(row)
+    if not fresh:
+        return
+
+    if not dry_run:
+        started = time.perf_counter()
+        hashes = pool.map(hash_password, [row.password for row in fresh])
+        for row, password_hash in zip(fresh, hashes):
+            row.password_hash = password_hash
+        report.hash_seconds += time.perf_counter() - started
+        _insert_batch(conn, fresh)
+    for row in fresh:
+        report.add(row, 'created')
+
+
+def import_users(conn, stream, report_stream=None, batch_size=USER_BATCH_SIZE,
+                 workers=USER_IMPORT_WORKERS, dry_run=False):
+    """Create the users listed in a CSV stream; returns a UserImportReport"""
+    writer = None
+    if report_stream is not None:
+        writer = csv.writer(report_stream)
+        writer.writerow(REPORT_FIELDS)
+    report = UserImportReport(writer)
+    seen_phones = set()
+    seen_nnis = set()
+
+    reader = csv.DictReader(stream)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for record in reader:
+            report.read += 1
+            batch.append((UserRow(reader.line_num, record), record))
+            if len(batch) >= batch_size:
+                _process_batch(conn, pool, batch, seen_phones, seen_nnis, report, dry_run)
+                batch = []
+        if batch:
+            _process_batch(conn, pool, batch, seen_phones, seen_nnis, report, dry_run)
+
+    report.elapsed = time.perf_counter() - report.started
+    return report
@@ -0,0 +1,22 @@
+"""
+Change counters for data cached in memory
+resource_versions holds one counter per cached resource. Writers bump it
+in the same transaction as the change (directly, or through the triggers
+added by migrations.add_version_triggers); caches in every worker compare
+it with the version they loaded to decide whether to reload.
+"""
+
+
+def get(conn, name):
+    """Current version of a resource, 0 if it was never changed"""
+    row = conn.execute('SELECT version FROM resource_versions WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump(conn, name):
+    """Increment a resource's version and return the new value (call inside the write transaction)"""
+    conn.execute('''
+        INSERT INTO resource_versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+    ''', (name,))
+    return get(conn, name)
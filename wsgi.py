@@ -0,0 +1,27 @@
+"""
+WSGI entry point for production servers
+Importing this module brings the database schema up to date and loads the
+in-memory caches (reference data, question bank, leaderboard, admin
+statistics). gunicorn.conf.py preloads it in the master, so this happens
+once before the workers are forked rather than once per worker.
+"""
+
+import time
+
+_started = time.perf_counter()
+
+from app import app, init_db, warm_caches  # noqa: E402
+
+imported_at = time.perf_counter()
+init_db()
+migrated_at = time.perf_counter()
+warm_caches()
+
+# Seconds spent on each startup step, logged by gunicorn.conf.py
+startup_timings = {
+    'import': imported_at - _started,
+    'init_db': migrated_at - imported_at,
+    'warm_caches': time.perf_counter() - migrated_at,
+}
+
+__all__ = ['app']